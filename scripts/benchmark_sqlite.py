@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Measure the per-write latency of the SQLite3 database under different performance settings.
+
+Fills a temporary database with a number of rows, then times individually committed updates,
+like those done by the processing steps when they mark a file as processed.
+
+Usage: python scripts/benchmark_sqlite.py [--rows 100000] [--writes 2000] [--dir /tmp]
+"""
+
+import argparse
+from pathlib import Path
+import statistics
+import tempfile
+import time
+
+from musicbird.config import Config
+from musicbird.db import SQLiteLibrary
+from musicbird.file import File, FileType
+
+PROFILES = {
+    # The settings used before the sqlite3 options were introduced (SQLite defaults)
+    "legacy": {"journal_mode": "delete", "synchronous": "full"},
+    "default": {key: value for key, value in Config._DEFAULT_CONFIG["sqlite3"].items() if key != "path"},
+}
+
+
+def benchmark(directory: Path, options: dict, rows: int, writes: int) -> list:
+    path = directory.joinpath("db.sqlite3")
+    db = SQLiteLibrary(path, options=options)
+    db.add_or_update_files(
+        File(Path(f"/music/Artist {i // 100}/Album/{i:06}.flac"), FileType.LOSSLESS, 1600000000 + i, True)
+        for i in range(rows)
+    )
+
+    latencies = []
+    for i in range(writes):
+        file = File(Path(f"/music/Artist {i // 100}/Album/{i:06}.flac"), FileType.LOSSLESS, 1600000000 + i, False)
+        start = time.perf_counter()
+        db.add_or_update_file(file)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000, help="Number of rows in the table")
+    parser.add_argument("--writes", type=int, default=2000, help="Number of individually committed writes to time")
+    parser.add_argument("--dir", default=None, help="Directory in which to create the test databases")
+    args = parser.parse_args()
+
+    print(f"{args.writes} committed single-row updates on a {args.rows}-row table")
+    print(f"{'profile':<10}{'mean (ms)':>12}{'p50 (ms)':>12}{'p99 (ms)':>12}")
+    for name, options in PROFILES.items():
+        with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+            latencies = sorted(benchmark(Path(directory), options, args.rows, args.writes))
+        print((
+            f"{name:<10}{statistics.mean(latencies) * 1000:>12.3f}"
+            f"{latencies[len(latencies) // 2] * 1000:>12.3f}{latencies[int(len(latencies) * 0.99)] * 1000:>12.3f}"
+        ))
+
+
+if __name__ == "__main__":
+    main()
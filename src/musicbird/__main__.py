@@ -8,7 +8,7 @@ from typing import List
 
 from schema import SchemaError
 
-from . import config, run, scan, prune, copy, encode, __version__
+from . import config, run, scan, move, prune, copy, encode, watch, __version__
 
 logger = logging.getLogger("musicbird")
 
@@ -34,7 +34,7 @@ def main(args: List[str]) -> bool:
                         choices=["DEBUG", "INFO", "WARNING", "ERROR", "FATAL"], default="INFO")
     parser.add_argument("--version", help="Print the program version and exit", action="store_true")
     parser.add_argument("command", nargs="?", help="The command you want to run", choices=[
-                        "config", "run", "scan", "copy", "encode", "prune"])
+                        "config", "run", "scan", "move", "copy", "encode", "prune", "watch"])
     args, command_args = parser.parse_known_args(args)
 
     logging.basicConfig(level=getattr(logging, args.loglevel))
@@ -59,12 +59,16 @@ def main(args: List[str]) -> bool:
         successful = run.run_command(parser, command_args, _config.config)
     elif args.command == "scan":
         successful = scan.scan_command(parser, command_args, _config.config)
+    elif args.command == "move":
+        successful = move.move_command(parser, command_args, _config.config)
     elif args.command == "copy":
         successful = copy.copy_command(parser, command_args, _config.config)
     elif args.command == "encode":
         successful = encode.encode_command(parser, command_args, _config.config)
     elif args.command == "prune":
         successful = prune.prune_command(parser, command_args, _config.config)
+    elif args.command == "watch":
+        successful = watch.watch_command(parser, command_args, _config.config)
     else:
         parser.parse_args()
         successful = False
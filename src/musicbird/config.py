@@ -35,13 +35,41 @@ class Config:
         "source": And(Use(Path)),
         "database": And(Use(str), len, lambda d: d in ("sqlite3")),
         Optional("sqlite3"): {
-            "path": And(Use(Path))
+            "path": And(Use(Path)),
+            "journal_mode": And(Use(str), lambda j: j.lower() in ("delete", "truncate", "persist", "memory", "wal")),
+            "synchronous": And(Use(str), lambda s: s.lower() in ("off", "normal", "full", "extra")),
+            "cache_size": And(Use(int)),
+            "mmap_size": And(Use(int), lambda m: m >= 0),
+            "temp_store": And(Use(str), lambda t: t.lower() in ("default", "file", "memory")),
+            "busy_timeout": And(Use(int), lambda b: b >= 0)
         },
         "destination": And(Use(Path)),
+        "scan": {
+            "threads": And(Use(int), lambda t: t > 0),
+            "probe_cache_size": And(Use(int), lambda s: s >= 0),
+            "change_detection": And(Use(str), lambda c: c in ("mtime", "checksum")),
+            "fast_rescan": And(Use(bool)),
+            "ignore": [And(Use(str))]
+        },
+        "watch": {
+            "method": And(Use(str), lambda m: m in ("auto", "inotify", "poll")),
+            "debounce": And(Use(float), lambda d: d >= 0),
+            "max_delay": And(Use(float), lambda d: d >= 0),
+            "poll_interval": And(Use(float), lambda p: p > 0)
+        },
         "copy": {
             "files": And(Use(bool)),
             "album_art": And(Use(bool))
         },
+        "encode": {
+            "schedule": And(Use(str), lambda s: s in ("lpt", "album", "newest", "queue")),
+            "segment_above": And(Use(float), lambda s: s >= 0),
+            "segment_length": And(Use(float), lambda s: s >= 10),
+            "stall_timeout": And(Use(float), lambda s: s >= 0),
+            "deadline_factor": And(Use(float), lambda d: d >= 0),
+            "retries": And(Use(int), lambda r: r >= 0),
+            "retry_delay": And(Use(float), lambda d: d >= 0)
+        },
         "prune": And(Use(bool)),
         "lossy_files": And(Use(str), len, lambda l: l in ("copy", "convert", "ignore")),
         "encoder": And(Use(str), len, lambda f: f in ("mp3", "opus")),
@@ -60,12 +88,40 @@ class Config:
     _DEFAULT_CONFIG = {
         "database": "sqlite3",
         "sqlite3": {
-            "path": f"{os.environ.get('XDG_DATA_HOME', os.environ['HOME'] + '/.local/share')}/{_DIRNAME}/db.sqlite3"
+            "path": f"{os.environ.get('XDG_DATA_HOME', os.environ['HOME'] + '/.local/share')}/{_DIRNAME}/db.sqlite3",
+            "journal_mode": "wal",
+            "synchronous": "normal",
+            "cache_size": -65536,
+            "mmap_size": 268435456,
+            "temp_store": "memory",
+            "busy_timeout": 5000,
+        },
+        "scan": {
+            "threads": 8,
+            "probe_cache_size": 250000,
+            "change_detection": "mtime",
+            "fast_rescan": False,
+            "ignore": ["Thumbs.db", "desktop.ini", ".DS_Store", "._*", "@eaDir/", "__MACOSX/", ".git/"],
+        },
+        "watch": {
+            "method": "auto",
+            "debounce": 5,
+            "max_delay": 60,
+            "poll_interval": 300,
         },
         "copy": {
             "files": True,
             "album_art": False,
         },
+        "encode": {
+            "schedule": "lpt",
+            "segment_above": 0,
+            "segment_length": 600,
+            "stall_timeout": 120,
+            "deadline_factor": 1.0,
+            "retries": 2,
+            "retry_delay": 5,
+        },
         "prune": True,
         "lossy_files": "copy",
         "encoder": "mp3",
@@ -229,6 +285,34 @@ class Config:
         return a
 
 
+def resolve_source_paths(config: Dict, paths: Union[List[str], None]) -> Union[List[Path], None]:
+    """Resolve paths passed with --path to absolute paths within the source library.
+
+    Relative paths are relative to the source library. Paths outside of it are skipped with an error,
+    and paths below another given path are merged into that path.
+
+    Args:
+        config (Dict): MusicBirds configuration
+        paths (Union[List[str], None]): The paths as passed on the command line, None if none were passed.
+
+    Returns:
+        Union[List[Path], None]: The resolved paths in sorted order, None if no paths were passed (meaning the
+            entire library).
+    """
+    if paths is None:
+        return None
+    source = Path(config["source"])
+    resolved = set()
+    for path in paths:
+        # Don't resolve symbolic links, paths in the DB are based on the source path as configured
+        full_path = Path(os.path.normpath(source.joinpath(Path(path).expanduser())))
+        if full_path != source and source not in full_path.parents:
+            logger.error(f"Path {path} is not in the source library {source}, skipping it")
+            continue
+        resolved.add(full_path)
+    return sorted((path for path in resolved if not resolved.intersection(path.parents)), key=str)
+
+
 def config_command(parent_parser: argparse.ArgumentParser, args: List[str], config_path: Path) -> bool:
     """Entrypoint for the CLI `config` command.
 
@@ -3,10 +3,12 @@
 
 import argparse
 import logging
-from typing import Dict, List
+from pathlib import Path
+from typing import Dict, List, Tuple
 
-from .db import LibraryDB, init as init_db
-from .file import File, FileType
+from .config import resolve_source_paths
+from .db import BATCH_SIZE, LibraryDB, init as init_db
+from .file import File, Stage
 
 logger = logging.getLogger(__name__)
 
@@ -24,15 +26,18 @@ def copy_command(parent_parser: argparse.ArgumentParser, args: List[str], config
                                      description=__doc__, prog="musicbird", parents=[parent_parser])
     parser.add_argument("--pretend", action="store_true",
                         help="Show what files would be copied, but don't perform the actual copy")
+    parser.add_argument("--path", action="append", dest="paths", metavar="PATH",
+                        help=("Only process files in this file or directory, relative to the source library. "
+                              "Can be passed multiple times"))
     args = parser.parse_args(args)
     db = init_db(config, pretend=args.pretend)
-    return copy(config, db, args.pretend)
+    return copy(config, db, args.pretend, resolve_source_paths(config, args.paths))
 
 
-def copy(config: Dict, db: LibraryDB, pretend=False) -> bool:
+def copy(config: Dict, db: LibraryDB, pretend=False, paths: List[Path] = None) -> bool:
     """Process and copy all files marked for copying to the mirror library.
 
-    Processes all regular/copyable files according to their state in the library DB.
+    Processes all files queued for the copy stage in the library DB.
     Will copy regular files, album art and lossy files depending on the values set in config,
     before marking them as processed in the Databse.
 
@@ -40,23 +45,25 @@ def copy(config: Dict, db: LibraryDB, pretend=False) -> bool:
         config (Dict): Dictionary containing the musicbird configuration.
         db (LibraryDB): Database object to read/write the library status from/to.
         pretend (bool, optional): Pretend to copy, but don't perform any filesystem operations. Defaults to False.
+        paths (List[Path], optional): Only process files at or below these paths, see
+            config.resolve_source_paths(). Defaults to None (the entire library).
 
     Returns:
         bool: True if all files were processed successfully, false if not.
     """
     to_copy: List[File] = []
-    for file in db.get_files_needing_processing():
-        if ((file.type == FileType.OTHER and config["copy"]["files"])
-            or (file.type == FileType.ALBUMART and config["copy"]["album_art"])
-            or (file.type == FileType.LOSSY and config["lossy_files"] == "copy")
-            ):
+    # Processed files are written back to the DB in batches
+    processed: List[Tuple[Stage, File]] = []
+    for file in db.iter_queued_files(Stage.COPY, paths):
+        if Stage.COPY in file.get_stages(config):
             to_copy.append(file)
-        # Remove the processing flag from files concerning us if the required option is not set
-        if ((file.type == FileType.OTHER and not config["copy"]["files"])
-            or (file.type == FileType.ALBUMART and not config["copy"]["album_art"])
-            or (file.type == FileType.LOSSY and config["lossy_files"] == "ignore")
-            ):
-            file.needs_processing = False
+        else:
+            processed.append((Stage.COPY, file))
+        # Dequeue the file from stages that the configuration excludes it from, such as ignored lossy files
+        processed.extend((stage, file) for stage in file.get_skipped_stages(config) if stage != Stage.COPY)
+        if len(processed) >= BATCH_SIZE:
+            db.complete_queued_files(processed)
+            processed = []
     logger.info(f"Need to copy {len(to_copy)} files")
 
     successes = []
@@ -64,15 +71,17 @@ def copy(config: Dict, db: LibraryDB, pretend=False) -> bool:
     for file in to_copy:
         if not pretend:
             if file.copy_to_dest(config):
-                file.needs_processing = False
-                db.add_or_update_file(file)
+                processed.append((Stage.COPY, file))
                 successes.append(file)
             else:
                 failures.append(file)
         else:
-            file.needs_processing = False
-            db.add_or_update_file(file)
+            processed.append((Stage.COPY, file))
             successes.append(file)
+        if len(processed) >= BATCH_SIZE:
+            db.complete_queued_files(processed)
+            processed = []
+    db.complete_queued_files(processed)
 
     logger.info(f"Successfully copied {len(successes)} files")
     if failures:
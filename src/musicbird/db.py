@@ -6,17 +6,27 @@ The Abstract class LibraryLB serves as the interface used by other components, w
 """
 
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import itertools
+import json
 import logging
+import os
 from pathlib import Path
 import sqlite3
 from sqlite3.dbapi2 import Row
 import sys
-from typing import Dict, List, Tuple, Union
+import threading
+import time
+from typing import ContextManager, Dict, Iterable, Iterator, List, Tuple, Union
 
-from .file import File, FileType
+from .file import STAGES_BY_TYPE, EncodeOutcome, File, FileType, Stage
+from .walker import Directory
 
 logger = logging.getLogger(__name__)
 
+BATCH_SIZE = 500
+"""Number of files that the processing steps collect before writing them to the database at once."""
+
 
 class LibraryDB(ABC):
     """Interface for communicating with a Database backend.
@@ -34,6 +44,17 @@ class LibraryDB(ABC):
             List[File]: A list of every file currently stored in the DB.
         """
 
+    @abstractmethod
+    def iter_all_files(self) -> Iterator[File]:
+        """Iterate over all files in the database, in ascending order of their path.
+
+        Unlike get_all_files(), this does not load the entire library into memory at once.
+        The database may be modified while iterating, as long as the paths of the yet unvisited files don't change.
+
+        Yields:
+            File: Every file currently stored in the DB.
+        """
+
     @abstractmethod
     def get_file_by_path(self, path: Path) -> Union[File, None]:
         """Get a file object by its path.
@@ -45,6 +66,17 @@ class LibraryDB(ABC):
             Union[File, None]: The file object if present, None if that file is not in the DB.
         """
 
+    @abstractmethod
+    def iter_files_below(self, directory: Path) -> Iterator[File]:
+        """Iterate over all files within a directory and its subdirectories.
+
+        Args:
+            directory (Path): The directory to look in.
+
+        Yields:
+            File: Every file below the directory, in ascending order of their path.
+        """
+
     @abstractmethod
     def get_files_by_type(self, filetype: FileType) -> List[File]:
         """Get all files of the specified FileType.
@@ -64,6 +96,16 @@ class LibraryDB(ABC):
             List[File]: A list of all Files that have the needs_processing flag set.
         """
 
+    @abstractmethod
+    def iter_files_needing_processing(self) -> Iterator[File]:
+        """Iterate over all files that have the needs_processing flag set, in ascending order of their path.
+
+        Like iter_all_files(), but only yields files that have the needs_processing flag set.
+
+        Yields:
+            File: Every file that has the needs_processing flag set.
+        """
+
     @abstractmethod
     def get_deleted_files(self) -> List[File]:
         """Get all files that have the was_deleted flag set.
@@ -72,6 +114,40 @@ class LibraryDB(ABC):
             List[File]: A list of all Files that have the was_deleted flag set.
         """
 
+    @abstractmethod
+    def iter_deleted_files(self) -> Iterator[File]:
+        """Iterate over all files that have the was_deleted flag set, in ascending order of their path.
+
+        Like iter_all_files(), but only yields files that have the was_deleted flag set.
+
+        Yields:
+            File: Every file that has the was_deleted flag set.
+        """
+
+    @abstractmethod
+    def count_all_files(self) -> int:
+        """Count all files in the database.
+
+        Returns:
+            int: The number of files in the DB.
+        """
+
+    @abstractmethod
+    def count_files_needing_processing(self) -> int:
+        """Count all files that have the needs_processing flag set.
+
+        Returns:
+            int: The number of files that have the needs_processing flag set.
+        """
+
+    @abstractmethod
+    def count_deleted_files(self) -> int:
+        """Count all files that have the was_deleted flag set.
+
+        Returns:
+            int: The number of files that have the was_deleted flag set.
+        """
+
     @abstractmethod
     def remove_file(self, file: File) -> None:
         """Remove this file from the DB.
@@ -80,14 +156,205 @@ class LibraryDB(ABC):
             file (File): The file to remove.
         """
 
+    @abstractmethod
+    def remove_files(self, files: Iterable[File]) -> None:
+        """Remove multiple files from the DB at once.
+
+        Args:
+            files (Iterable[File]): The files to remove.
+        """
+
+    @abstractmethod
+    def set_queued_stages(self, files: Iterable[File], stages: Iterable[Stage]) -> None:
+        """Replace the stages that files are queued for.
+
+        Args:
+            files (Iterable[File]): The files to queue. They must already be stored in the DB.
+            stages (Iterable[Stage]): The stages to queue the files for. Pass an empty list to remove the files
+                from all queues.
+        """
+
+    @abstractmethod
+    def iter_queued_files(self, stage: Stage, paths: Iterable[Path] = None) -> Iterator[File]:
+        """Iterate over all files queued for a stage, in ascending order of their path.
+
+        Like iter_all_files(), the DB may be modified while iterating.
+
+        Args:
+            stage (Stage): The stage whose queue to read.
+            paths (Iterable[Path], optional): Only return files at or below these paths, which must not overlap.
+                Files are sorted by path within each of them. Defaults to None (all files).
+
+        Yields:
+            File: Every file queued for the stage.
+        """
+
+    @abstractmethod
+    def get_queued_stages(self, file: File) -> List[Stage]:
+        """Get the stages that a file is queued for.
+
+        Args:
+            file (File): The file to look up.
+
+        Returns:
+            List[Stage]: The stages the file is queued for, empty if it is not queued.
+        """
+
+    @abstractmethod
+    def count_queued_files(self, stage: Stage, paths: Iterable[Path] = None) -> int:
+        """Count all files queued for a stage.
+
+        Args:
+            stage (Stage): The stage whose queue to count.
+            paths (Iterable[Path], optional): Only count files at or below these paths, which must not overlap.
+                Defaults to None (all files).
+
+        Returns:
+            int: The number of files queued for the stage.
+        """
+
+    @abstractmethod
+    def complete_queued_files(self, entries: Iterable[Tuple[Stage, File]]) -> None:
+        """Remove files from the queues of stages that are done with them.
+
+        Files that are no longer queued for copying or encoding have their needs_processing flag cleared.
+
+        Args:
+            entries (Iterable[Tuple[Stage, File]]): Pairs of stages and the files they completed.
+        """
+
     @abstractmethod
     def add_or_update_file(self, file: File) -> None:
         """Insert or update a file in the DB.
 
+        Files that don't have the needs_processing flag set are removed from the copy and encode queues.
+
         Args:
             file (File): The file to add or update.
         """
 
+    @abstractmethod
+    def add_or_update_files(self, files: Iterable[File]) -> None:
+        """Insert or update multiple files in the DB at once.
+
+        Files that don't have the needs_processing flag set are removed from the copy and encode queues.
+
+        Args:
+            files (Iterable[File]): The files to add or update.
+        """
+
+    @abstractmethod
+    def transaction(self) -> ContextManager[None]:
+        """Group all database operations within a with-block into a single transaction.
+
+        The transaction is committed when the block exits normally and rolled back if an exception is raised.
+        Transactions may be nested, in which case only the outermost one takes effect.
+        Other threads accessing the database wait until the transaction has completed.
+
+        Example:
+            with db.transaction():
+                db.add_or_update_files(new_files)
+                db.remove_files(old_files)
+        """
+
+    @abstractmethod
+    def next_scan_epoch(self) -> int:
+        """Get the epoch to use for a new scan.
+
+        Every scan stamps the files it sees with its epoch, which is higher than that of any previous scan.
+        Files that were not stamped by a complete scan no longer exist.
+
+        Returns:
+            int: The epoch for the new scan.
+        """
+
+    @abstractmethod
+    def mark_files_seen(self, first: Path, last: Path, epoch: int) -> None:
+        """Stamp all files whose path lies between first and last (inclusive) as seen during a scan.
+
+        Paths are compared as strings, in the same order used by iter_all_files().
+
+        Args:
+            first (Path): Path of the first file in the range.
+            last (Path): Path of the last file in the range.
+            epoch (int): The epoch of the current scan, as returned by next_scan_epoch().
+        """
+
+    @abstractmethod
+    def iter_unseen_files(self, epoch: int) -> Iterator[File]:
+        """Iterate over all files that were not seen during the given scan and are not yet marked as deleted.
+
+        Args:
+            epoch (int): The epoch of the scan, as returned by next_scan_epoch().
+
+        Yields:
+            File: Every file that was not seen during the scan, in ascending order of their path.
+        """
+
+    @abstractmethod
+    def mark_files_deleted(self, files: Iterable[File]) -> None:
+        """Set the was_deleted flag on the given files and queue them for the prune stage.
+
+        Args:
+            files (Iterable[File]): The deleted files.
+        """
+
+    @abstractmethod
+    def mark_unseen_files_deleted(self, epoch: int) -> int:
+        """Set the was_deleted flag on all files that were not seen during the given scan.
+
+        The affected files are queued for Stage.PRUNE and removed from all other queues.
+
+        Args:
+            epoch (int): The epoch of the scan, as returned by next_scan_epoch().
+
+        Returns:
+            int: The number of files that were newly marked as deleted.
+        """
+
+    @abstractmethod
+    def iter_directories(self) -> Iterator[Directory]:
+        """Iterate over all directories in the directory index.
+
+        Yields:
+            Directory: The stored listing of every indexed directory.
+        """
+
+    @abstractmethod
+    def add_or_update_directories(self, directories: Iterable[Directory]) -> None:
+        """Add directory listings to the directory index, replacing existing listings of the same directories.
+
+        Args:
+            directories (Iterable[Directory]): The listings to store.
+        """
+
+    @abstractmethod
+    def remove_directories(self, paths: Iterable[Path]) -> None:
+        """Remove directories from the directory index.
+
+        Args:
+            paths (Iterable[Path]): The paths of the directories to remove.
+        """
+
+    @abstractmethod
+    def record_encode_outcomes(self, outcomes: Iterable[Tuple[File, EncodeOutcome]]) -> None:
+        """Store the outcome of the last encode of files, replacing any previous outcome.
+
+        Args:
+            outcomes (Iterable[Tuple[File, EncodeOutcome]]): Pairs of files and the outcome of their encode.
+        """
+
+    @abstractmethod
+    def get_encode_outcome(self, file: File) -> Union[EncodeOutcome, None]:
+        """Get the outcome of the last encode of a file.
+
+        Args:
+            file (File): The file to look up.
+
+        Returns:
+            Union[EncodeOutcome, None]: The outcome, None if the file was never encoded.
+        """
+
 
 class SQLiteLibrary(LibraryDB):
     _FILES_TABLE = "Files"
@@ -96,19 +363,92 @@ class SQLiteLibrary(LibraryDB):
         "filetype": "INT",
         "mtime": "INT",
         "needs_processing": "BOOLEAN",
-        "was_deleted": "BOOLEAN"
+        "was_deleted": "BOOLEAN",
+        "scan_epoch": "INT NOT NULL DEFAULT 0",
+        # Fingerprint used for change detection. NULL in rows written by older versions
+        "mtime_ns": "INT",
+        "size": "INT",
+        "checksum": "TEXT",
+        # Identity of the file on disk and its previous path, used to detect moves
+        "dev": "INT",
+        "inode": "INT",
+        "moved_from": "TEXT",
+        # Properties of the audio, used to estimate the cost of encoding the file. NULL if unknown
+        "duration": "REAL",
+        "sample_rate": "INT",
+    }
+
+    # Stages that files are queued for. Each row is one pending stage for one file
+    _QUEUE_TABLE = "Queue"
+    _QUEUE_SCHEMA = "stage TEXT NOT NULL, path TEXT NOT NULL, PRIMARY KEY (stage, path)"
+
+    # Listings of all directories in the library, used to skip listing unchanged directories.
+    # The children are stored as a JSON list, see Directory.children
+    _DIRECTORIES_TABLE = "Directories"
+    _DIRECTORIES_SCHEMA = ("path TEXT PRIMARY KEY, mtime_ns INT NOT NULL, child_count INT NOT NULL, "
+                           "children TEXT NOT NULL")
+
+    # Outcome of the last encode of each file, see EncodeOutcome. Finished is a UNIX timestamp
+    _ENCODES_TABLE = "Encodes"
+    _ENCODES_SCHEMA = ("path TEXT PRIMARY KEY, status TEXT NOT NULL, attempts INT NOT NULL, error TEXT NOT NULL, "
+                       "elapsed REAL NOT NULL, finished INT NOT NULL")
+
+    # Indexes for the queries used to find work. The partial indexes only contain the (usually few) rows
+    # that match their condition, so they are cheap to maintain and keep these queries from scanning the entire table.
+    _INDEXES = {
+        "Files_needs_processing": f"{_FILES_TABLE}(path) WHERE needs_processing",
+        "Files_was_deleted": f"{_FILES_TABLE}(path) WHERE was_deleted",
+        "Files_filetype": f"{_FILES_TABLE}(filetype, path)",
+        "Queue_path": f"{_QUEUE_TABLE}(path)",
     }
 
-    def __init__(self, path: Path, delete: bool = False, pretend: bool = False) -> None:
+    # Number of rows fetched at once by the iter_* methods
+    _CHUNK_SIZE = 1000
+
+    # Columns written by add_or_update_files(), in the order of the parameters. The path comes first
+    _UPSERT_COLUMNS = ("path", "filetype", "mtime", "needs_processing", "was_deleted", "mtime_ns", "size", "checksum",
+                       "dev", "inode", "moved_from", "duration", "sample_rate")
+    _UPSERT_QUERY = (
+        f"INSERT INTO {_FILES_TABLE} ({', '.join(_UPSERT_COLUMNS)}) VALUES ({','.join('?' * len(_UPSERT_COLUMNS))}) "
+        f"ON CONFLICT(path) DO UPDATE SET {', '.join(f'{column}=excluded.{column}' for column in _UPSERT_COLUMNS[1:])}"
+    )
+    # UPSERT requires SQLite 3.24, which older Python builds may not ship with. They update existing rows and
+    # insert the missing ones in two separate steps instead, see add_or_update_files()
+    _UPSERT_SUPPORTED = sqlite3.sqlite_version_info >= (3, 24, 0)
+    _UPDATE_QUERY = (
+        f"UPDATE {_FILES_TABLE} SET {', '.join(f'{column}=?' for column in _UPSERT_COLUMNS[1:])} WHERE path=?"
+    )
+    _INSERT_QUERY = (
+        f"INSERT OR IGNORE INTO {_FILES_TABLE} ({', '.join(_UPSERT_COLUMNS)}) "
+        f"VALUES ({','.join('?' * len(_UPSERT_COLUMNS))})"
+    )
+
+    # Connection settings applied with PRAGMA statements. Keys match the options in the sqlite3 config section
+    _PRAGMAS = ("journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store", "busy_timeout")
+
+    def __init__(self, path: Path, delete: bool = False, pretend: bool = False, options: Dict = None) -> None:
+        """Open the SQLite3 database at path.
+
+        Args:
+            path (Path): Location of the database file.
+            delete (bool, optional): Whether to delete the existing database first. Defaults to False.
+            pretend (bool, optional): Whether to work on an in-memory copy of the database, so that no changes are
+                persisted. Defaults to False.
+            options (Dict, optional): Performance settings (journal_mode, synchronous, ...) as found in the
+                sqlite3 config section. Any setting not given uses the SQLite default. Defaults to None.
+        """
         self.path = path
+        self.options = {key: value for key, value in (options or {}).items() if key in SQLiteLibrary._PRAGMAS}
+        # The connection is shared between threads, so all access to it is serialized
+        self._lock = threading.RLock()
+        self._transaction_depth = 0
 
         if not delete and pretend:
-            # Make a copy of the existing DB and save it to a in-memory DB
-            self._init_db_con(pretend=False)
-            files = self.get_all_files()
-            self._init_db_con(pretend=True)
-            for file in files:
-                self.add_or_update_file(file)
+            # Work on an in-memory snapshot of the existing DB, if there is one. The file itself is left untouched
+            if path.exists():
+                self._snapshot_db_con()
+            else:
+                self._init_db_con(pretend=True)
         elif not delete and not pretend:
             # Default - just init the database
             self._init_db_con(pretend=False)
@@ -135,6 +475,9 @@ class SQLiteLibrary(LibraryDB):
         fetched = self._make_query(f"SELECT * FROM {SQLiteLibrary._FILES_TABLE}")
         return [self._file_from_row(row) for row in fetched]
 
+    def iter_all_files(self) -> Iterator[File]:
+        return self._iter_query()
+
     def get_file_by_path(self, path: Path) -> Union[File, None]:
         fetched = self._make_query(f"SELECT * FROM {SQLiteLibrary._FILES_TABLE} WHERE path=?", (str(path),))
         if fetched:
@@ -142,6 +485,9 @@ class SQLiteLibrary(LibraryDB):
         else:
             return None
 
+    def iter_files_below(self, directory: Path) -> Iterator[File]:
+        return self._iter_query(*SQLiteLibrary._path_scopes(SQLiteLibrary._FILES_TABLE, [directory])[1])
+
     def get_files_by_type(self, filetype: FileType):
         fetched = self._make_query(f"SELECT * FROM {SQLiteLibrary._FILES_TABLE} WHERE filetype=?", (filetype.value,))
         return [self._file_from_row(row) for row in fetched]
@@ -150,24 +496,213 @@ class SQLiteLibrary(LibraryDB):
         fetched = self._make_query(f"SELECT * FROM {SQLiteLibrary._FILES_TABLE} WHERE needs_processing")
         return [self._file_from_row(row) for row in fetched]
 
+    def iter_files_needing_processing(self) -> Iterator[File]:
+        return self._iter_query("needs_processing")
+
     def get_deleted_files(self):
         fetched = self._make_query(f"SELECT * FROM {SQLiteLibrary._FILES_TABLE} WHERE was_deleted")
         return [self._file_from_row(row) for row in fetched]
 
+    def iter_deleted_files(self) -> Iterator[File]:
+        return self._iter_query("was_deleted")
+
+    def count_all_files(self) -> int:
+        return self._make_query(f"SELECT COUNT(*) FROM {SQLiteLibrary._FILES_TABLE}")[0][0]
+
+    def count_files_needing_processing(self) -> int:
+        return self._make_query(f"SELECT COUNT(*) FROM {SQLiteLibrary._FILES_TABLE} WHERE needs_processing")[0][0]
+
+    def count_deleted_files(self) -> int:
+        return self._make_query(f"SELECT COUNT(*) FROM {SQLiteLibrary._FILES_TABLE} WHERE was_deleted")[0][0]
+
     def add_or_update_file(self, file: File) -> None:
-        self._make_query((
-            f"INSERT OR REPLACE INTO {SQLiteLibrary._FILES_TABLE} "
-            "(path, filetype, mtime, needs_processing, was_deleted) VALUES (?,?,?,?,?)"
-        ), (str(file.path), file.type.value, file.mtime, file.needs_processing, file.was_deleted))
+        self.add_or_update_files([file])
+
+    def add_or_update_files(self, files: Iterable[File]) -> None:
+        files = list(files)
+        rows = [(str(file.path), file.type.value, file.mtime, file.needs_processing, file.was_deleted,
+                 file.mtime_ns, file.size, file.checksum, file.dev, file.inode,
+                 str(file.moved_from) if file.moved_from else None, file.duration, file.sample_rate)
+                for file in files]
+        with self.transaction():
+            # Use an upsert instead of INSERT OR REPLACE to keep columns not tracked by File (such as scan_epoch) intact
+            if SQLiteLibrary._UPSERT_SUPPORTED:
+                self._make_update(SQLiteLibrary._UPSERT_QUERY, rows, many=True)
+            else:
+                self._make_update(SQLiteLibrary._UPDATE_QUERY, (row[1:] + row[:1] for row in rows), many=True)
+                self._make_update(SQLiteLibrary._INSERT_QUERY, rows, many=True)
+            self._make_update(
+                f"DELETE FROM {SQLiteLibrary._QUEUE_TABLE} WHERE path=? AND stage IN (?,?)",
+                ((str(file.path), Stage.COPY.value, Stage.ENCODE.value) for file in files if not file.needs_processing),
+                many=True)
+
+    def set_queued_stages(self, files: Iterable[File], stages: Iterable[Stage]) -> None:
+        files = list(files)
+        stages = list(stages)
+        with self.transaction():
+            self._make_update(f"DELETE FROM {SQLiteLibrary._QUEUE_TABLE} WHERE path=?",
+                              ((str(file.path),) for file in files), many=True)
+            self._make_update(f"INSERT INTO {SQLiteLibrary._QUEUE_TABLE} (stage, path) VALUES (?,?)",
+                              ((stage.value, str(file.path)) for file in files for stage in stages), many=True)
+
+    def iter_queued_files(self, stage: Stage, paths: Iterable[Path] = None) -> Iterator[File]:
+        queue = SQLiteLibrary._QUEUE_TABLE
+        if paths is None:
+            return self._iter_query("stage=?", (stage.value,), queue)
+        return itertools.chain.from_iterable(
+            self._iter_query(f"stage=? AND {condition}", (stage.value,) + params, queue)
+            for condition, params in SQLiteLibrary._path_scopes(queue, paths))
+
+    def get_queued_stages(self, file: File) -> List[Stage]:
+        return [Stage(row[0]) for row in self._make_query(
+            f"SELECT stage FROM {SQLiteLibrary._QUEUE_TABLE} WHERE path=?", (str(file.path),))]
+
+    def count_queued_files(self, stage: Stage, paths: Iterable[Path] = None) -> int:
+        queue = SQLiteLibrary._QUEUE_TABLE
+        if paths is None:
+            return self._make_query(f"SELECT COUNT(*) FROM {queue} WHERE stage=?", (stage.value,))[0][0]
+        return sum(self._make_query(f"SELECT COUNT(*) FROM {queue} WHERE stage=? AND {condition}",
+                                    (stage.value,) + params)[0][0]
+                   for condition, params in SQLiteLibrary._path_scopes(queue, paths))
+
+    def complete_queued_files(self, entries: Iterable[Tuple[Stage, File]]) -> None:
+        entries = list(entries)
+        with self.transaction():
+            self._make_update(f"DELETE FROM {SQLiteLibrary._QUEUE_TABLE} WHERE stage=? AND path=?",
+                              ((stage.value, str(file.path)) for stage, file in entries), many=True)
+            self._make_update((
+                f"UPDATE {SQLiteLibrary._FILES_TABLE} SET needs_processing=0 WHERE path=? AND needs_processing "
+                f"AND NOT EXISTS (SELECT 1 FROM {SQLiteLibrary._QUEUE_TABLE} "
+                f"WHERE {SQLiteLibrary._QUEUE_TABLE}.path = {SQLiteLibrary._FILES_TABLE}.path AND stage IN (?,?))"
+            ), ((path, Stage.COPY.value, Stage.ENCODE.value) for path in {str(file.path) for _, file in entries}),
+                many=True)
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        with self._lock:
+            self._transaction_depth += 1
+            try:
+                yield
+            except BaseException:
+                self._transaction_depth -= 1
+                if not self._transaction_depth:
+                    self._con.rollback()
+                raise
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self._con.commit()
+
+    def next_scan_epoch(self) -> int:
+        fetched = self._make_query(f"SELECT MAX(scan_epoch) FROM {SQLiteLibrary._FILES_TABLE}")
+        return (fetched[0][0] or 0) + 1
+
+    def mark_files_seen(self, first: Path, last: Path, epoch: int) -> None:
+        self._make_query(f"UPDATE {SQLiteLibrary._FILES_TABLE} SET scan_epoch=? WHERE path BETWEEN ? AND ?",
+                         (epoch, str(first), str(last)))
+
+    def iter_unseen_files(self, epoch: int) -> Iterator[File]:
+        return self._iter_query("scan_epoch < ? AND NOT was_deleted", (epoch,))
+
+    def mark_files_deleted(self, files: Iterable[File]) -> None:
+        paths = [(str(file.path),) for file in files]
+        with self.transaction():
+            self._make_update(f"DELETE FROM {SQLiteLibrary._QUEUE_TABLE} WHERE path=?", paths, many=True)
+            self._make_update(f"INSERT INTO {SQLiteLibrary._QUEUE_TABLE} (stage, path) VALUES (?,?)",
+                              ((Stage.PRUNE.value, path) for path, in paths), many=True)
+            self._make_update(f"UPDATE {SQLiteLibrary._FILES_TABLE} SET was_deleted=1 WHERE path=?", paths, many=True)
+
+    def mark_unseen_files_deleted(self, epoch: int) -> int:
+        unseen = f"SELECT path FROM {SQLiteLibrary._FILES_TABLE} WHERE scan_epoch < ? AND NOT was_deleted"
+        with self.transaction():
+            self._make_update(f"DELETE FROM {SQLiteLibrary._QUEUE_TABLE} WHERE path IN ({unseen})", (epoch,))
+            self._make_update(f"INSERT INTO {SQLiteLibrary._QUEUE_TABLE} (stage, path) SELECT ?, path FROM ({unseen})",
+                              (Stage.PRUNE.value, epoch))
+            return self._make_update(
+                f"UPDATE {SQLiteLibrary._FILES_TABLE} SET was_deleted=1 WHERE scan_epoch < ? AND NOT was_deleted",
+                (epoch,))
+
+    def iter_directories(self) -> Iterator[Directory]:
+        last_path = ""
+        while True:
+            fetched = self._make_query(
+                f"SELECT path, mtime_ns, children FROM {SQLiteLibrary._DIRECTORIES_TABLE} WHERE path > ? "
+                "ORDER BY path LIMIT ?", (last_path, SQLiteLibrary._CHUNK_SIZE))
+            for row in fetched:
+                yield Directory(Path(row["path"]), row["mtime_ns"], json.loads(row["children"]))
+            if len(fetched) < SQLiteLibrary._CHUNK_SIZE:
+                return
+            last_path = fetched[-1]["path"]
+
+    def add_or_update_directories(self, directories: Iterable[Directory]) -> None:
+        self._make_update(
+            f"INSERT OR REPLACE INTO {SQLiteLibrary._DIRECTORIES_TABLE} VALUES (?,?,?,?)",
+            ((str(directory.path), directory.mtime_ns, len(directory.children), json.dumps(directory.children))
+             for directory in directories), many=True)
+
+    def remove_directories(self, paths: Iterable[Path]) -> None:
+        self._make_update(f"DELETE FROM {SQLiteLibrary._DIRECTORIES_TABLE} WHERE path=?",
+                          ((str(path),) for path in paths), many=True)
+
+    def record_encode_outcomes(self, outcomes: Iterable[Tuple[File, EncodeOutcome]]) -> None:
+        finished = int(time.time())
+        self._make_update(
+            f"INSERT OR REPLACE INTO {SQLiteLibrary._ENCODES_TABLE} VALUES (?,?,?,?,?,?)",
+            ((str(file.path), outcome.status, outcome.attempts, outcome.error, outcome.elapsed, finished)
+             for file, outcome in outcomes), many=True)
+
+    def get_encode_outcome(self, file: File) -> Union[EncodeOutcome, None]:
+        fetched = self._make_query(f"SELECT * FROM {SQLiteLibrary._ENCODES_TABLE} WHERE path=?", (str(file.path),))
+        if not fetched:
+            return None
+        return EncodeOutcome(fetched[0]["status"], fetched[0]["attempts"], fetched[0]["error"], fetched[0]["elapsed"])
 
     def remove_file(self, file: File) -> None:
-        self._make_query(f"DELETE FROM {SQLiteLibrary._FILES_TABLE} WHERE path=?", (str(file.path),))
+        self.remove_files([file])
+
+    def remove_files(self, files: Iterable[File]) -> None:
+        paths = [(str(file.path),) for file in files]
+        with self.transaction():
+            self._make_update(f"DELETE FROM {SQLiteLibrary._QUEUE_TABLE} WHERE path=?", paths, many=True)
+            self._make_update(f"DELETE FROM {SQLiteLibrary._ENCODES_TABLE} WHERE path=?", paths, many=True)
+            self._make_update(f"DELETE FROM {SQLiteLibrary._FILES_TABLE} WHERE path=?", paths, many=True)
+
+    def _iter_query(self, condition: str = "1", params: Tuple = (), table: str = _FILES_TABLE) -> Iterator[File]:
+        """Iterate over all files matching a condition, in ascending order of their path.
+
+        Rather than keeping a cursor open, this pages through the table by path, fetching _CHUNK_SIZE rows at a time.
+        Callers can therefore write to the DB in between chunks without invalidating the iteration,
+        while the memory used stays the same regardless of the size of the library.
 
-    def _make_query(self, query: str, params: Union[Dict, Tuple] = ()) -> Union[List, None]:
-        """Perform a SQLite query with the given parameters.
+        Args:
+            condition (str, optional): SQL expression that files must match. Defaults to "1" (all files).
+            params (Tuple, optional): Parameters for the condition. Defaults to an empty tuple.
+            table (str, optional): Table to page through. Tables other than Files are joined with it by path,
+                which lets the condition refer to their columns. Defaults to the Files table.
+
+        Yields:
+            File: Every file matching the condition.
+        """
+        files = SQLiteLibrary._FILES_TABLE
+        source = files if table == files else f"{table} JOIN {files} ON {files}.path = {table}.path"
+        last_path = ""
+        while True:
+            fetched = self._make_query(
+                f"SELECT {files}.* FROM {source} WHERE ({condition}) AND {table}.path > ? "
+                f"ORDER BY {table}.path LIMIT ?",
+                params + (last_path, SQLiteLibrary._CHUNK_SIZE))
+            for row in fetched:
+                yield self._file_from_row(row)
+            if len(fetched) < SQLiteLibrary._CHUNK_SIZE:
+                return
+            last_path = fetched[-1]["path"]
+
+    def _make_query(self, query: str, params: Union[Dict, Tuple] = ()) -> List:
+        """Perform a SQLite query with the given parameters and return the resulting rows.
+
+        Queries that modify the database are committed right away, unless they run inside transaction().
 
         Args:
-            query (str): [description]
+            query (str): The query to run.
             params (Union[Dict, Tuple], optional): Parameters in a format supported by sqlite3s execute().
                 Defaults to an empty tuple.
 
@@ -175,14 +710,50 @@ class SQLiteLibrary(LibraryDB):
             sqlite3.Error: If the query failed
 
         Returns:
-            Union[List, None]: The returned rows. Might be None
+            List: The returned rows. Might be empty
+        """
+        with self._lock:
+            return self._execute(query, params).fetchall()
+
+    def _make_update(self, query: str, params: Union[Dict, Tuple, Iterable] = (), many: bool = False) -> int:
+        """Perform a SQLite query that modifies the database and return the number of affected rows.
+
+        The changes are committed right away, unless the query runs inside transaction().
+
+        Args:
+            query (str): The query to run.
+            params (Union[Dict, Tuple, Iterable], optional): Parameters in a format supported by sqlite3s execute().
+                If many is set, an iterable of such parameters, as supported by executemany().
+                Defaults to an empty tuple.
+            many (bool, optional): Whether to run the query once for every set of parameters. Defaults to False.
+
+        Raises:
+            sqlite3.Error: If the query failed
+
+        Returns:
+            int: The number of modified rows.
+        """
+        with self._lock:
+            return self._execute(query, params, many).rowcount
+
+    def _execute(self, query: str, params: Union[Dict, Tuple, Iterable], many: bool = False) -> sqlite3.Cursor:
+        """Execute a query and commit it if it is not part of a transaction().
+
+        Must be called with the lock held. See _make_update() for a description of the arguments.
         """
         try:
-            with self._con:
+            if many:
+                logger.debug(f"Running database query '{query}' for multiple sets of parameters")
+                cursor = self._con.executemany(query, params)
+            else:
                 logger.debug(f"Running database query '{query}' with parameters {params}")
-                result = self._con.execute(query, params).fetchall()
-                return result
+                cursor = self._con.execute(query, params)
+            if self._con.in_transaction and not self._transaction_depth:
+                self._con.commit()
+            return cursor
         except sqlite3.Error as e:
+            if not self._transaction_depth:
+                self._con.rollback()
             logger.fatal(f"Error performing database query: {repr(e)}")
             raise e
 
@@ -193,10 +764,6 @@ class SQLiteLibrary(LibraryDB):
             pretend (bool, optional): Whether the initialize the connection against a temporary in-memory DB.
                 Defaults to False
         """
-        columns = ', '.join([
-            f"{column} {SQLiteLibrary._FILES_COLUMNS[column]}"
-            for column in SQLiteLibrary._FILES_COLUMNS
-        ])
         try:
             if pretend:
                 self._con = sqlite3.connect(":memory:", check_same_thread=False)
@@ -204,23 +771,133 @@ class SQLiteLibrary(LibraryDB):
                 self.path.parent.mkdir(parents=True, exist_ok=True)
                 # Python <= 3.7 needs a string instead of a Path object
                 self._con = sqlite3.connect(str(self.path), check_same_thread=False)
-            self._con.row_factory = sqlite3.Row
-            with self._con:
-                self._con.execute(f"CREATE TABLE IF NOT EXISTS {SQLiteLibrary._FILES_TABLE} ({columns})")
-        except (sqlite3.Error, OSError) as e:
+            self._prepare_con()
+        except (sqlite3.Error, OSError, ValueError) as e:
             logger.fatal(f"Error while accessing/initializing SQLite3 database at {self.path}: {repr(e)}")
             raise e
 
+    def _snapshot_db_con(self) -> None:
+        """Initialize a connection to an in-memory copy of the existing database.
+
+        The copy is made page by page using SQLites online backup API, which is much faster than copying
+        the database row by row and preserves all tables, indexes and columns.
+        The database file is opened read-only and without any options, so that it is never changed:
+        schema upgrades and settings such as the journal mode are only applied to the copy.
+        """
+        try:
+            source = sqlite3.connect(f"{self.path.resolve().as_uri()}?mode=ro", uri=True)
+            try:
+                snapshot = sqlite3.connect(":memory:", check_same_thread=False)
+                if hasattr(source, "backup"):
+                    source.backup(snapshot)
+                else:
+                    # Connection.backup() requires Python 3.7
+                    snapshot.executescript("\n".join(source.iterdump()))
+            finally:
+                source.close()
+            self._con = snapshot
+            self._prepare_con()
+        except (sqlite3.Error, OSError, ValueError) as e:
+            logger.fatal(f"Error while creating a snapshot of the SQLite3 database at {self.path}: {repr(e)}")
+            raise e
+
+    def _prepare_con(self) -> None:
+        """Apply the settings to a new connection and ensure the required tables exist."""
+        columns = ', '.join([
+            f"{column} {SQLiteLibrary._FILES_COLUMNS[column]}"
+            for column in SQLiteLibrary._FILES_COLUMNS
+        ])
+        self._con.row_factory = sqlite3.Row
+        self._apply_options()
+        with self._con:
+            self._con.execute(f"CREATE TABLE IF NOT EXISTS {SQLiteLibrary._FILES_TABLE} ({columns})")
+            self._upgrade_schema()
+
+    def _apply_options(self) -> None:
+        """Apply the performance settings in self.options to the current connection.
+
+        Raises:
+            ValueError: If a setting has an invalid value.
+        """
+        for pragma, value in self.options.items():
+            # PRAGMA statements don't support parameters, so only allow simple values
+            if not str(value).lstrip("-").isalnum():
+                raise ValueError(f"Invalid value for sqlite3 option {pragma}: {value}")
+            self._con.execute(f"PRAGMA {pragma}={value}")
+
+    def _upgrade_schema(self) -> None:
+        """Bring tables created by older versions of MusicBird up to date.
+
+        Adds any tables, columns and indexes that are missing from an existing database.
+        Must be called inside a transaction.
+        """
+        if not self._con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
+                                 (SQLiteLibrary._QUEUE_TABLE,)).fetchall():
+            self._create_queue()
+        self._con.execute(
+            f"CREATE TABLE IF NOT EXISTS {SQLiteLibrary._DIRECTORIES_TABLE} ({SQLiteLibrary._DIRECTORIES_SCHEMA})")
+        self._con.execute(
+            f"CREATE TABLE IF NOT EXISTS {SQLiteLibrary._ENCODES_TABLE} ({SQLiteLibrary._ENCODES_SCHEMA})")
+
+        existing = {row["name"] for row in self._con.execute(f"PRAGMA table_info({SQLiteLibrary._FILES_TABLE})")}
+        for column in SQLiteLibrary._FILES_COLUMNS:
+            if column not in existing:
+                logger.info(f"Upgrading database: adding column {column}")
+                definition = SQLiteLibrary._FILES_COLUMNS[column]
+                self._con.execute(f"ALTER TABLE {SQLiteLibrary._FILES_TABLE} ADD COLUMN {column} {definition}")
+        for index, definition in SQLiteLibrary._INDEXES.items():
+            self._con.execute(f"CREATE INDEX IF NOT EXISTS {index} ON {definition}")
+
+    def _create_queue(self) -> None:
+        """Create the Queue table and fill it from the needs_processing and was_deleted flags.
+
+        Databases created before the introduction of queues only tracked pending work with these flags.
+        Must be called inside a transaction.
+        """
+        queue = SQLiteLibrary._QUEUE_TABLE
+        files = SQLiteLibrary._FILES_TABLE
+        self._con.execute(f"CREATE TABLE {queue} ({SQLiteLibrary._QUEUE_SCHEMA}) WITHOUT ROWID")
+        for filetype, stages in STAGES_BY_TYPE.items():
+            for stage in stages:
+                self._con.execute(
+                    (f"INSERT INTO {queue} (stage, path) SELECT ?, path FROM {files} "
+                     "WHERE needs_processing AND NOT was_deleted AND filetype=?"),
+                    (stage.value, filetype.value))
+        self._con.execute(f"INSERT INTO {queue} (stage, path) SELECT ?, path FROM {files} WHERE was_deleted",
+                          (Stage.PRUNE.value,))
+
+    @staticmethod
+    def _path_scopes(table: str, paths: Iterable[Path]) -> List[Tuple[str, Tuple]]:
+        """Build conditions that select the rows at and below the given paths.
+
+        Each path gets one condition for the path itself and one for everything below it,
+        so that every condition can be answered with a single range scan of an index on the path column.
+        A single condition for both would also have to skip the siblings that sort in between (such as "Album 2").
+
+        Args:
+            table (str): The table whose path column to compare.
+            paths (Iterable[Path]): The paths to select.
+
+        Returns:
+            List[Tuple[str, Tuple]]: Pairs of conditions and their parameters, in the order of paths.
+        """
+        scopes = []
+        for path in paths:
+            # All paths starting with "path/" sort between the separator and the character following it
+            prefix = str(path).rstrip(os.sep) + os.sep
+            scopes.append((f"{table}.path = ?", (str(path),)))
+            scopes.append((f"{table}.path > ? AND {table}.path < ?", (prefix, prefix[:-1] + chr(ord(os.sep) + 1))))
+        return scopes
+
     @staticmethod
-    def _file_from_row(row: Row) -> FileType:
+    def _file_from_row(row: Row) -> File:
         """Convert a row back into a full file object, including enums and Paths.
         """
-        file = File(**row)
-        file.path = Path(row["path"])
-        file.type = FileType(row["filetype"])
-        file.needs_processing = bool(row["needs_processing"])
-        file.was_deleted = bool(row["was_deleted"])
-        return file
+        return File(Path(row["path"]), FileType(row["filetype"]), row["mtime"],
+                    needs_processing=bool(row["needs_processing"]), was_deleted=bool(row["was_deleted"]),
+                    mtime_ns=row["mtime_ns"], size=row["size"], checksum=row["checksum"], dev=row["dev"],
+                    inode=row["inode"], moved_from=Path(row["moved_from"]) if row["moved_from"] else None,
+                    duration=row["duration"], sample_rate=row["sample_rate"])
 
 
 def init(config: Dict, delete: bool = False, pretend: bool = False, exit_on_error: bool = False) -> LibraryDB:
@@ -241,7 +918,7 @@ def init(config: Dict, delete: bool = False, pretend: bool = False, exit_on_erro
     """
     try:
         if config["database"] == "sqlite3":
-            return SQLiteLibrary(config["sqlite3"]["path"], delete, pretend)
+            return SQLiteLibrary(config["sqlite3"]["path"], delete, pretend, config["sqlite3"])
     except (OSError, sqlite3.Error) as e:
         if exit_on_error:
             sys.exit("Error initializing database")
@@ -4,13 +4,17 @@
 import argparse
 import concurrent.futures
 import logging
-from queue import Queue
+from queue import Empty, Queue
 import threading
 import time
-from typing import Dict, List
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple, Union
 
-from .db import LibraryDB, init as init_db
-from .file import File, FileType
+from .config import resolve_source_paths
+from .db import BATCH_SIZE, LibraryDB, init as init_db
+from .file import EncodeOutcome, File, Stage
+from .jobs import JobCancelledError, init as init_jobs
+from .schedule import MakespanTracker, estimate_cost, order_files
 
 logger = logging.getLogger(__name__)
 
@@ -28,117 +32,265 @@ def encode_command(parent_parser: argparse.ArgumentParser, args, config: Dict) -
                                      description=__doc__, prog="musicbird", parents=[parent_parser])
     parser.add_argument("--pretend", action="store_true",
                         help="Show what files would be converted, but don't perform the actual encoding")
+    parser.add_argument("--path", action="append", dest="paths", metavar="PATH",
+                        help=("Only process files in this file or directory, relative to the source library. "
+                              "Can be passed multiple times"))
     args = parser.parse_args(args)
     db = init_db(config, pretend=args.pretend)
-    return encode(config, db, args.pretend)
+    return encode(config, db, args.pretend, resolve_source_paths(config, args.paths))
 
 
-def _encode_worker(file: File, config: Dict, successes: Queue, failures: Queue) -> bool:
+def _encode_worker(file: File, config: Dict, results: "_ResultWriter", tracker: MakespanTracker, cost: float) -> bool:
     """Thread function that processes a single file, then returns.
 
     Called by encode(), this worker first encodes its file,
-    then puts the file into either the successes or failures queue, depending on whether everything went well.
+    then hands the result to the result writer, whether everything went well or not.
+    Exceptions raised while encoding are recorded as failures as well, as the result of the worker is never read.
+    Encodes that failed with a transient error are retried up to `encode.retries` times, waiting
+    `encode.retry_delay` seconds before the first retry and twice as long before every further one.
 
     Args:
         file (File): The file to encode.
         config (Dict): MusicBird config dict.
-        successes (Queue): Queue for successfully encoded files.
-        failures (Queue): Queue for failed encodes.
+        results (_ResultWriter): Writer that records the result in the DB.
+        tracker (MakespanTracker): Tracker that the runtime of the encode is recorded with.
+        cost (float): The estimated cost of the encode.
 
     Returns:
         bool: True if the encode was successful, False if not
     """
-    if file.encode_to_dest(config):
-        file.needs_processing = False
-        successes.put(file)
-        return True
-    else:
-        failures.put(file)
-        return False
+    start = time.monotonic()
+    attempts = 1
+    try:
+        result = file.encode_to_dest(config)
+        while not result and result.transient and attempts <= config["encode"]["retries"]:
+            delay = config["encode"]["retry_delay"] * 2 ** (attempts - 1)
+            logger.warning(f"Retrying file {file.path} in {delay:.0f} seconds after a transient error "
+                           f"(attempt {attempts + 1} of {config['encode']['retries'] + 1})")
+            time.sleep(delay)
+            result = file.encode_to_dest(config)
+            attempts += 1
+        outcome = EncodeOutcome(result.status, attempts, result.error, 0.0)
+    except JobCancelledError as e:
+        logger.error(f"Failed to encode file {file.path}: {repr(e)}")
+        outcome = EncodeOutcome("cancelled", attempts, repr(e), 0.0)
+    except Exception as e:  # pylint: disable=broad-except
+        logger.exception(f"Unexpected error while encoding file {file.path}: {repr(e)}")
+        outcome = EncodeOutcome("error", attempts, repr(e), 0.0)
+    elapsed = time.monotonic() - start
+    tracker.finish(cost, elapsed)
+    results.put(file, outcome._replace(elapsed=elapsed))
+    return outcome.status == "ok"
+
+
+def _iter_scheduled_files(config: Dict, db: LibraryDB, paths: List[Path] = None) -> Iterator[File]:
+    """Yield the queued files that need to be encoded, in the order of the configured scheduling policy.
+
+    Queued files that won't be encoded according to the configuration are dequeued along the way.
+    With the "queue" policy, files are yielded as they are read from the queue. All other policies
+    read the entire queue before yielding the first file, see schedule.order_files().
+
+    Args:
+        config (Dict): Dictionary containing the musicbird configuration.
+        db (LibraryDB): Database object to read the queue from.
+        paths (List[Path], optional): Only yield files at or below these paths. Defaults to None.
+
+    Yields:
+        File: The files to encode.
+    """
+    policy = config["encode"]["schedule"]
+    files: List[File] = []
+    skipped: List[Tuple[Stage, File]] = []
+    for file in db.iter_queued_files(Stage.ENCODE, paths):
+        if Stage.ENCODE not in file.get_stages(config):
+            skipped.extend((stage, file) for stage in file.get_skipped_stages(config))
+            if len(skipped) >= BATCH_SIZE:
+                db.complete_queued_files(skipped)
+                skipped = []
+        elif policy == "queue":
+            yield file
+        else:
+            files.append(file)
+    db.complete_queued_files(skipped)
+    if files:
+        hours = sum(estimate_cost(file) for file in files) / 3600
+        logger.info(f"Scheduling {len(files)} files by policy '{policy}', estimated {hours:.1f} hours of audio")
+        yield from order_files(files, policy)
 
 
-def _db_update_worker(db: LibraryDB, input_q: Queue, output: Queue) -> None:
-    """Processes encoded files and saves them to the DB.
+class _ResultWriter:
+    """Records the results of finished encodes in the DB.
 
-    Processes files will also be put into the output queue.
-    Terminates upon receiving a None object.
+    The outcome of every encode is recorded, and successfully encoded files are removed from the encode queue.
+    Both happen in groups: a group is committed once it contains max_items files, or once its oldest file
+    has waited for max_delay seconds, whichever comes first.
+    The writer thread blocks on the result queue, so results are picked up as soon as they arrive.
 
-    args:
-        db (LibraryLB): Database to write to.
-        input_q (Queue): Queue to read files from.
-        output (Queue): Queue to send processed files to.
+    Attributes:
+        successes: Number of files that were encoded and committed successfully.
+        failures: Files that could not be encoded.
+        commits: Number of groups committed to the DB.
+        max_depth: Highest number of results waiting in the queue while committing a group.
+        max_latency: Longest time between finishing an encode and committing it, in seconds.
     """
-    while True:
-        if not input_q.empty():
-            file = input_q.get()
-            if not file:
-                # None object was sent by controll thread -> exit
+
+    def __init__(self, db: LibraryDB, max_items: int = BATCH_SIZE, max_delay: float = 1.0) -> None:
+        """Create a new result writer. Call start() to start writing.
+
+        Args:
+            db (LibraryDB): Database to write to.
+            max_items (int, optional): Maximum number of files per group. Defaults to BATCH_SIZE.
+            max_delay (float, optional): Maximum time to hold back a finished file before committing it,
+                in seconds. Defaults to 1.0.
+        """
+        self.db = db
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.successes = 0
+        self.failures: List[File] = []
+        self.commits = 0
+        self.max_depth = 0
+        self.max_latency = 0.0
+        self._total_latency = 0.0
+        self._queue: "Queue[Union[Tuple[File, EncodeOutcome, float], None]]" = Queue()
+        self._thread = threading.Thread(target=self._run)
+
+    def start(self) -> None:
+        """Start the writer thread."""
+        self._thread.start()
+
+    def put(self, file: File, outcome: EncodeOutcome) -> None:
+        """Hand over the result of an encode. Thread-safe.
+
+        Args:
+            file (File): The file that was encoded.
+            outcome (EncodeOutcome): The outcome of the encode.
+        """
+        self._queue.put((file, outcome, time.monotonic()))
+
+    def close(self) -> None:
+        """Commit all remaining results and wait for the writer thread to finish."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def report(self) -> str:
+        """Summarize the statistics of the writer in a human-readable form.
+
+        Returns:
+            str: The number of commits, the commit latency and the highest queue depth.
+        """
+        average = self._total_latency / self.successes if self.successes else 0
+        return (f"{self.successes} files in {self.commits} commits, latency {average:.2f}s average, "
+                f"{self.max_latency:.2f}s max, up to {self.max_depth} results waiting")
+
+    def _run(self) -> None:
+        # Files waiting to be committed, with their outcome and the time their encode finished
+        group: List[Tuple[File, EncodeOutcome, float]] = []
+        deadline = 0.0
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.monotonic(), 0) if group else None)
+            except Empty:
+                self._commit(group)
+                group = []
+                continue
+            if item is None:
+                self._commit(group)
                 return
-            db.add_or_update_file(file)
-            output.put(file)
+            file, outcome, finished = item
+            if outcome.status != "ok":
+                self.failures.append(file)
+            if not group:
+                deadline = finished + self.max_delay
+            group.append((file, outcome, finished))
+            if len(group) >= self.max_items:
+                self._commit(group)
+                group = []
+
+    def _commit(self, group: List[Tuple[File, EncodeOutcome, float]]) -> None:
+        if not group:
+            return
+        depth = self._queue.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        succeeded = [(file, finished) for file, outcome, finished in group if outcome.status == "ok"]
+        with self.db.transaction():
+            self.db.record_encode_outcomes((file, outcome) for file, outcome, _ in group)
+            self.db.complete_queued_files((Stage.ENCODE, file) for file, _ in succeeded)
+        committed = time.monotonic()
+        for file, finished in succeeded:
+            self._total_latency += committed - finished
+            self.max_latency = max(self.max_latency, committed - finished)
             logger.info(f"Processed file: {file.path}")
-        else:
-            time.sleep(1)
+        self.successes += len(succeeded)
+        self.commits += 1
+        logger.debug(f"Committed {len(group)} encode results, {depth} results waiting")
 
 
-def encode(config: Dict, db: LibraryDB, pretend=False) -> bool:
+def encode(config: Dict, db: LibraryDB, pretend=False, paths: List[Path] = None) -> bool:
     """Process and copy all files marked for copying to the mirror library.
 
-    Encodes all files that are due for encoding, according to the data in the library DB.
+    Encodes all files queued for the encode stage in the library DB.
     Will encode lossles files and also lossy files, if the configuration option is set accordingly.
 
+    Files are submitted in the order of the scheduling policy set in `encode.schedule` (see the schedule module),
+    longest files first by default. At most twice as many files as there are threads are submitted at once,
+    so that the order of submission is also the order in which the encodes start.
+    Finished files are committed to the DB in groups by a _ResultWriter.
+    Once all files are encoded, the predicted and the actual makespan of the schedule are logged.
+
     Args:
         config (Dict): Dictionary containing the musicbird configuration
         db (LibraryDB): Database object to read/write the library status from/to.
         pretend (bool, optional): Pretend to encode, but don't perform any actual operations. Defaults to False.
+        paths (List[Path], optional): Only process files at or below these paths, see
+            config.resolve_source_paths(). Defaults to None (the entire library).
 
     Returns:
         bool: True if all files were processed successfully, false if not.
     """
-    to_encode: List[File] = []
-    for file in db.get_files_needing_processing():
-        if file.type == FileType.LOSSLESS or (file.type == FileType.LOSSY and config["lossy_files"] == "convert"):
-            to_encode.append(file)
-        # Remove the processing flag from lossy files if they're to be ignored
-        if file.type == FileType.LOSSY and config["lossy_files"] == "ignore":
-            file.needs_processing = False
-    logger.info(f"Need to encode {len(to_encode)} files")
+    logger.info(f"Need to encode {db.count_queued_files(Stage.ENCODE, paths)} files")
 
     if not pretend:
         # Queue structure:
-        # encode_worker --- success ---> successful_encodes ---> db_update_worker ---> processed_files
-        #      |
-        #      +----------- failure ---> failed_encodes
-        successful_encodes = Queue()
-        failed_encodes = Queue()
-        processed_files = Queue()
-
-        db_thread = threading.Thread(target=_db_update_worker, args=(db, successful_encodes, processed_files))
-        db_thread.start()
-
-        with concurrent.futures.ThreadPoolExecutor(config["threads"]) as executor:
-            for file in to_encode:
-                executor.submit(_encode_worker, file, config, successful_encodes, failed_encodes)
-
-        # Encode jobs have finished, add termination object to DB queue
-        successful_encodes.put(None)
-        db_thread.join()
-
-        # Process failures
-        failures: List[File] = []
-        while not failed_encodes.empty():
-            failures.append(failed_encodes.get_nowait())
+        # encode_worker --- result ---> result_writer ---> DB
+        results = _ResultWriter(db)
+        results.start()
+        tracker = MakespanTracker(config["threads"])
+        window = threading.BoundedSemaphore(config["threads"] * 2)
+        runner = init_jobs(config)
+        try:
+            # On SIGINT, running encodes are killed before the executor waits for its workers
+            with concurrent.futures.ThreadPoolExecutor(config["threads"]) as executor, runner.cancel_on_interrupt():
+                for file in _iter_scheduled_files(config, db, paths):
+                    # Wait for a free slot before reading the next file
+                    window.acquire()
+                    cost = estimate_cost(file)
+                    tracker.submit(cost)
+                    future = executor.submit(_encode_worker, file, config, results, tracker, cost)
+                    future.add_done_callback(lambda _: window.release())
+        finally:
+            # Encode jobs have finished, commit the remaining results
+            results.close()
+        logger.debug(f"Result writer: {results.report()}")
+        if tracker.costs:
+            logger.info(f"Makespan: {tracker.report()}")
+        encoded = results.successes
+        failures = results.failures
 
     else:
-        processed_files = []
-        for file in to_encode:
-            file.needs_processing = False
-            db.add_or_update_file(file)
-            processed_files.append(file)
+        encoded = 0
+        processed: List[Tuple[Stage, File]] = []
+        for file in _iter_scheduled_files(config, db, paths):
             logger.info(f"Encoded file: {file.path}")
+            processed.append((Stage.ENCODE, file))
+            encoded += 1
+            if len(processed) >= BATCH_SIZE:
+                db.complete_queued_files(processed)
+                processed = []
+        db.complete_queued_files(processed)
         failures = []
 
-    logger.info(f"Successfully encoded {len(to_encode) - len(failures)} files")
+    logger.info(f"Successfully encoded {encoded} files")
     if failures:
         logger.error(f"Failed to delete {len(failures)} files. See above for errors")
         failures_str = "\n".join([str(f.path) for f in failures])
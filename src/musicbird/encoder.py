@@ -5,17 +5,170 @@ The Abstract class Encoder serves as the interface used by other components, whi
 (such as MP3Encoder) are derived from it.
 """
 from abc import ABC, abstractmethod
+import errno
+import json
 import logging
+import os
 from pathlib import Path
+import shutil
 import subprocess
 import re
 import sys
-from typing import Dict
+import threading
+from typing import Callable, Dict, List, NamedTuple, Tuple, Union
 
 import ffmpeg
 
+from .jobs import JobCancelledError, JobLimits, Watchdog, get_runner
+
 logger = logging.getLogger(__name__)
 
+# Errors that are likely to go away when trying again, such as those of a network mount that is briefly unavailable
+_TRANSIENT_ERRNOS = {errno.EIO, errno.EAGAIN, errno.ETIMEDOUT, errno.ESTALE, errno.ECONNRESET, errno.EHOSTDOWN}
+_TRANSIENT_MESSAGES = re.compile(
+    r"Input/output error|Resource temporarily unavailable|Connection timed out|Stale file handle|Connection reset")
+# Lines written by ffmpeg -progress, such as "out_time_us=1234"
+_PROGRESS_LINES = re.compile(r"^\w+=\S*\n?", re.MULTILINE)
+# Maximum length of the error output kept in an EncodeResult
+_ERROR_LIMIT = 2000
+
+
+class EncodeResult(NamedTuple):
+    """The result of an encode. Evaluates to True if the encode was successful.
+
+    Attributes:
+        status: "ok" if the encode was successful. Otherwise "error", "stalled" or "timeout" if the encoder was killed
+            for making no progress or running too long, or "cancelled".
+        error: Description of the error, empty if the encode was successful.
+        transient: Whether the error is likely to go away when trying again, such as an I/O error on a network mount.
+    """
+    status: str = "ok"
+    error: str = ""
+    transient: bool = False
+
+    def __bool__(self) -> bool:
+        return self.status == "ok"
+
+    @classmethod
+    def from_os_error(cls, e: OSError) -> "EncodeResult":
+        """Create the result for an OSError, which is transient depending on its errno."""
+        return cls("error", repr(e), e.errno in _TRANSIENT_ERRNOS)
+
+
+class CapabilityCache:
+    """Persistent cache for the capabilities of external binaries such as ffmpeg or opusenc.
+
+    Checking whether a binary is present and what it supports requires spawning it, which adds up quickly
+    when done for every file. This cache stores the result of these checks on disk, keyed by the resolved
+    path of the binary and its mtime. Upgrading or replacing a binary therefore invalidates its entry.
+
+    The cache is safe to use from multiple threads. It is only loaded from disk once it is first used.
+    """
+
+    def __init__(self, path: Path = None) -> None:
+        """Create a new cache.
+
+        Args:
+            path (Path, optional): Location of the cache file. Defaults to musicbird/capabilities.json in the user's
+                cache directory. If that cannot be determined (for example because $HOME is not set),
+                the cache is only kept in memory.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Union[Dict[str, Dict], None] = None
+
+    def get(self, binary: str, probe: Callable[[str], Dict]) -> Union[Dict, None]:
+        """Get the capabilities of a binary, probing it if no valid cache entry exists.
+
+        Args:
+            binary (str): Name of the binary to look up in $PATH.
+            probe (Callable[[str], Dict]): Function that determines the capabilities of the binary.
+                Receives the full path to the binary and must return a JSON-serializable dict.
+                Exceptions raised by it are passed on to the caller.
+
+        Returns:
+            Union[Dict, None]: The capabilities of the binary, or None if the binary could not be found.
+        """
+        resolved = shutil.which(binary)
+        if not resolved:
+            return None
+        try:
+            mtime = os.stat(resolved).st_mtime_ns
+        except OSError:
+            return None
+
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            entry = self._entries.get(resolved)
+            if entry and entry["mtime"] == mtime:
+                return entry["capabilities"]
+
+            logger.debug(f"Checking capabilities of {resolved}")
+            capabilities = probe(resolved)
+            self._entries[resolved] = {"mtime": mtime, "capabilities": capabilities}
+            self._save()
+            return capabilities
+
+    def _load(self) -> None:
+        """Determine the location of the cache, then read the cache from disk."""
+        self._entries = {}
+        if self.path is None:
+            try:
+                self.path = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache", "musicbird",
+                                 "capabilities.json")
+            except (KeyError, RuntimeError) as e:
+                logger.debug(f"Could not locate the capability cache, keeping it in memory only: {repr(e)}")
+                return
+        try:
+            with self.path.open(encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def _save(self) -> None:
+        """Write the cache back to disk.
+
+        The cache only serves to speed things up, so failing to write it is not an error.
+        """
+        if self.path is None:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            with tmp.open("w", encoding="utf-8") as f:
+                json.dump(self._entries, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.debug(f"Could not save capability cache at {self.path}: {repr(e)}")
+
+
+def _probe_ffmpeg(binary: str) -> Dict:
+    """Determine the audio encoders supported by a ffmpeg binary.
+
+    Raises:
+        subprocess.CalledProcessError: If ffmpeg could not be run successfully.
+    """
+    result = subprocess.run([binary, "-hide_banner", "-encoders"],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    # Encoder lines look like " A....D libmp3lame           libmp3lame MP3 (MPEG audio layer 3)"
+    encoders = re.findall(r"^ A\S{5} (\S+)", result.stdout.decode(errors="replace"), re.MULTILINE)
+    return {"encoders": encoders}
+
+
+def _probe_opusenc(binary: str) -> Dict:
+    """Verify that opusenc can be run.
+
+    Raises:
+        subprocess.CalledProcessError: If opusenc could not be run successfully.
+    """
+    subprocess.run([binary, "--version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return {}
+
+
+capabilities = CapabilityCache()
+"""Capability cache shared by all encoders in this process."""
+
 
 class Encoder(ABC):
     """Interface for interacting with an Audio file Encoder.
@@ -24,9 +177,11 @@ class Encoder(ABC):
     """
 
     extension = ""
+    # Output format of segmented encodes (see the segment module). Empty if the encoder doesn't support them
+    segment_format = ""
 
     @abstractmethod
-    def encode(self, src: Path, dest: Path) -> bool:
+    def encode(self, src: Path, dest: Path, limits: JobLimits = None) -> EncodeResult:
         """Encode the file at src to dest.
 
         Calls the encoders backend and converts the source file, then saves the output at the destination directory.
@@ -34,24 +189,111 @@ class Encoder(ABC):
         Args:
             src (Path): The file to encode.
             dest (Path): The Path at which to store the encoded file.
+            limits (JobLimits, optional): Limits for the encoder processes. Defaults to None (no limits).
+
+        Returns:
+            EncodeResult: The result, which evaluates to True if the operation was successful.
+        """
+
+    def output_rate(self, sample_rate: int) -> int:
+        """Get the sample rate of the output of a segmented encode.
+
+        Args:
+            sample_rate (int): The sample rate of the source.
 
         Returns:
-            bool: True if the operation was successful, False if not.
+            int: The sample rate of the output.
         """
+        return sample_rate
+
+    def encode_segment(self, src: Path, dest: Path, seek: int, start: int, end: Union[int, None], sample_rate: int,
+                       first: bool, limits: JobLimits = None) -> EncodeResult:  # pylint: disable=unused-argument
+        """Encode a range of samples of the file at src to dest, as part of a segmented encode.
+
+        The output is resampled to output_rate(). Only the first segment carries the metadata of the source.
+        Only supported by encoders with a segment_format, all others fail.
+
+        Args:
+            src (Path): The file to encode.
+            dest (Path): The Path at which to store the encoded segment.
+            seek (int): Position to seek to in the source before decoding, in whole seconds.
+            start (int): First sample of the source to encode.
+            end (Union[int, None]): Sample after the last one to encode, None to encode until the end of the file.
+            sample_rate (int): The sample rate of the source.
+            first (bool): Whether this is the first segment.
+            limits (JobLimits, optional): Limits for the encoder processes. Defaults to None (no limits).
+
+        Returns:
+            EncodeResult: The result, which evaluates to True if the operation was successful.
+        """
+        logger.error(f"Failed to encode file {src}: {type(self).__name__} does not support segmented encodes")
+        return EncodeResult("error", f"{type(self).__name__} does not support segmented encodes")
 
     @staticmethod
-    def mkdir(dest: Path) -> bool:
+    def mkdir(dest: Path) -> EncodeResult:
         """Create the directory for the dest file.
 
         Returns:
-            bool: Whether the creatin was successful
+            EncodeResult: The result, which evaluates to True if the creation was successful.
         """
         try:
             dest.parent.mkdir(parents=True, exist_ok=True)
         except OSError as e:
             logger.error(f"Could not create directory to encode file {dest}: {repr(e)}")
-            return False
-        return True
+            return EncodeResult.from_os_error(e)
+        return EncodeResult()
+
+    @staticmethod
+    def _run(src: Path, args: List[str], limits: Union[JobLimits, None], ffmpeg_progress: bool = False,
+             poll: Callable[[], float] = None) -> EncodeResult:
+        """Run an encoder process through the job runner and log any errors.
+
+        If the limits contain a stall timeout, the process is watched for progress: ffmpeg reports the position
+        it has reached with -progress, other programs are polled with poll.
+
+        Args:
+            src (Path): The file being encoded.
+            args (List[str]): The program and its arguments.
+            limits (Union[JobLimits, None]): Limits for the process. None for no limits.
+            ffmpeg_progress (bool, optional): Whether the program is ffmpeg. Defaults to False.
+            poll (Callable[[], float], optional): Reads the progress of other programs,
+                such as the size of their output. Defaults to None.
+
+        Returns:
+            EncodeResult: The result of the process.
+        """
+        limits = limits or JobLimits()
+        name = os.path.basename(args[0])
+        watchdog = on_stderr = None
+        if limits.stall_timeout:
+            watchdog = Watchdog(limits.stall_timeout, poll)
+            if ffmpeg_progress:
+                args = [args[0], "-progress", "pipe:2", "-nostats"] + args[1:]
+
+                def on_stderr(line: str) -> None:
+                    key, _, value = line.partition("=")
+                    # Older versions only write out_time_ms, which is in microseconds as well
+                    if key in ("out_time_us", "out_time_ms") and value.isdigit():
+                        watchdog.update(int(value))
+        try:
+            result = get_runner().run(args, limits.timeout, on_stderr, watchdog)
+        except JobCancelledError as e:
+            logger.error(f"Failed to encode file {src}: {repr(e)}")
+            return EncodeResult("cancelled", repr(e))
+        except OSError as e:
+            logger.error(f"Failed to encode file {src}: {repr(e)}")
+            return EncodeResult.from_os_error(e)
+        if result.stalled:
+            logger.error(f"Failed to encode file {src}: {name} made no progress for {limits.stall_timeout} seconds")
+            return EncodeResult("stalled", f"{name} made no progress for {limits.stall_timeout} seconds")
+        if result.timed_out:
+            logger.error(f"Failed to encode file {src}: {name} did not finish within {limits.timeout:.0f} seconds")
+            return EncodeResult("timeout", f"{name} did not finish within {limits.timeout:.0f} seconds")
+        if result.returncode != 0:
+            output = _PROGRESS_LINES.sub("", result.stderr.decode(errors="replace"))
+            logger.error(f"Failed to encode file {src}. {name} error: \n {output}")
+            return EncodeResult("error", output.strip()[-_ERROR_LIMIT:], bool(_TRANSIENT_MESSAGES.search(output)))
+        return EncodeResult()
 
 
 class FFmpegEncoder(Encoder):
@@ -62,79 +304,171 @@ class FFmpegEncoder(Encoder):
     # We might need to use config in this class in the future, so keep it in
     # pylint: disable=unused-argument
 
+    # Name of the ffmpeg encoder used by this class. Checked against the capabilities of the installed ffmpeg
+    ffmpeg_encoder = ""
+    # Whether the output format can store album art. The first segment of a segmented encode then takes it over
+    attached_pictures = False
+
     def __init__(self, config: Dict) -> None:
         super().__init__()
         self.ffmpeg_args = {}
 
         # Check if we can access ffmpeg
         try:
-            subprocess.run(["ffmpeg", "-version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-        except FileNotFoundError as e:
-            logger.fatal("Could not access ffmpeg. Pease make sure that it is installed")
-            raise e
+            ffmpeg_capabilities = capabilities.get("ffmpeg", _probe_ffmpeg)
         except subprocess.CalledProcessError as e:
             logger.fatal(f"Could not verify that ffmpeg is ready. Error: {repr(e)}")
             raise e
+        if ffmpeg_capabilities is None:
+            logger.fatal("Could not access ffmpeg. Pease make sure that it is installed")
+            raise FileNotFoundError("ffmpeg")
+        self.supported_encoders: List[str] = ffmpeg_capabilities["encoders"]
 
-    def encode(self, src: Path, dest: Path) -> bool:
-        if not self.mkdir(dest):
-            return False
-        try:
-            logger.debug(f"Encoding to {str(dest)} with arguments {self.ffmpeg_args}")
-            stream = ffmpeg.input(str(src))
-            stream = ffmpeg.output(stream, str(dest), **self.ffmpeg_args)
-            stream = ffmpeg.overwrite_output(stream)
-            ffmpeg.run(stream, quiet=True)
-        except ffmpeg.Error as e:
-            logger.error(f"Failed to encode file {src}. ffmpeg error: \n {e.stderr}")
-            return False
-        return True
+    def _require_ffmpeg_encoder(self) -> None:
+        """Ensure that the installed ffmpeg supports the encoder used by this class.
+
+        Raises:
+            OSError: If the encoder is not available.
+        """
+        if self.ffmpeg_encoder not in self.supported_encoders:
+            logger.fatal(f"Your ffmpeg installation does not support the {self.ffmpeg_encoder} encoder")
+            raise OSError(f"ffmpeg encoder {self.ffmpeg_encoder} is not available")
+
+    def encode(self, src: Path, dest: Path, limits: JobLimits = None) -> EncodeResult:
+        created = self.mkdir(dest)
+        if not created:
+            return created
+        logger.debug(f"Encoding to {str(dest)} with arguments {self.ffmpeg_args}")
+        stream = ffmpeg.input(str(src))
+        return self._run_ffmpeg(src, ffmpeg.output(stream, str(dest), **self.ffmpeg_args), limits)
+
+    def encode_segment(self, src: Path, dest: Path, seek: int, start: int, end: Union[int, None], sample_rate: int,
+                       first: bool, limits: JobLimits = None) -> EncodeResult:
+        created = self.mkdir(dest)
+        if not created:
+            return created
+        source, audio = self._segment_input(src, seek, start, end, sample_rate)
+        streams = [audio, source["v?"]] if first and self.attached_pictures else [audio]
+        args = dict(self.ffmpeg_args, ar=self.output_rate(sample_rate), **self._segment_args(first))
+        return self._run_ffmpeg(src, ffmpeg.output(*streams, str(dest), **args), limits)
+
+    @staticmethod
+    def _segment_input(src: Path, seek: int, start: int, end: Union[int, None],
+                       sample_rate: int) -> Tuple[ffmpeg.Stream, ffmpeg.Stream]:
+        """Build the input of a segment, see encode_segment().
+
+        Seeking to a whole second is exact, the filter then trims the audio to the exact samples of the segment.
+
+        Returns:
+            Tuple[ffmpeg.Stream, ffmpeg.Stream]: The input file and its trimmed audio stream.
+        """
+        source = ffmpeg.input(str(src), ss=seek)
+        trim = {"start_sample": start - seek * sample_rate}
+        if end is not None:
+            trim["end_sample"] = end - seek * sample_rate
+        return source, source.audio.filter("atrim", **trim).filter("asetpts", "PTS-STARTPTS")
+
+    def _segment_args(self, first: bool) -> Dict:
+        """Get the additional output arguments for a segment, see encode_segment()."""
+        return {} if first else {"map_metadata": -1}
+
+    def _run_ffmpeg(self, src: Path, stream: ffmpeg.Stream, limits: Union[JobLimits, None]) -> EncodeResult:
+        """Run an ffmpeg output stream through the job runner, see _run()."""
+        return self._run(src, ffmpeg.compile(ffmpeg.overwrite_output(stream)), limits, ffmpeg_progress=True)
 
 
 class MP3Encoder(FFmpegEncoder):
+
+    ffmpeg_encoder = "libmp3lame"
+    segment_format = "mp3"
+    attached_pictures = True
+    # Sample rates supported by MP3, in order of preference
+    sample_rates = (48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000)
+
     def __init__(self, config: Dict) -> None:
         super().__init__(config)
         self.extension = ".mp3"
-        self.ffmpeg_args["acodec"] = "libmp3lame"
+        self._require_ffmpeg_encoder()
+        self.ffmpeg_args["acodec"] = self.ffmpeg_encoder
         if config["vbr"]:
             self.ffmpeg_args["q:a"] = config["quality"]
         else:
             self.ffmpeg_args["audio_bitrate"] = config["bitrate"]
 
+    def output_rate(self, sample_rate: int) -> int:
+        if sample_rate in self.sample_rates:
+            return sample_rate
+        # High-resolution sources are usually multiples of 44.1 or 48 kHz
+        return next((rate for rate in self.sample_rates if sample_rate % rate == 0), self.sample_rates[0])
+
+    def _segment_args(self, first: bool) -> Dict:
+        # Frames using the bit reservoir depend on data in earlier frames, which would be cut off by the join.
+        # All segments get a Xing/LAME header, which is needed to join them
+        args = dict(super()._segment_args(first), reservoir=0, write_xing=1)
+        if not first:
+            args["id3v2_version"] = 0
+        return args
+
 
 class OpusEncoder(FFmpegEncoder):
 
-    opusenc_checked = False
-    use_opusenc = False
+    ffmpeg_encoder = "libopus"
+    segment_format = "opus"
 
     def __init__(self, config: Dict) -> None:
         super().__init__(config)
 
         self.extension = ".opus"
 
-        if self._init_opusenc():
+        self.use_opusenc = self._init_opusenc()
+        if self.use_opusenc:
             self.opus_args = [
                 "--bitrate", re.sub(r'\D', '', config["bitrate"]),  # Strip k postfix from bitrate
             ]
         else:
             # FFmpeg fallback
-            self.ffmpeg_args["acodec"] = "libopus"
+            self._require_ffmpeg_encoder()
+            self.ffmpeg_args["acodec"] = self.ffmpeg_encoder
             self.ffmpeg_args["audio_bitrate"] = config["bitrate"]
 
-    def encode(self, src: Path, dest: Path) -> bool:
+    def encode(self, src: Path, dest: Path, limits: JobLimits = None) -> EncodeResult:
         if self.use_opusenc:
-            if not self.mkdir(dest):
-                return False
-
-            args = ["opusenc", str(src), str(dest.with_suffix(self.extension))] + self.opus_args
-            try:
-                subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-            except (subprocess.CalledProcessError, OSError) as e:
-                logger.error(f"fFailed to encode file {src}. opusenc error: \n {repr(e)}")
-                return False
-            return True
+            created = self.mkdir(dest)
+            if not created:
+                return created
+
+            output = dest.with_suffix(self.extension)
+            args = ["opusenc", str(src), str(output)] + self.opus_args
+            # opusenc writes its output as it goes, so its growth shows the progress
+            return self._run(src, args, limits, poll=lambda: output.stat().st_size)
         else:
-            return super().encode(src, dest)
+            return super().encode(src, dest, limits)
+
+    def output_rate(self, sample_rate: int) -> int:
+        # Opus always decodes to 48 kHz
+        return 48000
+
+    def encode_segment(self, src: Path, dest: Path, seek: int, start: int, end: Union[int, None], sample_rate: int,
+                       first: bool, limits: JobLimits = None) -> EncodeResult:
+        if not self.use_opusenc:
+            return super().encode_segment(src, dest, seek, start, end, sample_rate, first, limits)
+        created = self.mkdir(dest)
+        if not created:
+            return created
+
+        # opusenc can't trim its input, so extract the segment (with the album art of the source) to FLAC first
+        extracted = dest.with_suffix(".flac")
+        source, audio = self._segment_input(src, seek, start, end, sample_rate)
+        streams = [audio, source["v?"]] if first else [audio]
+        args = dict(self._segment_args(first), acodec="flac", vcodec="copy", compression_level=0)
+        try:
+            result = self._run_ffmpeg(src, ffmpeg.output(*streams, str(extracted), **args), limits)
+            if not result:
+                return result
+            return self.encode(extracted, dest, limits)
+        finally:
+            if extracted.exists():
+                extracted.unlink()
 
     def _init_opusenc(self) -> bool:
         """Look for opusenc and set the encoder to use it if available.
@@ -147,30 +481,35 @@ class OpusEncoder(FFmpegEncoder):
             bool: Whether opusenc can be used.
         """
 
-        # Use a classvar to only check for opusenc once every run.
-        # If it's not there the first, it's not gonna be there at all.
-        if OpusEncoder.opusenc_checked:
-            return OpusEncoder.use_opusenc
-
         try:
-            subprocess.run(["opusenc", "--version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-        except (FileNotFoundError, subprocess.CalledProcessError):
+            found = capabilities.get("opusenc", _probe_opusenc) is not None
+        except subprocess.CalledProcessError:
+            found = False
+        if not found:
             logger.warning((
                 "opusenc does not appear to be installed. Falling back to ffmpeg encoding."
                 "Please install 'opus-tools' if you want embedded album art support in Opus files"
             ))
-            OpusEncoder.use_opusenc = False
-        else:
-            OpusEncoder.use_opusenc = True
-        finally:
-            OpusEncoder.opusenc_checked = True
-        return OpusEncoder.use_opusenc
+        return found
+
+
+_ENCODERS = {
+    "mp3": MP3Encoder,
+    "opus": OpusEncoder,
+}
+
+# Encoder instances are stateless after initialization, so we build each configured encoder
+# only once per process and share it between all callers and threads.
+_registry: Dict[Tuple[str, str], Encoder] = {}
+_registry_lock = threading.Lock()
 
 
 def init(config, exit_on_error: bool = True) -> Encoder:
     """Initialize an encoder object based on the values provided in the config.
 
-    Creates an apropiate LibraryDB object for the given backend in config and returns it.
+    Creates an apropiate Encoder object for the encoder set in config and returns it.
+    Encoders are cached for the lifetime of the process, so calling this repeatedly with the same
+    encoder settings returns the same object.
 
     Args:
         config (Dict): MusicBirds configuration
@@ -180,13 +519,15 @@ def init(config, exit_on_error: bool = True) -> Encoder:
     Returns:
         Encoder: The Encoder object
     """
+    name = config["encoder"]
+    key = (name, json.dumps(config[name], sort_keys=True, default=str))
     try:
-        if config["encoder"] == "mp3":
-            return MP3Encoder(config["mp3"])
-        elif config["encoder"] == "opus":
-            return OpusEncoder(config["opus"])
-    except (OSError, ffmpeg.Error) as e:
+        with _registry_lock:
+            if key not in _registry:
+                _registry[key] = _ENCODERS[name](config[name])
+            return _registry[key]
+    except (OSError, ffmpeg.Error, subprocess.CalledProcessError) as e:
         if exit_on_error:
-            sys.exit("Error initializing database")
+            sys.exit(f"Error initializing encoder {name}: {repr(e)}")
         else:
             raise e
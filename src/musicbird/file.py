@@ -5,18 +5,24 @@ All file-based operations should be performed via File's methods.
 """
 
 from enum import Enum
+import json
 import logging
 import os
 from pathlib import Path
 from shutil import copy
-from typing import Dict
+from typing import Dict, List, NamedTuple, Union
 
-import ffmpeg
-
-from .encoder import init as init_encoder
+from .encoder import EncodeResult, init as init_encoder
+from .jobs import JobLimits, get_runner
+from .probecache import ProbeCache
+from .segment import encode_segmented
+from . import sniffer
 
 logger = logging.getLogger(__name__)
 
+# Time an encode may take on top of the deadline scaled by the duration of the file, in seconds
+_DEADLINE_GRACE = 60
+
 LOSSY_CODECS = [
     "mp3",
     "opus",
@@ -42,6 +48,9 @@ ALBUMART_EXTENSIONS = [
     ".png",
 ]
 
+# Maximum time ffprobe may take to parse a file, in seconds
+PROBE_TIMEOUT = 120
+
 
 class FileType(Enum):
     """Enum used to set the type of file, as far as MusicBird is concerned.
@@ -63,6 +72,54 @@ class FileType(Enum):
     """Any other kind of file"""
 
 
+class Stage(Enum):
+    """Enum for the processing stages that a file can be queued for.
+
+    During a scan, each new or changed file is queued for the stages that might apply to its type
+    (see STAGES_BY_TYPE), while deleted files are queued for pruning. Each stage then only reads the files
+    queued for it and marks them as done once processed. Which of these stages actually do something with a
+    file depends on the configuration, see File.get_stages().
+    """
+
+    COPY = "copy"
+    """Copy the file to the mirror library as-is"""
+
+    ENCODE = "encode"
+    """Encode the file and save it in the mirror library"""
+
+    PRUNE = "prune"
+    """Remove the file from the mirror library"""
+
+    MOVE = "move"
+    """Move the processed file in the mirror library from its previous path (moved_from) to its current one"""
+
+
+STAGES_BY_TYPE = {
+    FileType.LOSSY: [Stage.COPY, Stage.ENCODE],
+    FileType.LOSSLESS: [Stage.ENCODE],
+    FileType.ALBUMART: [Stage.COPY],
+    FileType.OTHER: [Stage.COPY],
+}
+"""The stages that new or changed files are queued for, depending on their type."""
+
+
+class EncodeOutcome(NamedTuple):
+    """The final outcome of encoding a file, after all retries.
+
+    Stored in the DB, see LibraryDB.record_encode_outcomes().
+
+    Attributes:
+        status: The status of the last attempt, see encoder.EncodeResult.
+        attempts: Number of attempts made.
+        error: Error of the last attempt, empty if it was successful.
+        elapsed: Total time spent on all attempts (including the delays between them), in seconds.
+    """
+    status: str
+    attempts: int
+    error: str
+    elapsed: float
+
+
 class File:
     """Provides an abstraction layer for all operations on the music library source files.
 
@@ -82,10 +139,21 @@ class File:
             This usually means that file was modified/added recently.
         was_deleted: Bool indicating whether the file was deleted and no longer exists on the fs.
             Used to track deletions.
+        mtime_ns: Last time the file was modified, in nanoseconds. None if unknown.
+        size: Size of the file in bytes. None if unknown.
+        checksum: Partial checksum of the file contents, see fingerprint.partial_checksum(). None if not computed.
+        dev: Device number of the filesystem the file is stored on. None if unknown.
+        inode: Inode number of the file. None if unknown.
+        moved_from: Previous path of the file, if it was moved since it was last processed. None otherwise.
+        duration: Length of the audio in the file in seconds. None if unknown or not an audio file.
+        sample_rate: Sample rate of the audio in the file in Hz. None if unknown or not an audio file.
     """
 
     def __init__(self, path: Path, filetype: FileType = None, mtime: int = None,
-                 needs_processing: bool = False, was_deleted: bool = False) -> None:
+                 needs_processing: bool = False, was_deleted: bool = False,
+                 mtime_ns: int = None, size: int = None, checksum: str = None,
+                 dev: int = None, inode: int = None, moved_from: Path = None,
+                 duration: float = None, sample_rate: int = None) -> None:
         """Creates a new File object, representing a physical file in the source libary.
 
         Args:
@@ -97,14 +165,36 @@ class File:
                 This usually means that file was modified/added recently.
             was_deleted(bool, optional): Bool indicating whether the file was deleted and no longer exists on the fs.
                 Used to track deletions.
+            mtime_ns(int, optional): Last time the file was modified in nanoseconds.
+                Will be read along with the mtime if that is not specified.
+            size(int, optional): Size of the file in bytes. Will be read along with the mtime if that is not specified.
+            checksum(str, optional): Partial checksum of the file contents.
+            dev(int, optional): Device number of the file. Will be read along with the mtime if that is not specified.
+            inode(int, optional): Inode number of the file. Will be read along with the mtime if that is not specified.
+            moved_from(Path, optional): Previous path of the file if it was moved.
+            duration(float, optional): Length of the audio in seconds. Set by determine_type() if not specified.
+            sample_rate(int, optional): Sample rate of the audio in Hz. Set by determine_type() if not specified.
         """
         self.path = path
         self.needs_processing = needs_processing
         self.was_deleted = was_deleted
         self.type = filetype
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.checksum = checksum
+        self.dev = dev
+        self.inode = inode
+        self.moved_from = moved_from
+        self.duration = duration
+        self.sample_rate = sample_rate
 
         if not mtime:
-            self.mtime = round(os.path.getmtime(path))
+            stat = os.stat(path)
+            self.mtime = round(stat.st_mtime)
+            self.mtime_ns = stat.st_mtime_ns
+            self.size = stat.st_size
+            self.dev = stat.st_dev
+            self.inode = stat.st_ino
         else:
             self.mtime = mtime
 
@@ -138,7 +228,7 @@ class File:
             return False
         return True
 
-    def encode_to_dest(self, config: Dict) -> bool:
+    def encode_to_dest(self, config: Dict) -> EncodeResult:
         """Encode the file and save it in the destination library.
 
         Encodes the file to its relative path in the destination library specified in config.
@@ -147,16 +237,30 @@ class File:
         ~/music_converted/Artist1/Album1/Track1.mp3/opus/...
 
         Any missing directories will be created.
+        Files longer than `encode.segment_above` seconds are encoded in segments that run in parallel,
+        if their duration and sample rate are known and the encoder supports it.
+        Encoder processes are killed if they make no progress for `encode.stall_timeout` seconds, or if they run
+        longer than `encode.deadline_factor` times the duration of the file (if known).
 
         Args:
             config(dict): Musicbird config as a dict.
 
         Returns:
-            bool: True if the encode operation was successful, False if not.
+            EncodeResult: The result, which evaluates to True if the encode operation was successful.
         """
         dest = self.get_dest_path(config)
         encoder = init_encoder(config)
-        return encoder.encode(self.path, dest)
+        settings = config["encode"]
+        timeout = None
+        if settings["deadline_factor"] and self.duration:
+            timeout = _DEADLINE_GRACE + self.duration * settings["deadline_factor"]
+        limits = JobLimits(timeout, settings["stall_timeout"] or None)
+        segment_above = settings["segment_above"]
+        if (segment_above and self.duration and self.sample_rate and self.duration > segment_above
+                and encoder.segment_format):
+            return encode_segmented(encoder, self.path, dest, self.duration, self.sample_rate,
+                                    settings["segment_length"], limits)
+        return encoder.encode(self.path, dest, limits)
 
     def get_dest_path(self, config: Dict) -> Path:
         """Get the files path in the destination library.
@@ -185,48 +289,151 @@ class File:
             path = path.with_suffix(init_encoder(config).extension)
         return path
 
-    def determine_type(self) -> None:
+    def get_stages(self, config: Dict) -> List[Stage]:
+        """Get the stages that need to process this file, according to the configuration.
+
+        This is always a subset of the stages the file was queued for by type (STAGES_BY_TYPE).
+        Deletions are not considered here.
+
+        Args:
+            config(dict): The musicbird configuration in dict form.
+
+        Returns:
+            List[Stage]: The stages that need to process the file. Empty if the file is ignored.
+        """
+        if self.type == FileType.LOSSLESS:
+            return [Stage.ENCODE]
+        elif self.type == FileType.LOSSY:
+            return {"copy": [Stage.COPY], "convert": [Stage.ENCODE], "ignore": []}[config["lossy_files"]]
+        elif self.type == FileType.ALBUMART:
+            return [Stage.COPY] if config["copy"]["album_art"] else []
+        else:
+            return [Stage.COPY] if config["copy"]["files"] else []
+
+    def get_skipped_stages(self, config: Dict) -> List[Stage]:
+        """Get the stages that this file was queued for by type, but that don't apply to it in the configuration.
+
+        Stages should mark these as done alongside their own, so that files don't linger in the other queues.
+
+        Args:
+            config(dict): The musicbird configuration in dict form.
+
+        Returns:
+            List[Stage]: The queued stages that won't process this file.
+        """
+        stages = self.get_stages(config)
+        return [stage for stage in STAGES_BY_TYPE[self.type] if stage not in stages]
+
+    def determine_type(self, probe_cache: ProbeCache = None) -> None:
         """Detects the type of file and sets the filetype attribute accordingly.
 
         Tries to figure out the kind of file present at self.path based on a few tests,
-        then sets the filetype attribute to the best match. Among other things, it uses
-        ffmpeg to parse media files and checks the filename for patterns(such as cover.jpg) files.
+        then sets the filetype attribute to the best match. Among other things, it checks the filename for
+        patterns(such as cover.jpg) and reads the file header to identify common formats.
+        ffmpeg is only used to parse media files that can't be identified by their header.
+        The duration and sample rate of the audio are set as well, if they are known after these steps.
 
         Since this does actually need to physically access the file, it is not called during File
         initialization. This method is especially useful if you are adding a new file and don't know its exact type yet.
+
+        Args:
+            probe_cache (ProbeCache, optional): Cache to look up ffmpeg results in before running ffmpeg,
+                and to store new results in. Defaults to None (no caching).
         """
         if self.path.name.lower() in [name + ext for name in ALBUMART_FILENAMES for ext in ALBUMART_EXTENSIONS]:
             self.type = FileType.ALBUMART
             return
 
+        audio_codecs, info = sniffer.sniff_file(self.path)
+        sniffer.stats.record(audio_codecs is not None)
+        if info:
+            self.duration, self.sample_rate = info
+        if audio_codecs is None:
+            audio_codecs = self._probe_codecs(probe_cache)
+        self.type = self._type_from_codecs(audio_codecs)
+
+    def _probe_codecs(self, probe_cache: ProbeCache = None) -> List[str]:
+        """Get the audio codecs used in the file with ffprobe.
+
+        Args:
+            probe_cache (ProbeCache, optional): Cache for the results of ffprobe. Defaults to None.
+
+        Also sets the duration and sample rate of the file from the result.
+
+        Returns:
+            List[str]: The audio codecs of all streams in the file. Empty if ffprobe can't parse the file.
+        """
+        result = probe_cache.get(self.path) if probe_cache else None
+        if result is None:
+            result = self._probe()
+            if result is None:
+                return []
+            if probe_cache:
+                probe_cache.put(self.path, result)
+        audio_streams = [stream for stream in result["streams"] if stream["codec_type"] == "audio"]
+        # ffprobe reports numbers as strings, and leaves them out if they are unknown
         try:
-            probe = ffmpeg.probe(self.path)
-        except (OSError, ffmpeg.Error) as e:
-            if "Invalid data found when processing input" in str(e.stderr):
+            if result["duration"]:
+                self.duration = float(result["duration"])
+            if audio_streams and audio_streams[0]["sample_rate"]:
+                self.sample_rate = int(audio_streams[0]["sample_rate"])
+        except ValueError:
+            pass
+        return [stream["codec_name"] for stream in audio_streams]
+
+    def _probe(self) -> Union[Dict, None]:
+        """Run ffprobe on the file and summarize the result.
+
+        Returns:
+            Union[Dict, None]: The codec type, codec name, channels and sample rate of each stream,
+                plus the duration and bitrate of the file. Files that ffprobe can't parse have no streams.
+                None if ffprobe could not be run.
+        """
+        try:
+            result = get_runner().run(["ffprobe", "-show_format", "-show_streams", "-of", "json", str(self.path)],
+                                      timeout=PROBE_TIMEOUT)
+            if result.returncode == 0:
+                probe = json.loads(result.stdout.decode(errors="replace"))
+            elif "Invalid data found when processing input" in result.stderr.decode(errors="replace"):
                 # ffmpeg can't handle the file, so its safe to assume that it's something else. Binary, text, whatever
-                self.type = FileType.OTHER
-                return
+                return {"streams": [], "duration": None, "bit_rate": None}
             else:
-                logger.warning(
-                    f"Failure trying to determine type for file {self.path}, falling back to type 'OTHER': {repr(e)}.")
-                self.type = FileType.OTHER
-                return
+                raise OSError(f"ffprobe failed with exit code {result.returncode}: {result.stderr[-1000:]}")
+        except (OSError, ValueError) as e:
+            logger.warning(
+                f"Failure trying to determine type for file {self.path}, falling back to type 'OTHER': {repr(e)}.")
+            return None
+
+        return {
+            "streams": [{key: stream.get(key) for key in ("codec_type", "codec_name", "channels", "sample_rate")}
+                        for stream in probe["streams"]],
+            "duration": probe.get("format", {}).get("duration"),
+            "bit_rate": probe.get("format", {}).get("bit_rate"),
+        }
+
+    def _type_from_codecs(self, audio_codecs: List[str]) -> FileType:
+        """Determine the type of the file from the audio codecs it contains.
+
+        Args:
+            audio_codecs (List[str]): The audio codecs of all streams in the file.
 
+        Returns:
+            FileType: The matching type.
+        """
         # Generate a set of audio codecs used in the file. Regular audio files usually only have a single stream.
-        audio_codecs = list({probe["streams"][i]["codec_name"] for i in range(len(probe["streams"]))
-                            if probe["streams"][i]["codec_type"] == "audio"})
+        audio_codecs = list(set(audio_codecs))
 
         if not audio_codecs:
-            self.type = FileType.OTHER  # Some other non-audio file recognized by FFMPEG
+            return FileType.OTHER  # Some other non-audio file
         elif len(audio_codecs) > 1:
             logger.warning(f"File has multiple audio streams: {self.path}. Cannot encode safely, Will copy instead.")
-            self.type = FileType.OTHER
+            return FileType.OTHER
         elif audio_codecs[0] in LOSSLESS_CODECS:
-            self.type = FileType.LOSSLESS
+            return FileType.LOSSLESS
         elif audio_codecs[0] in LOSSY_CODECS:
-            self.type = FileType.LOSSY
+            return FileType.LOSSY
         else:
-            self.type = FileType.OTHER  # Audio file that we don't recognize. Copy instead
+            return FileType.OTHER  # Audio file that we don't recognize. Copy instead
 
     def __eq__(self, o: object) -> bool:
         if not isinstance(o, File):
@@ -0,0 +1,149 @@
+"""Policies for detecting whether a file in the library has changed since the last scan.
+
+A change detector compares a file found on the filesystem with its entry in the library DB.
+The default policy compares modification times in nanoseconds and file sizes. The checksum policy additionally
+compares a hash of the start and end of the file whenever these change, so that files whose contents are unchanged
+(for example after a `touch` or after copying the library to another share) are not processed again.
+"""
+
+from abc import ABC, abstractmethod
+from enum import Enum
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Union
+
+from .file import File
+
+logger = logging.getLogger(__name__)
+
+# Number of bytes hashed at the start and end of a file
+CHECKSUM_BLOCK_SIZE = 64 * 1024
+
+
+class Change(Enum):
+    """Enum for the result of comparing a file with its DB entry."""
+
+    UNCHANGED = 1
+    """The entry is up to date"""
+
+    METADATA = 2
+    """The contents of the file are unchanged, but its entry needs to be updated (for example with a new mtime)"""
+
+    MODIFIED = 3
+    """The contents of the file have changed and it needs to be processed again"""
+
+
+class ChangeDetector(ABC):
+    """Interface for change detection policies."""
+
+    name = ""
+
+    @abstractmethod
+    def compare(self, file: File, stored: File) -> Change:
+        """Determine whether a file has changed since it was stored in the DB.
+
+        May set fingerprint attributes of file (such as checksum) that were computed during the comparison.
+
+        Args:
+            file (File): The file as found on the filesystem.
+            stored (File): The entry of the file in the DB.
+
+        Returns:
+            Change: The kind of change.
+        """
+
+    def fingerprint(self, file: File) -> None:
+        """Compute the fingerprint attributes used by this policy for a new or modified file.
+
+        Args:
+            file (File): The file to fingerprint.
+        """
+
+
+class MtimeDetector(ChangeDetector):
+    """Detect changes by comparing the modification time in nanoseconds and the size of a file.
+
+    Entries written by older versions only contain the mtime in seconds, which is compared instead.
+    These entries are updated with the full fingerprint on the next scan.
+    """
+
+    name = "mtime"
+
+    def compare(self, file: File, stored: File) -> Change:
+        if stored.mtime_ns is None or stored.size is None:
+            return Change.METADATA if stored.mtime == file.mtime else Change.MODIFIED
+        if stored.mtime_ns == file.mtime_ns and stored.size == file.size:
+            return Change.UNCHANGED
+        return Change.MODIFIED
+
+
+class ChecksumDetector(MtimeDetector):
+    """Detect changes by comparing mtime and size, then confirm them with a partial checksum of the contents.
+
+    Only files whose mtime changed but whose size did not are read. Entries without a checksum get one
+    on the next scan, which requires reading the start and end of every file once.
+    """
+
+    name = "checksum"
+
+    def compare(self, file: File, stored: File) -> Change:
+        change = super().compare(file, stored)
+        if change == Change.UNCHANGED and stored.checksum:
+            return Change.UNCHANGED
+        if change == Change.MODIFIED and (not stored.checksum or file.size != stored.size):
+            return Change.MODIFIED
+
+        self.fingerprint(file)
+        if change == Change.MODIFIED and file.checksum != stored.checksum:
+            return Change.MODIFIED
+        return Change.METADATA
+
+    def fingerprint(self, file: File) -> None:
+        file.checksum = partial_checksum(file.path)
+
+
+def partial_checksum(path: Path) -> Union[str, None]:
+    """Hash the size, the first and the last CHECKSUM_BLOCK_SIZE bytes of a file.
+
+    This is much faster than hashing the whole file, while still catching changes to tags and metadata blocks,
+    which are usually stored at the start or end of a file.
+
+    Args:
+        path (Path): The file to hash.
+
+    Returns:
+        Union[str, None]: The hex digest of the checksum, None if the file could not be read.
+    """
+    checksum = hashlib.blake2b(digest_size=16)
+    try:
+        with path.open("rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            checksum.update(size.to_bytes(8, "little"))
+            checksum.update(f.read(CHECKSUM_BLOCK_SIZE))
+            if size > CHECKSUM_BLOCK_SIZE:
+                f.seek(max(CHECKSUM_BLOCK_SIZE, size - CHECKSUM_BLOCK_SIZE))
+                checksum.update(f.read(CHECKSUM_BLOCK_SIZE))
+    except OSError as e:
+        logger.warning(f"Could not compute checksum of {path}: {repr(e)}")
+        return None
+    return checksum.hexdigest()
+
+
+_DETECTORS = {
+    MtimeDetector.name: MtimeDetector,
+    ChecksumDetector.name: ChecksumDetector,
+}
+
+
+def init(config: Dict) -> ChangeDetector:
+    """Create the change detector selected in the config.
+
+    Args:
+        config (Dict): MusicBirds configuration
+
+    Returns:
+        ChangeDetector: The change detector
+    """
+    return _DETECTORS[config["scan"]["change_detection"]]()
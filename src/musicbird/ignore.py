@@ -0,0 +1,202 @@
+"""Provides gitignore-style rules for excluding files and directories from the library.
+
+Rules use the syntax of .gitignore files:
+
+- Blank lines and lines starting with # are skipped.
+- A pattern without a slash (such as :code:`Thumbs.db` or :code:`*.tmp`) matches names at any depth.
+  A pattern with a slash (such as :code:`Artist/Scratch`) is relative to the root of the library.
+- A pattern ending with a slash (such as :code:`@eaDir/`) only matches directories.
+- :code:`*` matches anything except a slash, :code:`?` matches a single character, :code:`[a-z]` matches
+  a character class. :code:`**` matches any number of directories (such as :code:`**/Samples`).
+- A pattern starting with :code:`!` includes files again that were excluded by an earlier pattern.
+  The last matching pattern wins. Files in excluded directories can't be included again, as excluded directories
+  are not walked at all.
+
+All patterns are compiled into a single regular expression, so that files that aren't matched by any rule
+(nearly all of them) only need a single lookup.
+"""
+
+import logging
+import os
+from pathlib import Path
+import re
+import threading
+from typing import Iterable, List, Union
+
+logger = logging.getLogger(__name__)
+
+
+class IgnoreRule:
+    """A single compiled ignore pattern.
+
+    Attributes:
+        pattern: The pattern as written in the configuration.
+        regex: Regular expression matching the paths covered by the pattern, relative to the root.
+        negate: True if the pattern includes matching paths again.
+        dir_only: True if the pattern only matches directories.
+    """
+
+    def __init__(self, pattern: str) -> None:
+        """Compile an ignore pattern.
+
+        Args:
+            pattern (str): The pattern, in .gitignore syntax.
+
+        Raises:
+            ValueError: If the pattern is invalid.
+        """
+        self.pattern = pattern
+        pattern = pattern.strip()
+        self.negate = pattern.startswith("!")
+        if self.negate:
+            pattern = pattern[1:]
+        self.dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        # Like git, patterns without a slash (except at the end) match at any depth
+        anchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+        if not pattern:
+            raise ValueError(f"Empty pattern {self.pattern}")
+
+        regex = "" if anchored else "(?:.*/)?"
+        segments = pattern.split("/")
+        for index, segment in enumerate(segments):
+            last = index == len(segments) - 1
+            if segment == "**":
+                regex += ".+" if last else "(?:.*/)?"
+            else:
+                regex += _translate_segment(segment) + ("" if last else "/")
+        try:
+            self.regex = re.compile(regex)
+        except re.error as e:
+            raise ValueError(f"Invalid pattern {self.pattern}: {e}")
+
+
+class IgnoreRules:
+    """A compiled list of ignore rules for a directory tree.
+
+    Matching is thread-safe, so that the rules can be shared by all threads of a walk.
+
+    Attributes:
+        root: The directory that anchored patterns are relative to.
+        rules: The compiled rules, in order of their definition.
+        hits: Number of files and directories matched by each rule, in the same order as rules.
+    """
+
+    def __init__(self, root: Path, patterns: Iterable[str]) -> None:
+        """Compile a list of patterns.
+
+        Args:
+            root (Path): The root directory of the tree.
+            patterns (Iterable[str]): The patterns, in .gitignore syntax. Blank lines and comments are skipped.
+        """
+        self.root = root
+        self.rules: List[IgnoreRule] = []
+        for pattern in patterns:
+            if not pattern.strip() or pattern.strip().startswith("#"):
+                continue
+            try:
+                self.rules.append(IgnoreRule(pattern))
+            except ValueError as e:
+                logger.warning(f"Skipping ignore rule: {e}")
+        self.hits = [0] * len(self.rules)
+        self._lock = threading.Lock()
+        # Length of the root path including the trailing separator, to cut it from full paths
+        self._prefix = len(str(root).rstrip(os.sep)) + 1
+        self._combined = None
+        if self.rules:
+            self._combined = re.compile("|".join(f"(?:{rule.regex.pattern})" for rule in self.rules))
+
+    def match(self, path: Union[Path, str], is_dir: bool) -> bool:
+        """Check whether a path is excluded by the rules.
+
+        Only the path itself is checked, not its parent directories (see is_ignored()).
+
+        Args:
+            path (Union[Path, str]): The path to check. Must be below the root directory.
+            is_dir (bool): Whether the path is a directory.
+
+        Returns:
+            bool: True if the path is excluded, False if not.
+        """
+        if self._combined is None:
+            return False
+        relative = str(path)[self._prefix:]
+        if os.sep != "/":
+            relative = relative.replace(os.sep, "/")
+        # Most paths aren't matched by any rule, so check them all at once first
+        if not self._combined.fullmatch(relative):
+            return False
+        for index in range(len(self.rules) - 1, -1, -1):
+            rule = self.rules[index]
+            if rule.dir_only and not is_dir:
+                continue
+            if rule.regex.fullmatch(relative):
+                with self._lock:
+                    self.hits[index] += 1
+                return not rule.negate
+        return False
+
+    def is_ignored(self, path: Path) -> bool:
+        """Check whether a path or any of the directories containing it are excluded by the rules.
+
+        Args:
+            path (Path): The path to check. Paths outside of the root directory are never excluded.
+
+        Returns:
+            bool: True if the path is excluded, False if not.
+        """
+        if self._combined is None or self.root not in path.parents:
+            return False
+        for parent in reversed(path.parents):
+            if parent != self.root and self.root in parent.parents and self.match(parent, True):
+                return True
+        return self.match(path, path.is_dir())
+
+    def reset(self) -> None:
+        """Reset all hit counters to zero."""
+        with self._lock:
+            self.hits = [0] * len(self.rules)
+
+    def report(self) -> str:
+        """Summarize the hit counters in a human-readable form.
+
+        Returns:
+            str: The number of paths matched by each rule that matched at least one path.
+        """
+        matched = [f"'{rule.pattern}': {hits}" for rule, hits in zip(self.rules, self.hits) if hits]
+        return ", ".join(matched) if matched else "no paths matched"
+
+
+def _translate_segment(segment: str) -> str:
+    """Translate a single path segment of a pattern to a regular expression.
+
+    Unlike fnmatch.translate(), wildcards never match a slash.
+    """
+    regex = ""
+    index = 0
+    while index < len(segment):
+        char = segment[index]
+        index += 1
+        if char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "\\" and index < len(segment):
+            regex += re.escape(segment[index])
+            index += 1
+        elif char == "[":
+            start = index + 1 if segment[index:index + 1] in ("!", "^") else index
+            # A closing bracket right at the start is part of the class
+            end = segment.find("]", start + 1 if segment[start:start + 1] == "]" else start)
+            if end < 0:
+                regex += re.escape(char)
+                continue
+            chars = segment[index:end]
+            if chars[0] in ("!", "^"):
+                chars = "^" + chars[1:]
+            regex += "[" + chars.replace("\\", "\\\\") + "]"
+            index = end + 1
+        else:
+            regex += re.escape(char)
+    return regex
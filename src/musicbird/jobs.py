@@ -0,0 +1,347 @@
+"""Provides a job runner for the external programs used by MusicBird, such as ffmpeg, opusenc and ffprobe.
+
+All jobs run as asyncio subprocesses on a single event loop in a background thread. The number of jobs running
+at the same time is limited by one budget shared by all callers, so that probes started by a scan and encodes
+started by the processing steps never oversubscribe the machine together.
+
+Jobs can be limited in their total runtime, and be watched by a Watchdog that kills them once they stop making
+progress. This keeps a process that hangs (for example on a truncated file) from taking up a slot of the budget forever.
+
+The runner can be used from any thread: run() blocks the calling thread until the job has finished,
+while the event loop reads the output of all jobs concurrently. Running jobs can be cancelled at any time,
+which kills their processes right away instead of waiting for them to finish.
+"""
+
+import asyncio
+import concurrent.futures
+from contextlib import contextmanager
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Iterator, List, NamedTuple, Set, Union
+
+logger = logging.getLogger(__name__)
+
+# Maximum amount of stderr output kept per job. Only the end of the output is kept, as that is where errors are
+_STDERR_LIMIT = 64 * 1024
+_READ_SIZE = 4096
+# Time between two checks of the watchdog of a job, in seconds
+_WATCHDOG_INTERVAL = 1.0
+
+
+class JobResult(NamedTuple):
+    """The result of a finished job.
+
+    Attributes:
+        returncode: The exit code of the process. Negative if it was killed by a signal.
+        stdout: Everything the process wrote to stdout.
+        stderr: The end of what the process wrote to stderr.
+        timed_out: True if the process was killed because it exceeded its timeout.
+        stalled: True if the process was killed by its watchdog because it stopped making progress.
+    """
+    returncode: int
+    stdout: bytes
+    stderr: bytes
+    timed_out: bool
+    stalled: bool = False
+
+
+class JobLimits(NamedTuple):
+    """Limits on the runtime of a job, after which it is killed.
+
+    Attributes:
+        timeout: Maximum runtime in seconds. None for no limit.
+        stall_timeout: Maximum time without progress in seconds, see Watchdog. None for no limit.
+    """
+    timeout: Union[float, None] = None
+    stall_timeout: Union[float, None] = None
+
+
+class JobCancelledError(Exception):
+    """Raised by JobRunner.run() if the job was cancelled with cancel_all()."""
+
+
+class Watchdog:
+    """Detects jobs that have stopped making progress.
+
+    Progress is a number that grows while the job is working, such as the position in the audio that an encoder has
+    reached or the size of its output file. It is either reported with update() (usually from an on_stderr callback),
+    or read by a poll function every time the watchdog is checked. The job is considered stalled once its progress
+    hasn't grown for stall_timeout seconds.
+
+    Attributes:
+        stall_timeout: Time without progress after which the job is stalled, in seconds.
+        progress: The highest progress reported so far.
+        last_progress: Time the progress last grew, as returned by time.monotonic().
+    """
+
+    def __init__(self, stall_timeout: float, poll: Callable[[], float] = None) -> None:
+        """Create a new watchdog.
+
+        Args:
+            stall_timeout (float): Time without progress after which the job is stalled, in seconds.
+            poll (Callable[[], float], optional): Called to read the progress every time the watchdog is checked.
+                OSErrors raised by it are ignored. Defaults to None.
+        """
+        self.stall_timeout = stall_timeout
+        self.progress = 0.0
+        self.last_progress = time.monotonic()
+        self._poll = poll
+
+    def start(self) -> None:
+        """Start the timer, once the job has started."""
+        self.last_progress = time.monotonic()
+
+    def update(self, progress: float) -> None:
+        """Report the progress of the job.
+
+        Args:
+            progress (float): The current progress. Only counts if it is higher than before.
+        """
+        if progress > self.progress:
+            self.progress = progress
+            self.last_progress = time.monotonic()
+
+    def stalled(self) -> bool:
+        """Check whether the job has stalled, polling its progress first.
+
+        Returns:
+            bool: True if the progress hasn't grown for stall_timeout seconds.
+        """
+        if self._poll:
+            try:
+                self.update(self._poll())
+            except OSError:
+                pass
+        return time.monotonic() - self.last_progress > self.stall_timeout
+
+
+class JobRunner:
+    """Run external programs as asyncio subprocesses, limited by a shared concurrency budget.
+
+    Attributes:
+        max_jobs: Maximum number of jobs running at the same time.
+        running: Number of jobs currently running.
+    """
+
+    def __init__(self, max_jobs: int) -> None:
+        """Create a new runner and start its event loop.
+
+        Must be called from the main thread on Python versions before 3.8, where subprocesses can only be
+        watched by a loop that was set up in the main thread.
+
+        Args:
+            max_jobs (int): Maximum number of jobs running at the same time.
+        """
+        self.max_jobs = max_jobs
+        self.running = 0
+        self._cancelled = False
+        self._lock = threading.Lock()
+        self._pending: Set[concurrent.futures.Future] = set()
+        self._loop = asyncio.new_event_loop()
+        if sys.version_info < (3, 8) and os.name == "posix":
+            asyncio.get_child_watcher().attach_loop(self._loop)
+        self._thread = threading.Thread(target=self._loop.run_forever, name="JobRunner", daemon=True)
+        self._thread.start()
+        self._slots: asyncio.Semaphore = asyncio.run_coroutine_threadsafe(self._create_slots(), self._loop).result()
+
+    def run(self, args: List[str], timeout: float = None, on_stderr: Callable[[str], None] = None,
+            watchdog: Watchdog = None) -> JobResult:
+        """Run a program and wait for it to finish. Thread-safe.
+
+        Args:
+            args (List[str]): The program and its arguments.
+            timeout (float, optional): Kill the process if it runs longer than this many seconds. Defaults to None.
+            on_stderr (Callable[[str], None], optional): Called with every line the process writes to stderr,
+                as soon as it is written. Runs on the event loop, so it must not block. Defaults to None.
+            watchdog (Watchdog, optional): Kill the process once this watchdog considers it stalled.
+                It is checked on the event loop, once per second. Defaults to None.
+
+        Returns:
+            JobResult: The result of the job.
+
+        Raises:
+            OSError: If the program could not be started.
+            JobCancelledError: If the job was cancelled.
+        """
+        with self._lock:
+            if self._cancelled:
+                raise JobCancelledError(args[0])
+            future = asyncio.run_coroutine_threadsafe(self.run_async(args, timeout, on_stderr, watchdog), self._loop)
+            self._pending.add(future)
+        try:
+            return future.result()
+        except concurrent.futures.CancelledError:
+            raise JobCancelledError(args[0])
+        finally:
+            with self._lock:
+                self._pending.discard(future)
+
+    async def run_async(self, args: List[str], timeout: float = None, on_stderr: Callable[[str], None] = None,
+                        watchdog: Watchdog = None) -> JobResult:
+        """Run a program on the event loop of the runner. See run() for details."""
+        async with self._slots:
+            process = await asyncio.create_subprocess_exec(
+                *args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self.running += 1
+            stdout = bytearray()
+            stderr = bytearray()
+            stalled = []
+            try:
+                communicate = self._communicate(process, stdout, stderr, on_stderr)
+                if watchdog:
+                    communicate = self._watch(args[0], process, communicate, watchdog, stalled)
+                await asyncio.wait_for(communicate, timeout)
+                timed_out = False
+            except asyncio.TimeoutError:
+                logger.warning(f"{args[0]} did not finish within {timeout} seconds, killing it")
+                await self._kill(process)
+                timed_out = True
+            except asyncio.CancelledError:
+                await self._kill(process)
+                raise
+            finally:
+                self.running -= 1
+        return JobResult(process.returncode, bytes(stdout), bytes(stderr), timed_out, bool(stalled))
+
+    def cancel_all(self) -> None:
+        """Kill all running jobs and cancel all waiting ones. Thread-safe.
+
+        Calls to run() that are waiting for their job raise JobCancelledError. So do all further calls,
+        until reset() is called.
+        """
+        with self._lock:
+            self._cancelled = True
+            pending = list(self._pending)
+        if pending:
+            logger.info(f"Cancelling {len(pending)} jobs")
+        for future in pending:
+            future.cancel()
+
+    def reset(self) -> None:
+        """Accept new jobs again after cancel_all()."""
+        with self._lock:
+            self._cancelled = False
+
+    def close(self) -> None:
+        """Cancel all jobs and stop the event loop of the runner."""
+        self.cancel_all()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    @contextmanager
+    def cancel_on_interrupt(self) -> Iterator[None]:
+        """Cancel all jobs if a KeyboardInterrupt (SIGINT) occurs within the context.
+
+        Worker threads waiting for their jobs then return right away, so the interrupt isn't held up by
+        executors waiting for their workers to finish.
+        """
+        try:
+            yield
+        except KeyboardInterrupt:
+            self.cancel_all()
+            raise
+
+    async def _create_slots(self) -> asyncio.Semaphore:
+        # Older Python versions bind the semaphore to the event loop that is current when it is created
+        return asyncio.Semaphore(self.max_jobs)
+
+    @staticmethod
+    async def _communicate(process: asyncio.subprocess.Process, stdout: bytearray, stderr: bytearray,
+                           on_stderr: Union[Callable[[str], None], None]) -> None:
+        """Read the output of a process until it exits."""
+        async def read_stdout() -> None:
+            while True:
+                data = await process.stdout.read(_READ_SIZE)
+                if not data:
+                    return
+                stdout.extend(data)
+
+        async def read_stderr() -> None:
+            line = bytearray()
+            while True:
+                data = await process.stderr.read(_READ_SIZE)
+                if not data:
+                    break
+                stderr.extend(data)
+                del stderr[:-_STDERR_LIMIT]
+                if on_stderr:
+                    # Progress output is often terminated by carriage returns only
+                    line.extend(data.replace(b"\r", b"\n"))
+                    *lines, rest = line.split(b"\n")
+                    line = bytearray(rest)
+                    for complete in lines:
+                        if complete:
+                            on_stderr(complete.decode(errors="replace"))
+            if on_stderr and line:
+                on_stderr(line.decode(errors="replace"))
+
+        await asyncio.gather(read_stdout(), read_stderr())
+        await process.wait()
+
+    @staticmethod
+    async def _watch(name: str, process: asyncio.subprocess.Process, communicate: Awaitable[None],
+                     watchdog: Watchdog, stalled: List[bool]) -> None:
+        """Run communicate, killing the process once the watchdog considers it stalled.
+
+        Appends to stalled if the process was killed.
+        """
+        task = asyncio.ensure_future(communicate)
+        watchdog.start()
+        try:
+            while not task.done():
+                await asyncio.wait([task], timeout=_WATCHDOG_INTERVAL)
+                if not task.done() and not stalled and watchdog.stalled():
+                    logger.warning(f"{name} made no progress for {watchdog.stall_timeout} seconds, killing it")
+                    stalled.append(True)
+                    await JobRunner._kill(process)
+            await task
+        finally:
+            task.cancel()
+
+    @staticmethod
+    async def _kill(process: asyncio.subprocess.Process) -> None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+
+_runner: Union[JobRunner, None] = None
+_runner_lock = threading.Lock()
+
+
+def init(config: Dict) -> JobRunner:
+    """Get the job runner shared by all components in this process, creating it if needed.
+
+    The runner is created with a budget of config["threads"] jobs by the first caller.
+    Later calls return the same runner, so that all jobs share the same budget.
+
+    Args:
+        config (Dict): MusicBirds configuration
+
+    Returns:
+        JobRunner: The shared job runner.
+    """
+    return get_runner(config["threads"])
+
+
+def get_runner(max_jobs: int = None) -> JobRunner:
+    """Get the job runner shared by all components in this process, creating it if needed.
+
+    Args:
+        max_jobs (int, optional): Budget of the runner if it is created by this call. Defaults to the number of CPUs.
+
+    Returns:
+        JobRunner: The shared job runner.
+    """
+    global _runner  # pylint: disable=global-statement
+    with _runner_lock:
+        if _runner is None:
+            _runner = JobRunner(max_jobs or os.cpu_count() or 1)
+        return _runner
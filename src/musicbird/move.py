@@ -0,0 +1,124 @@
+"""Provides the move processing step and related functions.
+"""
+
+import argparse
+import os
+import logging
+from pathlib import Path
+from typing import Dict, List
+
+from .config import resolve_source_paths
+from .db import BATCH_SIZE, LibraryDB, init as init_db
+from .file import STAGES_BY_TYPE, File, Stage
+
+logger = logging.getLogger(__name__)
+
+
+def move_command(parent_parser: argparse.ArgumentParser, args: List[str], config: Dict) -> bool:
+    """Entrypoint for the CLI `move` command.
+
+    Args:
+        parent_parser (argparse.ArgumentParser): The parser from the main entrypoint.
+            Used to display a full --help output by inheriting its arguments.
+        args (List[str]): List of arguments not parsed by the main parser.
+        config (Dict): Dictionary containing the MusicBird configuration
+    """
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description=__doc__, prog="musicbird", parents=[parent_parser])
+    parser.add_argument("--pretend", action="store_true",
+                        help="Show what files would be moved, but don't perform the actual move")
+    parser.add_argument("--path", action="append", dest="paths", metavar="PATH",
+                        help=("Only process files in this file or directory, relative to the source library. "
+                              "Can be passed multiple times"))
+    args = parser.parse_args(args)
+    db = init_db(config, pretend=args.pretend)
+    return move(config, db, args.pretend, resolve_source_paths(config, args.paths))
+
+
+def move(config: Dict, db: LibraryDB, pretend=False, paths: List[Path] = None) -> bool:
+    """Move the outputs of all files that were moved in the source library.
+
+    Renames the existing output of every file queued for the move stage to match the new path of the file.
+    If there is no output at the previous location, the file is queued to be processed again instead.
+
+    Args:
+        config (Dict): Dictionary containing the musicbird configuration.
+        db (LibraryDB): Database object to read/write the library status from/to.
+        pretend (bool, optional): Pretend to move, but don't perform any filesystem operations. Defaults to False.
+        paths (List[Path], optional): Only process files at or below these paths, see
+            config.resolve_source_paths(). Defaults to None (the entire library).
+
+    Returns:
+        bool: True if all files were processed successfully, false if not.
+    """
+    logger.info(f"Need to move {db.count_queued_files(Stage.MOVE, paths)} files")
+
+    successes: List[File] = []
+    failures: List[File] = []
+    # Moved files are updated in the DB in batches
+    moved: List[File] = []
+    reprocess: List[File] = []
+    for file in db.iter_queued_files(Stage.MOVE, paths):
+        old_dest = File(file.moved_from, file.type, file.mtime).get_dest_path(config)
+        dest = file.get_dest_path(config)
+        if pretend:
+            logger.info(f"Would move file: {old_dest} -> {dest}")
+            successes.append(file)
+            continue
+        try:
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(old_dest, dest)
+        except FileNotFoundError:
+            logger.info(f"No previous output found at {old_dest}, {file.path} will be processed again")
+            reprocess.append(file)
+        except OSError as e:
+            logger.error(f"Could not move file {old_dest} to {dest}: {repr(e)}")
+            failures.append(file)
+            continue
+        else:
+            logger.info(f"Moved file: {old_dest} -> {dest}")
+            moved.append(file)
+            _remove_empty_dirs(old_dest)
+        file.moved_from = None
+        successes.append(file)
+        if len(moved) + len(reprocess) >= BATCH_SIZE:
+            _complete(db, moved, reprocess)
+            moved = []
+            reprocess = []
+    _complete(db, moved, reprocess)
+
+    logger.info(f"Successfully moved {len(successes)} files")
+    if failures:
+        logger.error(f"Failed to move {len(failures)} files. See above for errors")
+        failures_str = "\n".join([str(f.path) for f in failures])
+        logger.debug(f"Failed files: {failures_str}")
+        return False
+    else:
+        return True
+
+
+def _complete(db: LibraryDB, moved: List[File], reprocess: List[File]) -> None:
+    """Update the DB entries of processed files and remove them from the move queue.
+
+    Files whose previous output could not be found are queued for all stages of their type again.
+    """
+    with db.transaction():
+        for file in reprocess:
+            file.needs_processing = True
+        db.add_or_update_files(moved + reprocess)
+        for file in reprocess:
+            db.set_queued_stages([file], STAGES_BY_TYPE[file.type])
+        db.complete_queued_files((Stage.MOVE, file) for file in moved)
+
+
+def _remove_empty_dirs(dest: Path) -> None:
+    """Remove the directories left empty after moving a file out of them.
+
+    The directories may be removed concurrently, for example by a prune or by the move of a sibling file,
+    so failing to list or remove them is not an error.
+    """
+    try:
+        if not os.listdir(dest.parent):
+            os.removedirs(dest.parent)
+    except OSError as e:
+        logger.debug(f"Could not remove empty directory {dest.parent}: {repr(e)}")
@@ -0,0 +1,167 @@
+"""Provides a persistent cache for the results of ffprobe.
+
+Probing a file with ffprobe is by far the most expensive part of determining its type. The results only depend
+on the contents of the file, so this module stores them in a separate database that survives resets of the library DB
+(such as `run --rescan` or a new destination).
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+import sqlite3
+import threading
+from typing import Dict, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+PROBE_CACHE_FILENAME = "probe_cache.sqlite3"
+
+
+class ProbeCache:
+    """Cache of ffprobe results, keyed by the identity of a file on disk.
+
+    Files are identified by their device, inode, size and modification time in nanoseconds.
+    Rewriting a file changes at least one of these, which invalidates its entry, while renaming or moving a file
+    within the same filesystem keeps it.
+
+    The cache holds up to max_entries results. Once full, the least recently used entries are evicted.
+    The cache is safe to use from multiple threads.
+    """
+
+    _SCHEMA = ("dev INT NOT NULL, inode INT NOT NULL, size INT NOT NULL, mtime_ns INT NOT NULL, "
+               "result TEXT NOT NULL, last_used INT NOT NULL, PRIMARY KEY (dev, inode, size, mtime_ns)")
+
+    # Fraction of max_entries that is evicted at once when the cache is full, so that eviction doesn't run on every put
+    _EVICT_FRACTION = 0.05
+
+    def __init__(self, path: Path, max_entries: int, readonly: bool = False) -> None:
+        """Open or create the cache.
+
+        Args:
+            path (Path): Location of the cache database.
+            max_entries (int): Maximum number of cached results.
+            readonly (bool, optional): Only read from the cache, for pretend mode. Defaults to False.
+
+        Raises:
+            sqlite3.Error: If the cache could not be opened.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.readonly = readonly
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if readonly:
+            # as_uri() escapes characters with a special meaning in URIs, such as "?", "#" and "%"
+            self._con = sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Autocommit, as every write is a single statement
+            self._con = sqlite3.connect(str(path), isolation_level=None, check_same_thread=False)
+            self._con.execute("PRAGMA journal_mode=wal")
+            self._con.execute("PRAGMA synchronous=normal")
+            self._con.execute(f"CREATE TABLE IF NOT EXISTS Probes ({ProbeCache._SCHEMA})")
+            self._con.execute("CREATE INDEX IF NOT EXISTS Probes_last_used ON Probes(last_used)")
+        # Number of entries and the last value of the counter used to track when entries were last used
+        self._count, self._clock = self._con.execute(
+            "SELECT COUNT(*), COALESCE(MAX(last_used), 0) FROM Probes").fetchone()
+
+    def get(self, path: Path) -> Union[Dict, None]:
+        """Look up the cached probe result of a file.
+
+        Args:
+            path (Path): The file to look up.
+
+        Returns:
+            Union[Dict, None]: The cached result, None if there is none.
+        """
+        key = _file_key(path)
+        if key is None:
+            return None
+        with self._lock:
+            try:
+                row = self._con.execute(
+                    "SELECT rowid, result FROM Probes WHERE dev=? AND inode=? AND size=? AND mtime_ns=?", key
+                ).fetchone()
+                if not row:
+                    self.misses += 1
+                    return None
+                self.hits += 1
+                if not self.readonly:
+                    self._clock += 1
+                    self._con.execute("UPDATE Probes SET last_used=? WHERE rowid=?", (self._clock, row[0]))
+                return json.loads(row[1])
+            except (sqlite3.Error, ValueError) as e:
+                logger.debug(f"Could not read probe cache entry for {path}: {repr(e)}")
+                return None
+
+    def put(self, path: Path, result: Dict) -> None:
+        """Store the probe result of a file.
+
+        The cache only serves to speed things up, so failing to write it is not an error.
+
+        Args:
+            path (Path): The probed file.
+            result (Dict): The probe result. Must be JSON-serializable.
+        """
+        key = _file_key(path)
+        if self.readonly or key is None:
+            return
+        with self._lock:
+            try:
+                self._clock += 1
+                if self._con.execute("INSERT OR IGNORE INTO Probes VALUES (?,?,?,?,?,?)",
+                                     key + (json.dumps(result), self._clock)).rowcount:
+                    self._count += 1
+                if self._count > self.max_entries:
+                    self._evict(self._count - self.max_entries + int(self.max_entries * ProbeCache._EVICT_FRACTION))
+            except sqlite3.Error as e:
+                logger.debug(f"Could not save probe cache entry for {path}: {repr(e)}")
+
+    def close(self) -> None:
+        """Close the connection to the cache database."""
+        with self._lock:
+            self._con.close()
+
+    def _evict(self, count: int) -> None:
+        """Remove the least recently used entries from the cache."""
+        logger.debug(f"Evicting {count} entries from probe cache")
+        self._con.execute(
+            "DELETE FROM Probes WHERE rowid IN (SELECT rowid FROM Probes ORDER BY last_used LIMIT ?)", (count,))
+        self._count = self._con.execute("SELECT COUNT(*) FROM Probes").fetchone()[0]
+
+
+def _file_key(path: Path) -> Union[Tuple[int, int, int, int], None]:
+    """Get the key identifying a file in the cache, None if the file can't be accessed."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def init(config: Dict, pretend: bool = False) -> Union[ProbeCache, None]:
+    """Open the probe cache based on the values provided in the config.
+
+    The cache is stored next to the SQLite database.
+
+    Args:
+        config (Dict): MusicBirds configuration
+        pretend (bool, optional): Only read from the cache, without storing new results. Defaults to False.
+
+    Returns:
+        Union[ProbeCache, None]: The cache, None if it is disabled or could not be opened.
+    """
+    max_entries = config["scan"]["probe_cache_size"]
+    if not max_entries:
+        return None
+    path = Path(config["sqlite3"]["path"]).with_name(PROBE_CACHE_FILENAME)
+    if pretend and not path.exists():
+        return None
+    try:
+        return ProbeCache(path, max_entries, readonly=pretend)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"Could not open probe cache at {path}, continuing without it: {repr(e)}")
+        return None
@@ -4,10 +4,12 @@
 import argparse
 import os
 import logging
+from pathlib import Path
 from typing import Dict, List
 
-from .db import LibraryDB, init as init_db
-from .file import File
+from .config import resolve_source_paths
+from .db import BATCH_SIZE, LibraryDB, init as init_db
+from .file import File, Stage
 
 logger = logging.getLogger(__name__)
 
@@ -25,49 +27,58 @@ def prune_command(parent_parser: argparse.ArgumentParser, args: List[str], confi
                                      description=__doc__, prog="musicbird", parents=[parent_parser])
     parser.add_argument("--pretend", action="store_true",
                         help="Show what files would be pruned, but don't perform the actual deletion")
+    parser.add_argument("--path", action="append", dest="paths", metavar="PATH",
+                        help=("Only process files in this file or directory, relative to the source library. "
+                              "Can be passed multiple times"))
     args = parser.parse_args(args)
     db = init_db(config, pretend=args.pretend)
-    return prune(config, db, args.pretend)
+    return prune(config, db, args.pretend, resolve_source_paths(config, args.paths))
 
 
-def prune(config: Dict, db: LibraryDB, pretend=False) -> bool:
+def prune(config: Dict, db: LibraryDB, pretend=False, paths: List[Path] = None) -> bool:
     """Process and delete all files marked for deletion in the mirror library.
 
-    Attempts to delete all files that are marked as deleted in the mirror library,
-    then marks them as processed.
+    Attempts to delete all files queued for the prune stage from the mirror library,
+    then removes them from the library DB.
 
     Args:
         config (Dict): Dictionary containing the musicbird configuration.
         db (LibraryDB): Database object to read/write the library status from/to.
         pretend (bool, optional): Pretend to delete, but don't perform any filesystem operations. Defaults to False.
+        paths (List[Path], optional): Only process files at or below these paths, see
+            config.resolve_source_paths(). Defaults to None (the entire library).
 
     Returns:
         bool: True if all files were processed successfully, false if not.
     """
-    to_prune = db.get_deleted_files()
-    logger.info(f"Need to delete {len(to_prune)} files")
+    logger.info(f"Need to delete {db.count_queued_files(Stage.PRUNE, paths)} files")
 
     successes: List[File] = []
     failures: List[File] = []
-    for file in to_prune:
+    # Pruned files are removed from the DB in batches
+    pruned: List[File] = []
+    for file in db.iter_queued_files(Stage.PRUNE, paths):
         dest = file.get_dest_path(config)
         if not pretend:
             try:
                 dest.unlink()
             except FileNotFoundError:
-                db.remove_file(file)
+                pruned.append(file)
                 successes.append(file)
                 logger.info(f"Removed file: {dest}")
             except OSError as e:
                 logger.error(f"Could not remove file {dest}: {repr(e)}")
                 failures.append(file)
             else:
-                db.remove_file(file)
+                pruned.append(file)
                 successes.append(file)
                 logger.info(f"Removed file: {dest}")
         else:
             successes.append(file)
-            db.remove_file(file)
+            pruned.append(file)
+        if len(pruned) >= BATCH_SIZE:
+            db.remove_files(pruned)
+            pruned = []
 
         if not os.listdir(dest.parent):
             # Remove empty leftover directories
@@ -77,6 +88,7 @@ def prune(config: Dict, db: LibraryDB, pretend=False) -> bool:
                 pass
             except OSError as e:
                 logger.warning(f"Could not remove empty directory {dest.parent}: {repr(e)}")
+    db.remove_files(pruned)
 
     logger.info(f"Successfully pruned {len(successes)} files")
     if failures:
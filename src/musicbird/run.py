@@ -3,10 +3,13 @@
 
 import argparse
 import logging
+from pathlib import Path
 from typing import Dict, List
 
+from .config import resolve_source_paths
 from .db import init as init_db
-from .scan import scan
+from .scan import read_change_list, scan
+from .move import move
 from .copy import copy
 from .encode import encode
 from .prune import prune
@@ -29,19 +32,35 @@ def run_command(parent_parser: argparse.ArgumentParser, args: List[str], config:
                         help="Force a rescan of the entire library. This will force all files to be reprocessed")
     parser.add_argument("--pretend", action="store_true",
                         help="Show what changes would be made but don't modify any files")
+    parser.add_argument("--trust-dirs", action="store_true",
+                        help=("Assume that files in directories whose modification time hasn't changed are unchanged. "
+                              "Much faster, but misses files that were modified in place (e.g. by retagging them)"))
+    paths = parser.add_mutually_exclusive_group()
+    paths.add_argument("--path", action="append", dest="paths", metavar="PATH",
+                       help=("Only scan and process files in this file or directory, relative to the source library. "
+                             "Can be passed multiple times"))
+    paths.add_argument("--from-list", type=argparse.FileType("rb"), metavar="FILE",
+                       help=("Only scan and process the paths listed in this file (- for stdin), separated by newlines "
+                             "or NUL characters. The output of rsync --itemize-changes is accepted as well"))
     args = parser.parse_args(args)
-    return run(config, args.rescan, args.pretend)
+    if args.from_list:
+        with args.from_list:
+            args.paths = read_change_list(args.from_list)
+    return run(config, args.rescan, args.pretend, args.trust_dirs, resolve_source_paths(config, args.paths))
 
 
-def run(config: Dict, rescan: bool = False, pretend: bool = False):
+def run(config: Dict, rescan: bool = False, pretend: bool = False, trust_dirs: bool = False,
+        paths: List[Path] = None):
     """Scan, then process the entire music library.
 
-    Equivalent to calling scan(), copy(), encode(), prune() in that order.
+    Equivalent to calling scan(), move(), copy(), encode(), prune() in that order.
 
     Args:
         config (Dict): Dictionary containing the musicbird configuration.
         db (LibraryDB): Database object to read/write the library status from/to.
         pretend (bool, optional): Pretend to process/scan, but don't perform any actual operations. Defaults to False.
+        trust_dirs (bool, optional): Skip checking files in unchanged directories while scanning. Defaults to False.
+        paths (List[Path], optional): Only scan and process files at or below these paths. Defaults to None.
 
     Returns:
         bool: True if all files were processed successfully, false if not.
@@ -49,10 +68,11 @@ def run(config: Dict, rescan: bool = False, pretend: bool = False):
     db = init_db(config, delete=rescan, pretend=pretend)
 
     results = []
-    results.append(scan(config, db))
-    results.append(copy(config, db, pretend=pretend))
-    results.append(encode(config, db, pretend=pretend))
-    results.append(prune(config, db, pretend=pretend))
+    results.append(scan(config, db, pretend=pretend, trust_dirs=trust_dirs, paths=paths))
+    results.append(move(config, db, pretend=pretend, paths=paths))
+    results.append(copy(config, db, pretend=pretend, paths=paths))
+    results.append(encode(config, db, pretend=pretend, paths=paths))
+    results.append(prune(config, db, pretend=pretend, paths=paths))
     if False in results:
         return False
     else:
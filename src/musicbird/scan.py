@@ -3,13 +3,24 @@
 
 import argparse
 import logging
-from typing import Dict, List
+import os
+from pathlib import Path
+import re
+from typing import BinaryIO, Dict, List
 
+from .config import resolve_source_paths
 from .db import LibraryDB, init as init_db
+from .fingerprint import init as init_detector
+from .jobs import init as init_jobs
+from .probecache import init as init_probe_cache
 from .scanner import LibraryScanner
 
 logger = logging.getLogger(__name__)
 
+# Output of rsync --itemize-changes: an update code such as ">f+++++++++" followed by the path
+_ITEMIZED_ENTRY = re.compile(r"[<>ch.][fdLDS][^ ]{7,9} (.+)")
+_DELETED_ENTRY = re.compile(r"\*deleting +(.+)")
+
 
 def scan_command(parent_parser: argparse.ArgumentParser, args: List[str], config: Dict) -> bool:
     """Entrypoint for the CLI `scan` command.
@@ -23,11 +34,25 @@ def scan_command(parent_parser: argparse.ArgumentParser, args: List[str], config
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                                      description=__doc__, prog="musicbird", parents=[parent_parser])
     parser.add_argument("--pretend", action="store_true", help="Show scan results but don't store them")
+    parser.add_argument("--trust-dirs", action="store_true",
+                        help=("Assume that files in directories whose modification time hasn't changed are unchanged. "
+                              "Much faster, but misses files that were modified in place (e.g. by retagging them)"))
+    paths = parser.add_mutually_exclusive_group()
+    paths.add_argument("--path", action="append", dest="paths", metavar="PATH",
+                       help=("Only scan this file or directory, relative to the source library. "
+                             "Can be passed multiple times"))
+    paths.add_argument("--from-list", type=argparse.FileType("rb"), metavar="FILE",
+                       help=("Only scan the paths listed in this file (- for stdin), separated by newlines or NUL "
+                             "characters. The output of rsync --itemize-changes is accepted as well"))
     args = parser.parse_args(args)
-    return scan(config, init_db(config, pretend=args.pretend))
+    if args.from_list:
+        with args.from_list:
+            args.paths = read_change_list(args.from_list)
+    return scan(config, init_db(config, pretend=args.pretend), args.pretend, args.trust_dirs,
+                resolve_source_paths(config, args.paths))
 
 
-def scan(config: Dict, db: LibraryDB) -> bool:
+def scan(config: Dict, db: LibraryDB, pretend=False, trust_dirs=False, paths: List[Path] = None) -> bool:
     """Scan the source library for changed files and write them to the DB.
 
     Performs a filesystem scan on the source music library, registering any new, changed or deleted files along the way.
@@ -37,15 +62,69 @@ def scan(config: Dict, db: LibraryDB) -> bool:
         config (Dict): Dictionary containing the musicbird configuration.
         db (LibraryDB): Database object to read/write the library status from/to.
         pretend (bool, optional): Pretend to scan, but don't modify the DB. Defaults to False.
+        trust_dirs (bool, optional): Skip checking files in unchanged directories. Defaults to False.
+        paths (List[Path], optional): Only scan these files and directories. Files outside of them are left untouched
+            and are not marked as deleted. Defaults to None (the entire library).
 
     Returns:
         bool: True if the scan was successful, False if not.
     """
-    scanner = LibraryScanner(config["source"], db)
-    logger.info("Scanning library...")
-    result = scanner.scan()
+    probe_cache = init_probe_cache(config, pretend)
+    scanner = LibraryScanner(config["source"], db, threads=config["scan"]["threads"], probe_threads=config["threads"],
+                             probe_cache=probe_cache, detector=init_detector(config),
+                             fast_rescan=config["scan"]["fast_rescan"], trust_dirs=trust_dirs,
+                             ignore=config["scan"]["ignore"])
+    # Probes share the job budget from the configuration
+    init_jobs(config)
+    try:
+        if paths is None:
+            logger.info("Scanning library...")
+            result = scanner.scan()
+        else:
+            logger.info(f"Scanning {len(paths)} paths in library...")
+            result = scanner.update_paths(paths)
+    finally:
+        if probe_cache:
+            probe_cache.close()
     logger.info((
-        f"Scanned library. Summary: {len(db.get_all_files())} total files, {len(db.get_files_needing_processing())} "
-        f"files to process, {len(db.get_deleted_files())} files deleted."
+        f"Scanned library. Summary: {db.count_all_files()} total files, {db.count_files_needing_processing()} "
+        f"files to process, {db.count_deleted_files()} files deleted."
     ))
     return result
+
+
+def read_change_list(stream: BinaryIO) -> List[str]:
+    """Read a list of changed paths, as passed with --from-list.
+
+    The paths are separated by NUL characters if the list contains any, by newlines otherwise.
+    Each entry is either a plain path or a line from the output of rsync --itemize-changes.
+    Deleted paths need no special treatment, as they are checked on disk like all other paths,
+    but rsync deletion markers ("*deleting path") are accepted so that its output can be piped in directly.
+
+    Args:
+        stream (BinaryIO): The list to read.
+
+    Returns:
+        List[str]: The listed paths, in the order they were read.
+    """
+    data = stream.read()
+    separator = b"\0" if b"\0" in data else b"\n"
+    paths: List[str] = []
+    for entry in data.split(separator):
+        line = os.fsdecode(entry)
+        if not line:
+            continue
+        deleted = _DELETED_ENTRY.fullmatch(line)
+        itemized = _ITEMIZED_ENTRY.fullmatch(line)
+        if deleted:
+            paths.append(deleted.group(1))
+        elif itemized:
+            # rsync itemizes the files within changed directories separately, so scanning the directories
+            # as a whole (possibly including the entire library, as "./") would only add work
+            if line[1] == "d":
+                continue
+            # Symbolic links are listed with their target
+            paths.append(itemized.group(1).split(" -> ")[0] if line[1] == "L" else itemized.group(1))
+        else:
+            paths.append(line)
+    return paths
@@ -4,20 +4,24 @@ This module provides a LibraryScanner class that can be used to walk through a d
 pick up any files relevant to musicbird, plus changes made to it.
 """
 
+import concurrent.futures
+import itertools
 import logging
 from pathlib import Path
+from typing import Dict, Hashable, Iterable, Iterator, List, Set, Tuple, Union
 
-from .db import LibraryDB
-from .file import File
+from .db import BATCH_SIZE, LibraryDB
+from .file import STAGES_BY_TYPE, File, FileType, Stage
+from .fingerprint import Change, ChangeDetector, MtimeDetector
+from .ignore import IgnoreRules
+from .jobs import get_runner
+from .probecache import ProbeCache
+from . import sniffer
+from .walker import Directory, LibraryWalker
 
 
 logger = logging.getLogger(__name__)
 
-# Always ignore these files as system metadata
-IGNORE_FILES = [
-    "Thumbs.db"
-]
-
 
 class LibraryScanner:
     """Index a directory and add its contents to the DB.
@@ -25,41 +29,153 @@ class LibraryScanner:
     Use this class to scan a directory for files and add them to the provided Database.
     """
 
-    def __init__(self, path: Path, db: LibraryDB) -> None:
+    def __init__(self, path: Path, db: LibraryDB, threads: int = 1, probe_threads: int = 1,
+                 probe_cache: ProbeCache = None, detector: ChangeDetector = None, fast_rescan: bool = False,
+                 trust_dirs: bool = False, ignore: Iterable[str] = ()) -> None:
         """Generate a new scanner for the given path and database.
 
         Args:
             path (Path): The path to scan.
             db (LibraryDB): The library to save the result to.
+            threads (int, optional): Number of threads used to walk the filesystem. Defaults to 1.
+            probe_threads (int, optional): Number of threads used to determine the type of new and modified files.
+                Defaults to 1.
+            probe_cache (ProbeCache, optional): Cache consulted before running ffprobe on a file. Defaults to None.
+            detector (ChangeDetector, optional): Policy used to detect modified files. Defaults to MtimeDetector.
+            fast_rescan (bool, optional): Reuse the stored listings of directories that haven't changed since
+                the last scan instead of listing them again. Defaults to False.
+            trust_dirs (bool, optional): Like fast_rescan, but also assume that all files in unchanged directories
+                are unchanged, without checking them. Defaults to False.
+            ignore (Iterable[str], optional): Patterns for files and directories to skip, in .gitignore syntax
+                (see the ignore module). Defaults to an empty list.
         """
         self.path = path.resolve()
         self.db = db
+        self.threads = threads
+        self.probe_threads = probe_threads
+        self.probe_cache = probe_cache
+        self.detector = detector or MtimeDetector()
+        self.fast_rescan = fast_rescan or trust_dirs
+        self.trust_dirs = trust_dirs
+        self.ignore = IgnoreRules(self.path, ignore)
+        # Files that have been reconciled, but not yet written to the DB
+        self._pending: List[File] = []
+        # Files whose entries need to be updated without changing their processing state
+        self._updated: List[File] = []
+        # New files that have been reconciled, but not yet written to the DB
+        self._added: List[File] = []
+        # Move keys (see _move_keys()) of the new files found during the current scan, mapped to their path.
+        # Used to pair them with deleted files. Keys shared by several new files map to None
+        self._new: Dict[Hashable, Union[Path, None]] = {}
+        # Whether to collect the move keys of new files. Not needed if no existing file can be missing from the scan
+        self._track_moves = False
+        # Type detections of pending files that are still running, only used during scan()
+        self._executor: Union[concurrent.futures.Executor, None] = None
+        self._probes: List[concurrent.futures.Future] = []
 
     def scan(self) -> bool:
         """ Scan the filesystem for changes.
 
         Registers new, modified and deleted files and updates the Library.
 
+        The scan walks the filesystem and the database side by side, both sorted by path, and joins them
+        like a merge join. Every file is thereby classified as new, modified, unchanged or deleted in a single pass,
+        without looking up files in the database one by one or loading the whole library into memory.
+
+        The type of new and modified files is determined by a pool of probe_threads workers while the walk continues.
+        Pending files are written to the DB in the order they were found once all their types are known,
+        so the result is the same as that of a serial scan.
+
+        Deletions are tracked with scan epochs: every scan stamps the files it encounters with a new epoch,
+        one contiguous range of paths at a time. Once the walk has completed, all files with an older epoch are
+        marked as deleted in a single step. If the walk did not complete, no files are marked as deleted.
+
+        Before that, files that were not seen are paired with new files that have the same identity
+        (see _move_keys()). These files have been moved or renamed, so their outputs are moved along with them
+        instead of being deleted and processed again. Only the move keys and paths of new files are kept in memory
+        for this, and not even those if the DB contains no files that could be missing (such as on the first scan).
+
+        In fast_rescan mode, the listings of all directories are stored in the DB. A directory whose mtime has not
+        changed still has the same entries, so only its files are stat'ed. With trust_dirs, the files in unchanged
+        directories are not even stat'ed, their entries in the DB are treated as seen and unchanged instead.
+
         Returns:
             bool: True if all files were scanned successfully, False if not.
         """
         failed = False
-
-        # Mark all files as deleted in-memory at the beginning of our scan
-        # As files are rediscovered, the deleted flag will be removed
         logger.info(f"Scanning directory {self.path} into library")
+        sniffer.stats.reset()
+        self.ignore.reset()
 
-        for file in self.db.get_all_files():
-            file.was_deleted = True
-            self.db.add_or_update_file(file)
+        epoch = self.db.next_scan_epoch()
+        self._new = {}
+        self._track_moves = self.db.count_all_files() > self.db.count_deleted_files()
+        # First and last path of the current range of files that were seen during this scan
+        first_seen: Union[Path, None] = None
+        last_seen: Union[Path, None] = None
 
-        for path in self.path.glob("./**/*"):
-            if path.is_file() and path.name not in IGNORE_FILES:
-                file = File(path)
-                if not self.add_or_update_file(file):
-                    failed = True
+        index = None
+        if self.fast_rescan:
+            index = {directory.path: directory for directory in self.db.iter_directories()}
+        walker = LibraryWalker(self.path, self.threads, self.ignore, index=index, trust_dirs=self.trust_dirs)
+        # On SIGINT, running probes are killed before the executor waits for its workers
+        runner = get_runner()
+        with concurrent.futures.ThreadPoolExecutor(self.probe_threads) as self._executor, runner.cancel_on_interrupt():
+            try:
+                for fs_file, db_file in _merge_by_path(walker.walk(), self.db.iter_all_files()):
+                    if fs_file:
+                        if not self._reconcile(fs_file, db_file):
+                            failed = True
+                        first_seen = first_seen or fs_file.path
+                        last_seen = fs_file.path
+                    elif (db_file.path.parent in walker.trusted_dirs and not db_file.was_deleted
+                          and not self.ignore.match(db_file.path, False)):
+                        # The walker has already listed the directory of this file, as it is ahead of the DB
+                        first_seen = first_seen or db_file.path
+                        last_seen = db_file.path
+                    elif first_seen:
+                        # Deleted files are simply left unstamped, which ends the current range
+                        self._flush_seen(first_seen, last_seen, epoch)
+                        first_seen = None
+                    if len(self._pending) + len(self._updated) >= BATCH_SIZE:
+                        self._flush()
+                if first_seen:
+                    self._flush_seen(first_seen, last_seen, epoch)
+                self._flush()
+            finally:
+                self._executor = None
 
-        return not failed
+        if index is not None:
+            self._update_directory_index(walker, index)
+        if walker.failed:
+            logger.warning("Some directories could not be scanned. Skipping deletion tracking for this scan")
+        else:
+            moved = self._pair_moved_files(self.db.iter_unseen_files(epoch))
+            logger.info(f"Detected {moved} moved files")
+            deleted = self.db.mark_unseen_files_deleted(epoch)
+            logger.info(f"Marked {deleted} files as deleted")
+        logger.info(f"Type detection: {sniffer.stats.report()}")
+        logger.info(f"Ignore rules: {self.ignore.report()}")
+        if self.probe_cache:
+            logger.info(f"Probe cache: {self.probe_cache.hits} hits, {self.probe_cache.misses} misses")
+        self._new = {}
+
+        return not (failed or walker.failed)
+
+    def _update_directory_index(self, walker: LibraryWalker, index: Dict[Path, Directory]) -> None:
+        """Store the changed directory listings of a walk and remove directories that no longer exist.
+
+        Listings are only stored once all files found in them have been written to the DB. Otherwise, a scan that is
+        interrupted in between could leave new files that are never picked up with trust_dirs.
+        """
+        with self.db.transaction():
+            self.db.add_or_update_directories(walker.changed_dirs)
+            if not walker.failed:
+                self.db.remove_directories(index.keys() - walker.visited_dirs)
+        logger.info((
+            f"Directory index: {len(walker.visited_dirs) - len(walker.changed_dirs)} unchanged directories, "
+            f"{len(walker.changed_dirs)} listed"
+        ))
 
     def add_or_update_file(self, file: File) -> bool:
         """Adds a single new file to the library or update an existing one.
@@ -67,26 +183,299 @@ class LibraryScanner:
         Args:
             file (File): The file object to add
 
+        Returns:
+            bool: True if the file was processed successfully, False if not
+        """
+        self._track_moves = False
+        result = self._reconcile(file, self.db.get_file_by_path(file.path))
+        self._flush()
+        return result
+
+    def update_paths(self, paths: Iterable[Path]) -> bool:
+        """Scan only the given files and directories for changes.
+
+        This is much faster than a full scan if only a few paths are known to have changed,
+        for example from filesystem events. Each path is reconciled with the DB like a full scan would:
+        existing files are added or updated, directories are scanned recursively and files that no longer
+        exist at or below a path are paired with new files as moves, or marked as deleted.
+
+        Args:
+            paths (Iterable[Path]): The changed paths. Paths outside of the scanned directory are ignored.
+
+        Returns:
+            bool: True if all paths were scanned successfully, False if not.
+        """
+        failed = False
+        sniffer.stats.reset()
+        self.ignore.reset()
+        self._new = {}
+        self._track_moves = True
+        deleted: List[File] = []
+
+        # On SIGINT, running probes are killed before the executor waits for its workers
+        runner = get_runner()
+        with concurrent.futures.ThreadPoolExecutor(self.probe_threads) as self._executor, runner.cancel_on_interrupt():
+            try:
+                for path in self._top_level_paths(paths):
+                    logger.debug(f"Scanning changed path {path}")
+                    walker = LibraryWalker(path, self.threads, self.ignore)
+                    if path.is_dir():
+                        fs_files = walker.walk()
+                    else:
+                        fs_files = iter(_stat_file(path))
+                    db_files = itertools.chain(filter(None, [self.db.get_file_by_path(path)]),
+                                               self.db.iter_files_below(path))
+                    missing: List[File] = []
+                    for fs_file, db_file in _merge_by_path(fs_files, db_files):
+                        if fs_file:
+                            if not self._reconcile(fs_file, db_file):
+                                failed = True
+                        elif not db_file.was_deleted:
+                            missing.append(db_file)
+                        if len(self._pending) + len(self._updated) >= BATCH_SIZE:
+                            self._flush()
+                    if walker.failed:
+                        logger.warning(f"Some directories in {path} could not be scanned. Skipping deletion tracking")
+                        failed = True
+                    else:
+                        deleted.extend(missing)
+                self._flush()
+            finally:
+                self._executor = None
+
+        unpaired: List[File] = []
+        moved = self._pair_moved_files(deleted, unpaired)
+        self.db.mark_files_deleted(unpaired)
+        logger.info(f"Detected {moved} moved files, marked {len(unpaired)} files as deleted")
+        logger.debug(f"Type detection: {sniffer.stats.report()}")
+        logger.debug(f"Ignore rules: {self.ignore.report()}")
+        return not failed
+
+    def _top_level_paths(self, paths: Iterable[Path]) -> List[Path]:
+        """Get the paths within the scanned directory that are not below any of the other paths, in sorted order."""
+        within: Set[Path] = set()
+        for path in paths:
+            path = Path(path).absolute()
+            if path != self.path and self.path not in path.parents:
+                logger.warning(f"Ignoring path outside of the library: {path}")
+            elif self.ignore.is_ignored(path):
+                logger.debug(f"Skipping path excluded by ignore rules: {path}")
+            else:
+                within.add(path)
+        return sorted((path for path in within if not within.intersection(path.parents)), key=str)
+
+    def _reconcile(self, file: File, current_entry: Union[File, None]) -> bool:
+        """Compare a file found on the filesystem with its database entry and update the entry if needed.
+
+        Args:
+            file (File): The file as found on the filesystem.
+            current_entry (Union[File, None]): The existing entry for the same path, None if there is none.
+
         Returns:
             bool: True if the file was processed successfully, False if not
         """
         # If we're adding/updating a file, that means it must also exist physically
         file.was_deleted = False
 
-        current_entry = self.db.get_file_by_path(file.path)
-
         # By only scanning for the filetype after we detected a new/changed file, we can save a lot of calls
         # to ffmpeg, thus considerably speeding up scanning. If the file is unchanged, we just reuse the old type.
         if not current_entry:
             logger.info(f"Adding new file to library: {file.path}")
-            file.determine_type()
+            self._analyze(file)
             file.needs_processing = True
-        elif current_entry.mtime != file.mtime:
+            self._pending.append(file)
+            if self._track_moves:
+                # Moves can only be detected once all paths have been scanned, so remember new files until then
+                self._added.append(file)
+            return True
+
+        change = self.detector.compare(file, current_entry)
+        if change == Change.MODIFIED:
             logger.info(f"Existing file has been modified and will be reprocessed: {file.path}")
-            file.determine_type()
+            self._analyze(file)
             file.needs_processing = True
-        else:
+            self._pending.append(file)
+            return True
+
+        if change == Change.UNCHANGED:
             logger.debug(f"File unchanged since last scan: {file.path}")
-            file.type = current_entry.type
-        self.db.add_or_update_file(file)
+            if not current_entry.was_deleted:
+                # Nothing to do, the entry is already up to date
+                return True
+        else:
+            logger.debug(f"File contents unchanged since last scan, updating its metadata: {file.path}")
+        file.type = current_entry.type
+        file.needs_processing = current_entry.needs_processing
+        file.checksum = file.checksum or current_entry.checksum
+        file.duration = current_entry.duration
+        file.sample_rate = current_entry.sample_rate
+        if current_entry.was_deleted:
+            # The file reappeared after being marked as deleted, so it needs to be queued again
+            self._pending.append(file)
+        else:
+            self._updated.append(file)
         return True
+
+    def _analyze(self, file: File) -> None:
+        """Fingerprint a new or modified file and determine its type, in the background if a probe pool is running.
+
+        Args:
+            file (File): The file to analyze. Its type must not be read before the next flush.
+        """
+        if self._executor:
+            self._probes.append(self._executor.submit(self._analyze_now, file))
+        else:
+            self._analyze_now(file)
+
+    def _analyze_now(self, file: File) -> None:
+        """Fingerprint a file and determine its type right away."""
+        if file.checksum is None:
+            self.detector.fingerprint(file)
+        file.determine_type(self.probe_cache)
+
+    def _flush(self) -> None:
+        """Write all pending files to the DB and queue them for processing.
+
+        Waits for the type detection of all pending files to finish first.
+        Files that need processing are queued for all stages that apply to their type,
+        the remaining files (which reappeared after being deleted) are removed from all queues.
+        The queues of updated files are left untouched.
+        """
+        for probe in self._probes:
+            # Re-raises any exception raised during type detection
+            probe.result()
+        self._probes = []
+        # The keys are only complete once the file has been fingerprinted
+        for file in self._added:
+            for key in _move_keys(file):
+                # Ambiguous keys (for example hardlinks or duplicate files) are not used for pairing
+                self._new[key] = None if key in self._new else file.path
+        self._added = []
+        if self._pending or self._updated:
+            by_type: Dict[FileType, List[File]] = {}
+            for file in self._pending:
+                if file.needs_processing:
+                    by_type.setdefault(file.type, []).append(file)
+            with self.db.transaction():
+                self.db.add_or_update_files(self._pending + self._updated)
+                self.db.set_queued_stages([file for file in self._pending if not file.needs_processing], [])
+                for filetype, files in by_type.items():
+                    self.db.set_queued_stages(files, STAGES_BY_TYPE[filetype])
+            self._pending = []
+            self._updated = []
+
+    def _pair_moved_files(self, candidates: Iterable[File], unpaired: List[File] = None) -> int:
+        """Pair files that were not seen during the scan with new files that have the same identity.
+
+        The new entry of a moved file takes over the type and the processing state of the old entry
+        and is queued for the move stage, while the old entry is removed. The move stage then renames
+        the existing output of the file in the mirror library, if there is one.
+
+        Args:
+            candidates (Iterable[File]): The DB entries of files that no longer exist.
+            unpaired (List[File], optional): If given, candidates that could not be paired are appended to it.
+
+        Returns:
+            int: The number of moved files.
+        """
+        new_files = self._new
+        self._new = {}
+
+        moved = 0
+        pairs: List[Tuple[File, File]] = []
+        for old in candidates:
+            path = next((new_files.pop(key) for key in _move_keys(old) if new_files.get(key)), None)
+            # New files have already been written to the DB, so their entries are read back from there
+            new = self.db.get_file_by_path(path) if path else None
+            if new is None:
+                if unpaired is not None:
+                    unpaired.append(old)
+                continue
+            # A new file can only be paired once, even if it matches another candidate with a different key
+            for key in _move_keys(new):
+                if new_files.get(key) == new.path:
+                    del new_files[key]
+            logger.info(f"File has been moved from {old.path} to {new.path}")
+            new.type = old.type
+            new.needs_processing = old.needs_processing
+            new.checksum = new.checksum or old.checksum
+            new.duration = new.duration or old.duration
+            new.sample_rate = new.sample_rate or old.sample_rate
+            new.moved_from = old.path
+            pairs.append((old, new))
+            if len(pairs) >= BATCH_SIZE:
+                moved += self._flush_moves(pairs)
+                pairs = []
+        return moved + self._flush_moves(pairs)
+
+    def _flush_moves(self, pairs: List[Tuple[File, File]]) -> int:
+        """Write the new entries of moved files to the DB, queue them for the move stage and remove the old entries.
+
+        Stages that the old entry was still queued for are carried over to the new one.
+        """
+        with self.db.transaction():
+            self.db.add_or_update_files([new for _, new in pairs])
+            for old, new in pairs:
+                stages = [stage for stage in self.db.get_queued_stages(old) if stage != Stage.PRUNE]
+                self.db.set_queued_stages([new], [Stage.MOVE] + stages)
+            self.db.remove_files([old for old, _ in pairs])
+        return len(pairs)
+
+    def _flush_seen(self, first: Path, last: Path, epoch: int) -> None:
+        """Write all pending files to the DB, then stamp a range of paths as seen.
+
+        New files must be written first, as they would otherwise not be stamped along with the range they are in.
+        """
+        with self.db.transaction():
+            self._flush()
+            self.db.mark_files_seen(first, last, epoch)
+
+
+def _stat_file(path: Path) -> List[File]:
+    """Get a list containing the file at path, or an empty list if it is not a regular file."""
+    try:
+        return [File(path)] if path.is_file() else []
+    except OSError:
+        # The file was removed in the meantime
+        return []
+
+
+def _move_keys(file: File) -> List[Hashable]:
+    """Get the keys identifying a file independently of its path, used to detect moved files.
+
+    A file keeps its device, inode, size and modification time when it is moved within a filesystem.
+    If a checksum is available, files copied to a new location with the same size and contents are matched as well.
+    """
+    keys: List[Hashable] = []
+    if None not in (file.dev, file.inode, file.size, file.mtime_ns):
+        keys.append(("inode", file.dev, file.inode, file.size, file.mtime_ns))
+    if file.checksum and file.size is not None:
+        keys.append(("checksum", file.checksum, file.size))
+    return keys
+
+
+def _merge_by_path(fs_files: Iterator[File],
+                   db_files: Iterator[File]) -> Iterator[Tuple[Union[File, None], Union[File, None]]]:
+    """Join two iterators of files that are both sorted by path.
+
+    Args:
+        fs_files (Iterator[File]): Files found on the filesystem, sorted by path.
+        db_files (Iterator[File]): Files stored in the database, sorted by path.
+
+    Yields:
+        Tuple[Union[File, None], Union[File, None]]: Pairs of files with the same path.
+            One side of the pair is None if the path only exists in the other iterator.
+    """
+    fs_file = next(fs_files, None)
+    db_file = next(db_files, None)
+    while fs_file or db_file:
+        if db_file is None or (fs_file is not None and str(fs_file.path) < str(db_file.path)):
+            yield fs_file, None
+            fs_file = next(fs_files, None)
+        elif fs_file is None or str(fs_file.path) > str(db_file.path):
+            yield None, db_file
+            db_file = next(db_files, None)
+        else:
+            yield fs_file, db_file
+            fs_file = next(fs_files, None)
+            db_file = next(db_files, None)
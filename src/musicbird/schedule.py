@@ -0,0 +1,168 @@
+"""Provides the policies that decide in which order files are encoded.
+
+The time needed to encode a file mostly depends on the length and sample rate of its audio. If the longest files
+happen to be submitted last, the encode step ends with a single worker busy while all others are idle.
+The default policy therefore submits files longest-processing-time-first (LPT), which keeps the total
+runtime (the makespan) close to the optimum.
+
+The cost of each file is estimated from its duration and sample rate, as stored during the scan.
+Files without a known duration are estimated from their size instead.
+"""
+
+import heapq
+import logging
+import threading
+import time
+from typing import Dict, Iterable, List, Union
+
+from .file import File
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("lpt", "album", "newest", "queue")
+"""The available scheduling policies:
+
+- lpt: Longest files first
+- album: Album by album in path order, with the longest files of each album first
+- newest: Most recently modified files first
+- queue: In the order of the queue (by path). Files are read from the queue as they are submitted,
+  while all other policies read the entire queue first
+"""
+
+# Sample rate that costs are expressed in, so that a second of 96 kHz audio costs more than a second at 44.1 kHz
+_REFERENCE_SAMPLE_RATE = 44100
+# Assumed data rate of files with an unknown duration, in bytes per second of audio. Roughly that of a CD-quality FLAC
+_FALLBACK_BYTE_RATE = 100000
+
+
+def estimate_cost(file: File) -> float:
+    """Estimate the cost of encoding a file.
+
+    Args:
+        file (File): The file to estimate.
+
+    Returns:
+        float: The estimated cost, in seconds of audio at 44.1 kHz.
+    """
+    if file.duration:
+        return file.duration * (file.sample_rate or _REFERENCE_SAMPLE_RATE) / _REFERENCE_SAMPLE_RATE
+    return (file.size or 0) / _FALLBACK_BYTE_RATE
+
+
+def order_files(files: List[File], policy: str) -> List[File]:
+    """Order files according to a scheduling policy.
+
+    Args:
+        files (List[File]): The files to order, in the order of the queue.
+        policy (str): One of POLICIES.
+
+    Returns:
+        List[File]: The files in the order they should be submitted in.
+
+    Raises:
+        ValueError: If the policy is unknown.
+    """
+    if policy == "lpt":
+        # The sort is stable, so files with the same cost stay in path order
+        return sorted(files, key=lambda file: -estimate_cost(file))
+    if policy == "album":
+        albums: Dict[str, List[File]] = {}
+        for file in files:
+            albums.setdefault(str(file.path.parent), []).append(file)
+        return [file for album in sorted(albums) for file in order_files(albums[album], "lpt")]
+    if policy == "newest":
+        return sorted(files, key=lambda file: -(file.mtime_ns or file.mtime * 10**9))
+    if policy == "queue":
+        return list(files)
+    raise ValueError(f"Unknown scheduling policy {policy}")
+
+
+def predict_makespan(costs: Iterable[float], workers: int) -> float:
+    """Predict the makespan of jobs submitted in the given order to a pool of workers.
+
+    Each job is started by the worker that becomes idle first, like in a ThreadPoolExecutor.
+
+    Args:
+        costs (Iterable[float]): The costs of the jobs, in order of submission.
+        workers (int): Number of workers.
+
+    Returns:
+        float: The time until the last job finishes, in the unit of the costs.
+    """
+    finish_times = [0.0] * workers
+    for cost in costs:
+        heapq.heapreplace(finish_times, finish_times[0] + cost)
+    return max(finish_times)
+
+
+class MakespanTracker:
+    """Compares the makespan predicted for a schedule with the actual one.
+
+    Costs are converted to time using the throughput measured while the jobs ran, so that the prediction
+    only depends on the order of the jobs and on the accuracy of the cost estimates.
+
+    Attributes:
+        workers: Number of workers that run the jobs.
+        costs: Estimated costs of all submitted jobs, in order of submission.
+        busy: Total time spent running finished jobs, in seconds.
+        done: Total estimated cost of all finished jobs.
+        started: Time the first job was submitted, as returned by time.monotonic(). None if none was submitted.
+        finished: Time the last job finished, as returned by time.monotonic(). None if none has finished.
+    """
+
+    def __init__(self, workers: int) -> None:
+        """Create a new tracker.
+
+        Args:
+            workers (int): Number of workers that run the jobs.
+        """
+        self.workers = workers
+        self.costs: List[float] = []
+        self.busy = 0.0
+        self.done = 0.0
+        self.started: Union[float, None] = None
+        self.finished: Union[float, None] = None
+        self._lock = threading.Lock()
+
+    def submit(self, cost: float) -> None:
+        """Record the submission of a job.
+
+        Args:
+            cost (float): The estimated cost of the job.
+        """
+        if self.started is None:
+            self.started = time.monotonic()
+        self.costs.append(cost)
+
+    def finish(self, cost: float, elapsed: float) -> None:
+        """Record a finished job. Thread-safe.
+
+        Args:
+            cost (float): The estimated cost of the job.
+            elapsed (float): Time the job took, in seconds.
+        """
+        with self._lock:
+            self.busy += elapsed
+            self.done += cost
+            self.finished = time.monotonic()
+
+    def report(self) -> str:
+        """Summarize the predicted and the actual makespan in a human-readable form.
+
+        The actual makespan is the time from the first submission until the last job finished.
+
+        Returns:
+            str: The predicted makespan, its lower bound and the actual makespan.
+        """
+        if self.started is None or self.finished is None:
+            return "no jobs finished"
+        elapsed = self.finished - self.started
+        if not self.busy or not self.done:
+            return f"actual {elapsed:.1f}s, no prediction available"
+        # Seconds of runtime per unit of estimated cost
+        rate = self.busy / self.done
+        predicted = predict_makespan(self.costs, self.workers) * rate
+        # No schedule can beat a perfectly balanced load, or the longest job
+        lower_bound = max(sum(self.costs) / self.workers, max(self.costs)) * rate
+        return (f"predicted {predicted:.1f}s (lower bound {lower_bound:.1f}s), actual {elapsed:.1f}s, "
+                f"encoding at {1 / rate:.1f}x realtime per worker")
@@ -0,0 +1,622 @@
+"""Provides segmented encoding of long audio files.
+
+An encoder process only uses a single CPU core, so a single long file (such as a DJ mix or an audiobook) can take
+longer to encode than the rest of a batch combined. In segment mode, such a file is split into time ranges that are
+encoded in parallel, then the outputs are joined into a single file at the destination path.
+
+To join the outputs without gaps or overlaps, all segments are cut on a common frame grid:
+
+- Segment boundaries are placed on multiples of the frame size of the output format, at positions that are whole
+  samples in both the source and the output sample rate. Frame k of each segment then covers the same time range
+  as the frame at the same position in an encode of the entire file.
+- Each segment is encoded with some extra audio before and after its range, so that the encoder has settled once
+  it reaches the range. Only the frames within the range are kept, and their lengths add up exactly.
+- The headers describing the entire stream (the Xing/LAME header of MP3 files, the granule positions of Ogg Opus
+  files) are rebuilt for the joined file, so that players trim the encoder delay and padding as usual.
+  The metadata and album art are taken from the first segment.
+
+MP3 segments are encoded without the bit reservoir, as frames using it depend on data stored in preceding frames.
+"""
+
+import concurrent.futures
+import logging
+import math
+import os
+from pathlib import Path
+import shutil
+import struct
+from typing import Dict, Iterator, List, NamedTuple, Tuple, Union
+import zlib
+
+from .encoder import EncodeResult, Encoder
+from .jobs import JobLimits
+
+logger = logging.getLogger(__name__)
+
+# Amount of extra audio encoded before and after the range of each segment, in seconds
+_MARGIN = 1.0
+
+# Bitrates of MPEG audio layer III frames in kbit/s, for MPEG-1 and MPEG-2/2.5
+_MP3_BITRATES = {
+    True: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    False: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_MP3_SAMPLE_RATES = [44100, 48000, 32000]
+# Flags of the optional fields of a Xing/Info header, with the size of each field
+_XING_FIELDS = [(0x1, "frames", 4), (0x2, "bytes", 4), (0x4, "toc", 100), (0x8, "quality", 4)]
+_LAME_TAG_SIZE = 36
+
+# CRC-16 used by LAME tags (polynomial x^16 + x^15 + x^2 + 1, reflected)
+_CRC16_POLY = 0x18005
+# Multiplicative order of x modulo the CRC-16 polynomial, which is (x + 1) times a primitive polynomial of degree 15
+_CRC16_ORDER = 32767
+
+# Maximum duration of the packets on a single Ogg page, in samples at 48 kHz
+_OGG_PAGE_SAMPLES = 48000
+_OGG_CONTINUED = 0x01
+_OGG_EOS = 0x04
+
+
+class Segment(NamedTuple):
+    """A time range of a file that is encoded separately.
+
+    Attributes:
+        seek: Position to seek to in the source before decoding, in whole seconds.
+        start: First sample of the source passed to the encoder.
+        end: Sample of the source after the last sample passed to the encoder.
+            None for the last segment, which extends to the end of the file.
+        offset: Position of the first sample passed to the encoder in the output, in samples at the output rate.
+        keep_start: Start of the range of the segment, relative to offset. Frames starting before it are dropped.
+        keep_end: End of the range of the segment, relative to offset. Frames starting at or after it are dropped.
+            None for the last segment.
+    """
+    seek: int
+    start: int
+    end: Union[int, None]
+    offset: int
+    keep_start: int
+    keep_end: Union[int, None]
+
+
+def frame_samples(segment_format: str, sample_rate: int) -> int:
+    """Get the number of samples per frame of an output format.
+
+    Args:
+        segment_format (str): The format, see Encoder.segment_format.
+        sample_rate (int): The output sample rate.
+
+    Returns:
+        int: The number of samples per frame at the output rate.
+    """
+    if segment_format == "mp3":
+        # MPEG-1 frames have twice as many samples as those of the MPEG-2 extensions for low sample rates
+        return 1152 if sample_rate >= 32000 else 576
+    # Ogg Opus, using the default frame size of 20ms
+    return 960
+
+
+def plan_segments(duration: float, sample_rate: int, output_rate: int, frame_size: int,
+                  length: float) -> List[Segment]:
+    """Split a file into segments of roughly the given length.
+
+    Args:
+        duration (float): Length of the file in seconds.
+        sample_rate (int): Sample rate of the file.
+        output_rate (int): Sample rate of the output.
+        frame_size (int): Number of samples per frame at the output rate.
+        length (float): Target length of each segment in seconds.
+
+    Returns:
+        List[Segment]: The segments, in order. Empty if the file is too short to be split.
+    """
+    # Boundaries must be multiples of the frame size at the output rate that are whole samples at the source rate
+    unit = frame_size * sample_rate // math.gcd(frame_size * sample_rate, output_rate)
+    step = max(round(length * sample_rate / unit), 1) * unit
+    margin = math.ceil(_MARGIN * sample_rate / unit) * unit
+    total = int(duration * sample_rate)
+    boundaries = list(range(0, total, step))
+    if len(boundaries) > 1 and total - boundaries[-1] < step // 2:
+        # Merge a short remainder into the previous segment
+        boundaries.pop()
+    if len(boundaries) < 2:
+        return []
+
+    segments = []
+    for index, boundary in enumerate(boundaries):
+        start = max(boundary - margin, 0)
+        following = boundaries[index + 1] if index + 1 < len(boundaries) else None
+        segments.append(Segment(
+            seek=start // sample_rate,
+            start=start,
+            end=following + margin if following is not None else None,
+            offset=start * output_rate // sample_rate,
+            keep_start=(boundary - start) * output_rate // sample_rate,
+            keep_end=(following - start) * output_rate // sample_rate if following is not None else None))
+    return segments
+
+
+def encode_segmented(encoder: Encoder, src: Path, dest: Path, duration: float, sample_rate: int,
+                     length: float, limits: JobLimits = None) -> EncodeResult:
+    """Encode a file in segments that are encoded in parallel, then join them at dest.
+
+    The segments are run through the shared job runner, so they are spread over the same budget of processes
+    as all other encodes. Files too short to be split are encoded as usual.
+
+    Args:
+        encoder (Encoder): The encoder to use. Must support segmented encodes, see Encoder.segment_format.
+        src (Path): The file to encode.
+        dest (Path): The Path at which to store the encoded file.
+        duration (float): Length of the file in seconds.
+        sample_rate (int): Sample rate of the file.
+        length (float): Target length of each segment in seconds.
+        limits (JobLimits, optional): Limits for the encoder processes of each segment. Defaults to None (no limits).
+
+    Returns:
+        EncodeResult: The result, which is that of the first failed segment if any segment failed.
+    """
+    output_rate = encoder.output_rate(sample_rate)
+    segments = plan_segments(duration, sample_rate, output_rate,
+                             frame_samples(encoder.segment_format, output_rate), length)
+    if not segments:
+        return encoder.encode(src, dest, limits)
+    created = encoder.mkdir(dest)
+    if not created:
+        return created
+
+    logger.debug(f"Encoding {src} in {len(segments)} segments")
+    workdir = dest.parent.joinpath(f".{dest.name}.segments")
+    try:
+        workdir.mkdir(exist_ok=True)
+        parts = [(workdir.joinpath(f"{index}{encoder.extension}"), segment) for index, segment in enumerate(segments)]
+        with concurrent.futures.ThreadPoolExecutor(len(parts)) as executor:
+            results = list(executor.map(
+                lambda part: encoder.encode_segment(src, part[0], part[1].seek, part[1].start, part[1].end,
+                                                    sample_rate, part[1].start == 0, limits),
+                parts))
+        failed = [result for result in results if not result]
+        if failed:
+            logger.error(f"Failed to encode file {src}: {len(failed)} of {len(parts)} segments failed")
+            return failed[0]
+        if encoder.segment_format == "mp3":
+            join_mp3(parts, dest)
+        else:
+            join_opus(parts, dest)
+    except OSError as e:
+        logger.error(f"Failed to join the segments of file {src}: {repr(e)}")
+        return EncodeResult.from_os_error(e)
+    except ValueError as e:
+        logger.error(f"Failed to join the segments of file {src}: {repr(e)}")
+        return EncodeResult("error", repr(e))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return EncodeResult()
+
+
+class _Mp3Stream(NamedTuple):
+    """The frames of an MP3 file, as returned by _read_mp3()."""
+    # Xing/Info header frame, None if there is none
+    info: Union[bytes, None]
+    # Size of the side information of the header frame, which precedes the Xing/Info tag
+    side_info: int
+    # Positions of all audio frames, followed by the position after the last one
+    positions: List[int]
+    # Number of samples per frame
+    samples: int
+
+
+def join_mp3(parts: List[Tuple[Path, Segment]], dest: Path) -> None:
+    """Join the MP3 encodes of the segments of a file.
+
+    The ID3 tag is taken from the first segment. The Xing/LAME header is taken from the last segment, which has the
+    same encoder settings and the same padding at the end, and is updated to describe the entire file.
+    Every segment must have a Xing/LAME header.
+
+    Args:
+        parts (List[Tuple[Path, Segment]]): The encoded segments and their ranges, in order.
+        dest (Path): Location of the joined file.
+
+    Raises:
+        OSError: If a segment could not be read or the output could not be written.
+        ValueError: If a segment is not a valid MP3 file encoded on the frame grid of the segments.
+    """
+    id3 = b""
+    # Byte range of the kept frames in each segment
+    ranges: List[Tuple[Path, int, int]] = []
+    # Position of each kept frame in the joined audio data, for the seek table
+    positions: List[int] = []
+    total = 0
+    crc = 0
+    stream = None
+    for index, (path, segment) in enumerate(parts):
+        data = path.read_bytes()
+        start = _id3v2_size(data)
+        if index == 0:
+            id3 = data[:start]
+        stream = _read_mp3(data, start)
+        if stream.info is None:
+            raise ValueError(f"Segment {path} has no Xing header")
+        first, last = _kept_frames(stream.samples, len(stream.positions) - 1, segment)
+        kept_start, kept_end = stream.positions[first], stream.positions[last]
+        positions.extend(position - kept_start + total for position in stream.positions[first:last])
+        ranges.append((path, kept_start, kept_end))
+        total += kept_end - kept_start
+        crc = _crc16_shift(crc, kept_end - kept_start) ^ _kept_crc(data, stream, kept_start, kept_end)
+
+    # The stream of the last segment has the same padding at its end as the joined file
+    info = bytearray(stream.info)
+    audio_size = stream.positions[-1] - stream.positions[0]
+    frames = len(stream.positions) - 1
+    fields = _xing_fields(info, stream.side_info)
+    if "frames" in fields:
+        _add_uint(info, fields["frames"], 4, len(positions) - frames)
+    if "bytes" in fields:
+        _add_uint(info, fields["bytes"], 4, total - audio_size)
+    if "toc" in fields:
+        for i in range(100):
+            # Position of the frame at i percent of the duration, as a fraction of the size
+            info[fields["toc"] + i] = min(256 * positions[i * len(positions) // 100] // total, 255)
+    if "lame" in fields:
+        lame = fields["lame"]
+        delay_padding = int.from_bytes(info[lame + 21:lame + 24], "big")
+        padding = (delay_padding & 0xfff) + (len(positions) - frames) * stream.samples - parts[-1][1].offset
+        if not 0 <= padding <= 0xfff:
+            raise ValueError(f"Segments are not aligned, padding of joined file would be {padding}")
+        info[lame + 21:lame + 24] = (delay_padding & 0xfff000 | padding).to_bytes(3, "big")
+        _add_uint(info, lame + 28, 4, total - audio_size)
+        info[lame + 32:lame + 34] = crc.to_bytes(2, "big")
+        info[lame + 34:lame + 36] = _crc16(bytes(info[:lame + 34])).to_bytes(2, "big")
+
+    _write_parts(dest, [id3, bytes(info)], ranges)
+
+
+def _read_mp3(data: bytes, position: int) -> _Mp3Stream:
+    """Parse the frames of an MP3 file, starting at position. Stops at the first invalid or truncated frame."""
+    info = None
+    side_info = 0
+    positions: List[int] = []
+    samples = 0
+    while True:
+        frame = _mp3_frame(data, position)
+        if frame is None or position + frame[0] > len(data):
+            break
+        length, samples, frame_side_info = frame
+        tag = data[position + 4 + frame_side_info:position + 8 + frame_side_info]
+        if info is None and not positions and tag in (b"Xing", b"Info"):
+            info = data[position:position + length]
+            side_info = frame_side_info
+        else:
+            positions.append(position)
+        position += length
+    if not positions:
+        raise ValueError("No MP3 frames found")
+    positions.append(position)
+    return _Mp3Stream(info, side_info, positions, samples)
+
+
+def _mp3_frame(data: bytes, position: int) -> Union[Tuple[int, int, int], None]:
+    """Parse the header of an MPEG audio layer III frame.
+
+    Returns:
+        Union[Tuple[int, int, int], None]: The length of the frame, its number of samples and the size of its
+            side information. None if there is no valid frame at position.
+    """
+    header = data[position:position + 4]
+    if len(header) < 4 or header[0] != 0xff or header[1] & 0xe0 != 0xe0:
+        return None
+    version = (header[1] >> 3) & 0x03  # 0: MPEG-2.5, 1: reserved, 2: MPEG-2, 3: MPEG-1
+    layer = (header[1] >> 1) & 0x03  # 1: layer III
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = _MP3_BITRATES[mpeg1][bitrate_index] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[sample_rate_index] >> (3 - version if version else 2)
+    padding = (header[2] >> 1) & 0x01
+    mono = header[3] >> 6 == 3
+    if mpeg1:
+        return 144 * bitrate // sample_rate + padding, 1152, 17 if mono else 32
+    return 72 * bitrate // sample_rate + padding, 576, 9 if mono else 17
+
+
+def _id3v2_size(data: bytes) -> int:
+    """Get the size of the ID3v2 tag at the start of data, 0 if there is none."""
+    if not data.startswith(b"ID3") or len(data) < 10:
+        return 0
+    size = 10 + ((data[6] & 0x7f) << 21 | (data[7] & 0x7f) << 14 | (data[8] & 0x7f) << 7 | (data[9] & 0x7f))
+    return size + 10 if data[5] & 0x10 else size
+
+
+def _xing_fields(info: bytes, side_info: int) -> Dict[str, int]:
+    """Find the positions of the fields of a Xing/Info header frame.
+
+    Returns:
+        Dict[str, int]: The positions of the fields present in the frame (frames, bytes, toc, quality),
+            and of the LAME tag following them (lame), if there is one.
+    """
+    position = 4 + side_info
+    flags = struct.unpack_from(">I", info, position + 4)[0]
+    position += 8
+    fields = {}
+    for flag, name, size in _XING_FIELDS:
+        if flags & flag:
+            fields[name] = position
+            position += size
+    if position + _LAME_TAG_SIZE <= len(info) and info[position:position + 4].isalpha():
+        fields["lame"] = position
+    return fields
+
+
+def _kept_crc(data: bytes, stream: _Mp3Stream, kept_start: int, kept_end: int) -> int:
+    """Get the CRC-16 of the kept frames of an MP3 segment.
+
+    The LAME tag of the segment contains the CRC of all of its audio frames. The CRC of the kept frames is derived
+    from it, so that only the few frames outside of the range need to be read. If the segment doesn't have
+    a matching LAME tag, the CRC is calculated from the kept frames directly.
+    """
+    fields = _xing_fields(stream.info, stream.side_info)
+    audio_start, audio_end = stream.positions[0], stream.positions[-1]
+    if "lame" in fields:
+        lame = fields["lame"]
+        music_length = int.from_bytes(stream.info[lame + 28:lame + 32], "big")
+        # Depending on the encoder, the length of the music includes the header frame or not
+        if music_length - (audio_end - audio_start) in (0, len(stream.info)):
+            crc = int.from_bytes(stream.info[lame + 32:lame + 34], "big")
+            crc ^= _crc16(data[kept_end:audio_end])
+            crc ^= _crc16_shift(_crc16(data[audio_start:kept_start]), audio_end - kept_start)
+            return _crc16_shift(crc, kept_end - audio_end)
+    return _crc16(data[kept_start:kept_end])
+
+
+def _add_uint(data: bytearray, position: int, size: int, delta: int) -> None:
+    """Add delta to a big-endian unsigned integer field."""
+    value = int.from_bytes(data[position:position + size], "big") + delta
+    if value < 0:
+        raise ValueError(f"Invalid header field at position {position}")
+    data[position:position + size] = value.to_bytes(size, "big")
+
+
+def _crc16(data: bytes, crc: int = 0) -> int:
+    """Calculate the CRC-16 used by LAME tags (CRC-16/ARC)."""
+    for byte in data:
+        crc = _CRC16_TABLE[(crc ^ byte) & 0xff] ^ (crc >> 8)
+    return crc
+
+
+def _crc16_table() -> List[int]:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC16_TABLE = _crc16_table()
+
+
+def _crc16_shift(crc: int, length: int) -> int:
+    """Get the CRC-16 of data followed by length zero bytes, given the CRC of the data.
+
+    As the CRC has no initial value or final XOR, the CRC of a concatenation A + B is
+    _crc16_shift(_crc16(A), len(B)) ^ _crc16(B). A negative length removes zero bytes instead.
+    """
+    # Appending zero bits multiplies the CRC polynomial by x. The CRC is reflected, so reverse its bits first
+    exponent = (8 * length) % _CRC16_ORDER
+    factor = 1
+    base = 2
+    while exponent:
+        if exponent & 1:
+            factor = _gf2_mulmod(factor, base)
+        base = _gf2_mulmod(base, base)
+        exponent >>= 1
+    return _reverse_bits(_gf2_mulmod(_reverse_bits(crc, 16), factor), 16)
+
+
+def _gf2_mulmod(a: int, b: int) -> int:
+    """Multiply two polynomials over GF(2) modulo the CRC-16 polynomial."""
+    result = 0
+    while b:
+        if b & 1:
+            result ^= a
+        b >>= 1
+        a <<= 1
+        if a & 0x10000:
+            a ^= _CRC16_POLY
+    return result
+
+
+def _reverse_bits(value: int, bits: int) -> int:
+    return int(f"{value:0{bits}b}"[::-1], 2)
+
+
+def _kept_frames(samples: int, count: int, segment: Segment) -> Tuple[int, int]:
+    """Get the indices of the first frame of a segment within its range and of the first one after it."""
+    if segment.keep_start % samples or (segment.keep_end or 0) % samples:
+        raise ValueError(f"Segment boundaries are not aligned to frames of {samples} samples")
+    first = segment.keep_start // samples
+    last = count if segment.keep_end is None else segment.keep_end // samples
+    if last > count or first >= last:
+        raise ValueError(f"Segment has {count} frames, expected at least {last}")
+    return first, last
+
+
+def _write_parts(dest: Path, headers: List[bytes], ranges: List[Tuple[Path, int, int]]) -> None:
+    """Write headers followed by byte ranges of other files to dest, replacing it once complete."""
+    tmp = dest.with_name(f".{dest.name}.tmp")
+    try:
+        with tmp.open("wb") as f:
+            for header in headers:
+                f.write(header)
+            for path, start, end in ranges:
+                with path.open("rb") as part:
+                    part.seek(start)
+                    f.write(part.read(end - start))
+        os.replace(tmp, dest)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+class _OggOpusStream(NamedTuple):
+    """The packets of an Ogg Opus file, as returned by _read_ogg_opus()."""
+    # Raw pages containing the OpusHead and OpusTags packets
+    header: bytes
+    serial: int
+    # Number of header pages
+    header_pages: int
+    preskip: int
+    packets: List[bytes]
+    # Granule position of the last page
+    granule: int
+
+
+def join_opus(parts: List[Tuple[Path, Segment]], dest: Path) -> None:
+    """Join the Ogg Opus encodes of the segments of a file.
+
+    The header pages (with the metadata and album art) are taken from the first segment. The audio packets are
+    written to new pages with updated granule positions. The granule position of the last page marks the end
+    of the audio, so that the padding at the end of the last frame is trimmed.
+
+    Args:
+        parts (List[Tuple[Path, Segment]]): The encoded segments and their ranges, in order.
+        dest (Path): Location of the joined file.
+
+    Raises:
+        OSError: If a segment could not be read or the output could not be written.
+        ValueError: If a segment is not a valid Ogg Opus file encoded on the frame grid of the segments.
+    """
+    header = b""
+    serial = header_pages = preskip = 0
+    packets: List[bytes] = []
+    stream = None
+    for index, (path, segment) in enumerate(parts):
+        stream = _read_ogg_opus(path.read_bytes())
+        if index == 0:
+            header, serial, header_pages, preskip = stream.header, stream.serial, stream.header_pages, stream.preskip
+        elif stream.preskip != preskip:
+            raise ValueError(f"Segment {path} has a pre-skip of {stream.preskip}, expected {preskip}")
+        position = 0
+        for packet in stream.packets:
+            if position >= segment.keep_start and (segment.keep_end is None or position < segment.keep_end):
+                packets.append(packet)
+            position += _opus_samples(packet)
+        if segment.keep_end is not None and position < segment.keep_end:
+            raise ValueError(f"Segment {path} ends at {position} samples, expected at least {segment.keep_end}")
+    # The audio of the last segment ends at the same point as the joined audio
+    end = stream.granule + parts[-1][1].offset
+
+    pages = [header]
+    sequence = header_pages
+    # Granule positions count all decoded samples, including the pre-skip at the start of the first packet
+    granule = 0
+    page: List[bytes] = []
+    page_samples = 0
+    for index, packet in enumerate(packets):
+        page.append(packet)
+        page_samples += _opus_samples(packet)
+        lacing = sum(len(queued) // 255 + 1 for queued in page)
+        following = packets[index + 1] if index + 1 < len(packets) else None
+        if (following is None or page_samples >= _OGG_PAGE_SAMPLES
+                or lacing + len(following) // 255 + 1 > 255):
+            granule += page_samples
+            last = following is None
+            pages.append(_ogg_page(serial, sequence, end if last else granule, _OGG_EOS if last else 0, page))
+            sequence += 1
+            page = []
+            page_samples = 0
+    _write_parts(dest, pages, [])
+
+
+def _read_ogg_opus(data: bytes) -> _OggOpusStream:
+    """Parse the pages of an Ogg Opus file with a single logical stream."""
+    header_end = 0
+    header_pages = 0
+    packets: List[bytes] = []
+    packet = b""
+    serial = None
+    granule = 0
+    for page_serial, page_granule, segments, body, page_end in _iter_ogg_pages(data):
+        if serial is None:
+            serial = page_serial
+        elif page_serial != serial:
+            raise ValueError("Ogg file contains multiple streams")
+        granule = page_granule
+        position = 0
+        for size in segments:
+            packet += body[position:position + size]
+            position += size
+            if size < 255:
+                packets.append(packet)
+                packet = b""
+        if not header_end:
+            header_pages += 1
+            if len(packets) >= 2:
+                header_end = page_end
+    if len(packets) < 2 or not packets[0].startswith(b"OpusHead") or not packets[1].startswith(b"OpusTags"):
+        raise ValueError("No Opus headers found")
+    preskip = struct.unpack_from("<H", packets[0], 10)[0]
+    return _OggOpusStream(data[:header_end], serial, header_pages, preskip, packets[2:], granule)
+
+
+def _iter_ogg_pages(data: bytes) -> Iterator[Tuple[int, int, bytes, bytes, int]]:
+    """Yield the serial number, granule position, segment table, body and end position of each Ogg page."""
+    position = 0
+    while position < len(data):
+        if data[position:position + 4] != b"OggS" or position + 27 > len(data):
+            raise ValueError(f"Invalid Ogg page at position {position}")
+        granule, serial = struct.unpack_from("<qI", data, position + 6)
+        count = data[position + 26]
+        segments = data[position + 27:position + 27 + count]
+        body_start = position + 27 + count
+        end = body_start + sum(segments)
+        if end > len(data):
+            raise ValueError(f"Truncated Ogg page at position {position}")
+        yield serial, granule, segments, data[body_start:end], end
+        position = end
+
+
+def _ogg_page(serial: int, sequence: int, granule: int, flags: int, packets: List[bytes]) -> bytes:
+    """Build an Ogg page containing complete packets."""
+    segments = bytearray()
+    for packet in packets:
+        segments.extend([255] * (len(packet) // 255))
+        segments.append(len(packet) % 255)
+    page = bytearray(struct.pack("<4sBBqIIIB", b"OggS", 0, flags, granule, serial, sequence, 0, len(segments)))
+    page.extend(segments)
+    for packet in packets:
+        page.extend(packet)
+    page[22:26] = struct.pack("<I", _ogg_crc(bytes(page)))
+    return bytes(page)
+
+
+# Every byte value with its bits in reverse order
+_REVERSED_BYTES = bytes(_reverse_bits(byte, 8) for byte in range(256))
+
+
+def _ogg_crc(data: bytes) -> int:
+    """Calculate the CRC-32 of an Ogg page (polynomial 0x04c11db7, not reflected, no initial value or final XOR).
+
+    zlib implements the reflected variant of the same CRC, so reversing the bits of every byte of the input
+    and of the result gives the CRC used by Ogg. This is much faster than calculating it in Python.
+    """
+    crc = zlib.crc32(data.translate(_REVERSED_BYTES), 0xffffffff) ^ 0xffffffff
+    return _reverse_bits(crc, 32)
+
+
+def _opus_samples(packet: bytes) -> int:
+    """Get the number of samples in an Opus packet at 48 kHz, from its TOC byte."""
+    config = packet[0] >> 3
+    if config < 12:
+        # SILK-only frames of 10, 20, 40 or 60ms
+        frame_size = (480, 960, 1920, 2880)[config & 0x03]
+    elif config < 16:
+        # Hybrid frames of 10 or 20ms
+        frame_size = (480, 960)[config & 0x01]
+    else:
+        # CELT-only frames of 2.5, 5, 10 or 20ms
+        frame_size = (120, 240, 480, 960)[config & 0x03]
+    code = packet[0] & 0x03
+    frames = 1 if code == 0 else 2 if code < 3 else packet[1] & 0x3f
+    return frame_size * frames
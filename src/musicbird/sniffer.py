@@ -0,0 +1,517 @@
+"""Provides a fast classifier for media files based on their headers.
+
+Calling ffprobe for every new file is slow, as it spawns a new process and reads far more of the file than
+necessary. This module recognizes the common audio formats (and a few common non-audio formats) from the first few
+kilobytes of a file instead. The result uses the same codec names as ffprobe, so that it can be classified the same way.
+Files that can't be identified with certainty are left to ffprobe.
+"""
+
+import logging
+from pathlib import Path
+import struct
+import threading
+from typing import BinaryIO, Iterator, List, NamedTuple, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# Number of bytes read from the start of a file. Enough for the headers of all supported formats in almost all cases
+HEADER_SIZE = 8192
+# Largest header structure that will be read when it does not fit into HEADER_SIZE (ASF headers, MP4 moov boxes)
+MAX_HEADER_SIZE = 16 * 1024 * 1024
+
+# Signatures of common non-audio files found in music libraries
+_OTHER_SIGNATURES = [
+    b"\xff\xd8\xff",  # JPEG
+    b"\x89PNG\r\n\x1a\n",
+    b"GIF87a",
+    b"GIF89a",
+    b"%PDF-",
+    b"PK\x03\x04",  # ZIP (and formats based on it)
+    b"\xff\xfe",  # UTF-16 text
+    b"\xfe\xff",
+]
+# Bytes that don't occur in text files
+_BINARY_BYTES = bytes(set(range(0x20)) - set(b"\t\n\x0c\r\x1b")) + b"\x7f"
+
+_MPEG_BITRATES = {
+    # (MPEG-1, layer): bitrates in kbit/s by index
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# Sample rates of MPEG-1 audio. MPEG-2 uses half and MPEG-2.5 a quarter of these
+_MPEG_SAMPLE_RATES = [44100, 48000, 32000]
+
+# WAVE format tags and the codecs they map to. PCM and float formats depend on the sample size and are handled below
+_WAVE_FORMATS = {
+    0x0006: "pcm_alaw",
+    0x0007: "pcm_mulaw",
+    0x0055: "mp3",
+}
+_AIFC_FORMATS = {
+    b"fl32": "pcm_f32be",
+    b"FL32": "pcm_f32be",
+    b"fl64": "pcm_f64be",
+    b"FL64": "pcm_f64be",
+    b"alaw": "pcm_alaw",
+    b"ulaw": "pcm_mulaw",
+}
+# First bytes of the first packet of a logical Ogg stream
+_OGG_CODECS = {
+    b"OpusHead": "opus",
+    b"\x01vorbis": "vorbis",
+    b"\x7fFLAC": "flac",
+    b"Speex   ": "speex",
+}
+
+_ASF_HEADER = bytes.fromhex("3026b2758e66cf11a6d900aa0062ce6c")
+_ASF_STREAM_PROPERTIES = bytes.fromhex("9107dcb7b7a9cf118ee600c00c205365")
+_ASF_AUDIO_MEDIA = bytes.fromhex("409e69f84d5bcf11a8fd00805f5c442b")
+_ASF_FORMATS = {
+    0x0160: "wmav1",
+    0x0161: "wmav2",
+    0x0162: "wmapro",
+    0x0163: "wmalossless",
+}
+
+# MP4 sample entries and the codecs they map to. mp4a is handled separately, as it may contain several codecs
+_MP4_CODECS = {
+    b"alac": "alac",
+    b"fLaC": "flac",
+    b"Opus": "opus",
+    b"ac-3": "ac3",
+    b"ec-3": "eac3",
+}
+# MPEG-4 object type indications used in the esds box of mp4a sample entries
+_MP4_OBJECT_TYPES = {
+    0x40: "aac",
+    0x66: "aac",
+    0x67: "aac",
+    0x68: "aac",
+    0x69: "mp3",
+    0x6B: "mp3",
+}
+
+
+class SniffStats:
+    """Counts how many files could be classified from their headers alone.
+
+    The counters are shared by all threads, so that parallel scans can report a combined hit rate.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.fallbacks = 0
+
+    def record(self, hit: bool) -> None:
+        """Count a classified file.
+
+        Args:
+            hit (bool): True if the file was classified from its header, False if ffprobe had to be called.
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.fallbacks += 1
+
+    def reset(self) -> None:
+        """Reset all counters to zero."""
+        with self._lock:
+            self.hits = 0
+            self.fallbacks = 0
+
+    def report(self) -> str:
+        """Summarize the counters in a human-readable form.
+
+        Returns:
+            str: The number of files classified and the hit rate.
+        """
+        total = self.hits + self.fallbacks
+        rate = self.hits / total * 100 if total else 0
+        return (f"{self.hits} of {total} files classified from their headers ({rate:.1f}%), "
+                f"{self.fallbacks} needed ffprobe")
+
+
+class StreamInfo(NamedTuple):
+    """Properties of the audio stream in a file, as far as they can be read from its header.
+
+    Attributes:
+        duration: Length of the audio in seconds.
+        sample_rate: Sample rate of the audio in Hz.
+    """
+    duration: float
+    sample_rate: int
+
+
+stats = SniffStats()
+"""Hit rate of all calls to sniff_codecs() that were recorded by File.determine_type()."""
+
+
+def sniff_codecs(path: Path) -> Union[List[str], None]:
+    """Determine the audio codecs used in a file by reading its header.
+
+    Args:
+        path (Path): The file to examine.
+
+    Returns:
+        Union[List[str], None]: The names of the audio codecs in the file, as reported by ffprobe.
+            An empty list if the file is known not to contain audio, None if the file could not be identified.
+    """
+    return sniff_file(path)[0]
+
+
+def sniff_file(path: Path) -> Tuple[Union[List[str], None], Union[StreamInfo, None]]:
+    """Determine the audio codecs used in a file and the properties of its audio stream by reading its header.
+
+    The stream properties are currently only read from FLAC files, which store them in a fixed position.
+
+    Args:
+        path (Path): The file to examine.
+
+    Returns:
+        Tuple[Union[List[str], None], Union[StreamInfo, None]]: The audio codecs, see sniff_codecs(),
+            and the properties of the audio stream. The properties are None if they could not be read.
+    """
+    try:
+        with path.open("rb") as f:
+            header = f.read(HEADER_SIZE)
+            return _sniff(f, header), _sniff_stream_info(header)
+    except OSError as e:
+        logger.debug(f"Could not read header of {path}: {repr(e)}")
+        return None, None
+    except (struct.error, IndexError, KeyError):
+        # Truncated or corrupt header structures
+        return None, None
+
+
+def _sniff(f: BinaryIO, header: bytes) -> Union[List[str], None]:
+    """Identify a file from its header.
+
+    Args:
+        f (BinaryIO): The open file, for formats that need to read more than the header.
+        header (bytes): The first HEADER_SIZE bytes of the file.
+    """
+    if not header:
+        return []
+    if header.startswith(b"fLaC"):
+        return ["flac"]
+    if header.startswith(b"ID3"):
+        return _sniff_id3(f, header)
+    if header[:4] == b"RIFF" and header[8:12] == b"WAVE":
+        return _sniff_wave(header)
+    if header[:4] == b"FORM" and header[8:12] in (b"AIFF", b"AIFC"):
+        return _sniff_aiff(header)
+    if header.startswith(b"OggS"):
+        return _sniff_ogg(header)
+    if header.startswith(_ASF_HEADER):
+        return _sniff_asf(f, header)
+    if header[4:8] == b"ftyp":
+        return _sniff_mp4(f)
+    codec = _sniff_frames(header, 0)
+    if codec:
+        return [codec]
+    if any(header.startswith(signature) for signature in _OTHER_SIGNATURES):
+        return []
+    if header.translate(None, _BINARY_BYTES) == header:
+        # No control characters, so this is most likely a text file (.cue, .log, .txt, ...)
+        return []
+    return None
+
+
+def _sniff_stream_info(header: bytes) -> Union[StreamInfo, None]:
+    """Read the duration and sample rate from the STREAMINFO block of a FLAC file."""
+    # STREAMINFO is always the first metadata block, following the 4 byte signature and the 4 byte block header.
+    # Its fields after the block and frame sizes are packed into 64 bits: 20 bits sample rate, 3 bits channels,
+    # 5 bits sample size and 36 bits total number of samples
+    if not header.startswith(b"fLaC") or len(header) < 26 or header[4] & 0x7f != 0:
+        return None
+    packed = int.from_bytes(header[18:26], "big")
+    sample_rate = packed >> 44
+    samples = packed & 0xfffffffff
+    if not sample_rate or not samples:
+        # The number of samples is unknown if the encoder could not seek back to write it
+        return None
+    return StreamInfo(samples / sample_rate, sample_rate)
+
+
+def _sniff_id3(f: BinaryIO, header: bytes) -> Union[List[str], None]:
+    """Skip an ID3v2 tag and identify the audio data following it."""
+    # The tag size is stored as a 28 bit "syncsafe" integer, excluding the 10 byte header and optional footer
+    size = 10 + ((header[6] & 0x7f) << 21 | (header[7] & 0x7f) << 14 | (header[8] & 0x7f) << 7 | (header[9] & 0x7f))
+    if header[5] & 0x10:
+        size += 10
+    if size + HEADER_SIZE // 2 > len(header):
+        # Make sure that at least two MPEG frames are available after the tag
+        f.seek(size)
+        header = f.read(HEADER_SIZE)
+        size = 0
+    if header[size:size + 4] == b"fLaC":
+        return ["flac"]
+    codec = _sniff_frames(header, size)
+    return [codec] if codec else None
+
+
+def _sniff_frames(header: bytes, offset: int) -> Union[str, None]:
+    """Identify raw MPEG audio or ADTS AAC frames.
+
+    Frame sync patterns may appear by chance in other files, so the frame following the first one must
+    also be found at the expected position.
+
+    Args:
+        header (bytes): The data to examine.
+        offset (int): Position of the first frame.
+
+    Returns:
+        Union[str, None]: The codec of the frames, None if there are no valid frames at the given position.
+    """
+    first = _parse_frame(header, offset)
+    if not first:
+        return None
+    codec, length = first
+    second = _parse_frame(header, offset + length)
+    if not second or second[0] != codec:
+        return None
+    return codec
+
+
+def _parse_frame(header: bytes, offset: int) -> Union[Tuple[str, int], None]:
+    """Parse the header of a single MPEG audio or ADTS frame.
+
+    Returns:
+        Union[Tuple[str, int], None]: The codec and length of the frame, None if there is no valid frame at offset.
+    """
+    frame = header[offset:offset + 6]
+    if len(frame) < 6 or frame[0] != 0xff or frame[1] & 0xe0 != 0xe0:
+        return None
+
+    if frame[1] & 0xf6 == 0xf0:
+        # ADTS header: 12 bit sync word and layer 0
+        length = (frame[3] & 0x03) << 11 | frame[4] << 3 | frame[5] >> 5
+        return ("aac", length) if length > 7 else None
+
+    version = (frame[1] >> 3) & 0x03  # 0: MPEG-2.5, 1: reserved, 2: MPEG-2, 3: MPEG-1
+    layer = 4 - ((frame[1] >> 1) & 0x03)  # 4 is reserved
+    bitrate_index = frame[2] >> 4
+    sample_rate_index = (frame[2] >> 2) & 0x03
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        # Free-format streams are valid, but rare enough to leave them to ffprobe
+        return None
+    mpeg1 = version == 3
+    bitrate = _MPEG_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = _MPEG_SAMPLE_RATES[sample_rate_index] >> (3 - version if version else 2)
+    padding = (frame[2] >> 1) & 0x01
+    if layer == 1:
+        length = (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 3 and not mpeg1:
+        length = 72 * bitrate // sample_rate + padding
+    else:
+        length = 144 * bitrate // sample_rate + padding
+    return f"mp{layer}", length
+
+
+def _sniff_wave(header: bytes) -> Union[List[str], None]:
+    """Read the codec from the fmt chunk of a RIFF/WAVE file."""
+    fmt = _find_chunk(header, 12, b"fmt ", "<I")
+    if fmt is None:
+        return None
+    format_tag, bits = struct.unpack_from("<H", header, fmt)[0], struct.unpack_from("<H", header, fmt + 14)[0]
+    if format_tag == 0xfffe:
+        # WAVE_FORMAT_EXTENSIBLE, the actual format is stored in the first two bytes of the subformat GUID
+        format_tag = struct.unpack_from("<H", header, fmt + 24)[0]
+    if format_tag == 0x0001:
+        return ["pcm_u8" if bits == 8 else f"pcm_s{bits}le"] if bits in (8, 16, 24, 32) else None
+    if format_tag == 0x0003:
+        return [f"pcm_f{bits}le"] if bits in (32, 64) else None
+    return [_WAVE_FORMATS[format_tag]] if format_tag in _WAVE_FORMATS else None
+
+
+def _sniff_aiff(header: bytes) -> Union[List[str], None]:
+    """Read the codec from the COMM chunk of an AIFF or AIFF-C file."""
+    comm = _find_chunk(header, 12, b"COMM", ">I")
+    if comm is None:
+        return None
+    bits = struct.unpack_from(">H", header, comm + 6)[0]
+    compression = header[comm + 18:comm + 22] if header[8:12] == b"AIFC" else b"NONE"
+    if compression in (b"NONE", b"twos", b"sowt"):
+        endianness = "le" if compression == b"sowt" else "be"
+        if bits == 8:
+            return ["pcm_s8"]
+        return [f"pcm_s{bits}{endianness}"] if bits in (16, 24, 32) else None
+    return [_AIFC_FORMATS[compression]] if compression in _AIFC_FORMATS else None
+
+
+def _find_chunk(header: bytes, offset: int, chunk_id: bytes, size_format: str) -> Union[int, None]:
+    """Find a chunk in an IFF-style file (RIFF, AIFF).
+
+    Args:
+        header (bytes): The file header.
+        offset (int): Position of the first chunk.
+        chunk_id (bytes): The four character ID of the chunk to find.
+        size_format (str): struct format of the chunk size field, which depends on the endianness of the format.
+
+    Returns:
+        Union[int, None]: The position of the chunk data, None if the chunk is not within the header.
+    """
+    while offset + 8 <= len(header):
+        size = struct.unpack_from(size_format, header, offset + 4)[0]
+        if header[offset:offset + 4] == chunk_id:
+            return offset + 8
+        # Chunks are padded to an even size
+        offset += 8 + size + (size & 1)
+    return None
+
+
+def _sniff_ogg(header: bytes) -> Union[List[str], None]:
+    """Identify the logical streams of an Ogg file from their first pages."""
+    codecs = []
+    offset = 0
+    # Every logical stream starts with a page that has the "beginning of stream" flag set, all of which come first
+    while header[offset:offset + 4] == b"OggS" and header[offset + 5] & 0x02:
+        segments = header[offset + 26]
+        packet = offset + 27 + segments
+        for signature, codec in _OGG_CODECS.items():
+            if header[packet:packet + len(signature)] == signature:
+                codecs.append(codec)
+                break
+        else:
+            # Video or other streams that we don't know about
+            return None
+        offset = packet + sum(header[offset + 27:packet])
+    return codecs or None
+
+
+def _sniff_asf(f: BinaryIO, header: bytes) -> Union[List[str], None]:
+    """Read the codecs of all audio streams from the header object of an ASF (WMA) file."""
+    size, count = struct.unpack_from("<QI", header, 16)
+    if size > MAX_HEADER_SIZE:
+        return None
+    if size > len(header):
+        f.seek(0)
+        header = f.read(size)
+
+    codecs = []
+    offset = 30
+    for _ in range(count):
+        guid = header[offset:offset + 16]
+        object_size = struct.unpack_from("<Q", header, offset + 16)[0]
+        if object_size < 24:
+            return None
+        if guid == _ASF_STREAM_PROPERTIES and header[offset + 24:offset + 40] == _ASF_AUDIO_MEDIA:
+            # The type-specific data is a WAVEFORMATEX structure, starting with the format tag
+            format_tag = struct.unpack_from("<H", header, offset + 78)[0]
+            if format_tag not in _ASF_FORMATS:
+                return None
+            codecs.append(_ASF_FORMATS[format_tag])
+        offset += object_size
+    return codecs or None
+
+
+def _sniff_mp4(f: BinaryIO) -> Union[List[str], None]:
+    """Read the codecs of all audio tracks from the moov box of an MP4/M4A file."""
+    moov = _read_box(f, b"moov")
+    if moov is None:
+        return None
+
+    codecs = []
+    for trak in _iter_boxes(moov, b"trak"):
+        mdia = next(_iter_boxes(trak, b"mdia"), b"")
+        hdlr = next(_iter_boxes(mdia, b"hdlr"), b"")
+        if hdlr[8:12] != b"soun":
+            # Not an audio track
+            continue
+        stbl = next(_iter_boxes(next(_iter_boxes(mdia, b"minf"), b""), b"stbl"), b"")
+        stsd = next(_iter_boxes(stbl, b"stsd"), b"")
+        # The stsd box starts with a version, flags and entry count, followed by the sample entries
+        entry_type = stsd[12:16]
+        if entry_type == b"mp4a":
+            codec = _mp4a_codec(stsd[8:])
+        else:
+            codec = _MP4_CODECS.get(entry_type)
+        if codec is None:
+            return None
+        codecs.append(codec)
+    # Files without audio tracks are left to ffprobe, in case the moov box uses a structure we don't support
+    return codecs or None
+
+
+def _mp4a_codec(entry: bytes) -> Union[str, None]:
+    """Determine the codec of an mp4a sample entry from its esds box."""
+    size = struct.unpack_from(">I", entry)[0]
+    # Audio sample entries have 28 bytes of fields, plus 16 or 36 more in version 1 and 2 of the QuickTime format
+    version = struct.unpack_from(">H", entry, 16)[0]
+    offset = 8 + 28 + {0: 0, 1: 16, 2: 36}[version]
+    esds = next(_iter_boxes(entry[offset:size], b"esds"), None)
+    if esds is None:
+        return None
+
+    # Skip the version and flags, then walk down to the DecoderConfigDescriptor
+    position = 4
+    if esds[position] != 0x03:
+        return None
+    position = _skip_descriptor_size(esds, position + 1)
+    es_flags = esds[position + 2]
+    position += 3
+    if es_flags & 0x80:
+        position += 2
+    if es_flags & 0x40:
+        position += 1 + esds[position]
+    if es_flags & 0x20:
+        position += 2
+    if esds[position] != 0x04:
+        return None
+    position = _skip_descriptor_size(esds, position + 1)
+    return _MP4_OBJECT_TYPES.get(esds[position])
+
+
+def _skip_descriptor_size(data: bytes, position: int) -> int:
+    """Skip the variable-length size of an MPEG-4 descriptor and return the position of its contents."""
+    while data[position] & 0x80:
+        position += 1
+    return position + 1
+
+
+def _read_box(f: BinaryIO, box_type: bytes) -> Union[bytes, None]:
+    """Find a top-level box in an MP4 file by seeking from box to box and read its contents.
+
+    Returns:
+        Union[bytes, None]: The contents of the box, None if it was not found or is too large.
+    """
+    offset = 0
+    while True:
+        f.seek(offset)
+        box_header = f.read(16)
+        if len(box_header) < 8:
+            return None
+        size, found_type = struct.unpack_from(">I4s", box_header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", box_header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            # The box extends to the end of the file
+            size = MAX_HEADER_SIZE + 1
+        if size < header_size:
+            return None
+        if found_type == box_type:
+            if size > MAX_HEADER_SIZE:
+                return None
+            f.seek(offset + header_size)
+            return f.read(size - header_size)
+        offset += size
+
+
+def _iter_boxes(data: bytes, box_type: bytes) -> Iterator[bytes]:
+    """Yield the contents of all boxes of the given type within data."""
+    offset = 0
+    while offset + 8 <= len(data):
+        size, found_type = struct.unpack_from(">I4s", data, offset)
+        if size < 8:
+            return
+        if found_type == box_type:
+            yield data[offset + 8:offset + size]
+        offset += size
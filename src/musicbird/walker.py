@@ -0,0 +1,242 @@
+"""Provides a fast, parallel walker for the music library filesystem.
+
+This module provides the LibraryWalker class, which lists a directory tree using os.scandir and yields a
+File object for every regular file it finds. Directory listings and stat calls are spread across a thread pool,
+which greatly speeds up walks on high-latency filesystems such as network mounts.
+
+The walker can also use an index of previous directory listings. A directory whose modification time has not changed
+since it was indexed still has the same entries, so its listing can be reused instead of listing it again.
+"""
+
+import concurrent.futures
+import logging
+import os
+from pathlib import Path
+import stat
+from typing import Dict, Iterator, List, NamedTuple, Set, Tuple, Union
+
+from .file import File
+from .ignore import IgnoreRules
+
+logger = logging.getLogger(__name__)
+
+
+class Directory(NamedTuple):
+    """A directory listing, as stored in the directory index.
+
+    Attributes:
+        path: The path of the directory.
+        mtime_ns: The modification time of the directory in nanoseconds, at the time it was listed.
+        children: The names of all files in the directory and the names of all subdirectories followed by a slash.
+    """
+    path: Path
+    mtime_ns: int
+    children: List[str]
+
+
+class _Entry(NamedTuple):
+    """A single entry in a directory listing, as returned by LibraryWalker._list_dir()."""
+    path: Path
+    is_dir: bool
+    stat: os.stat_result
+
+
+class _Listing(NamedTuple):
+    """The result of LibraryWalker._list_dir()."""
+    entries: List[_Entry]
+    # The new listing if the directory was listed, None if the listing from the index was reused
+    directory: Union[Directory, None]
+    # Whether the files in the directory were skipped, as the directory is unchanged and trust_dirs is set
+    trusted: bool
+
+
+class LibraryWalker:
+    """Walk a directory tree and yield all files within it.
+
+    Files are yielded in ascending order of their full path string, which is the same order used by
+    the database when sorting by path. This allows callers to merge the walk with other sorted sources.
+
+    Each directory is listed by a worker thread. Once a directory has been listed, the listings of all its
+    subdirectories are scheduled right away, so that multiple metadata requests are in flight at the same time.
+
+    Attributes:
+        failed: True if at least one directory could not be listed during the last walk.
+        changed_dirs: Listings of all directories that were not in the index or have changed since they were indexed.
+            Only filled if an index is used.
+        visited_dirs: All directories that were walked. Only filled if an index is used.
+        trusted_dirs: Unchanged directories whose files were not yielded, as trust_dirs is set.
+    """
+
+    def __init__(self, path: Path, threads: int = 1, ignore: IgnoreRules = None,
+                 index: Dict[Path, Directory] = None, trust_dirs: bool = False) -> None:
+        """Create a new walker for the given directory.
+
+        Args:
+            path (Path): The directory to walk.
+            threads (int, optional): Number of threads used to list directories. Defaults to 1.
+            ignore (IgnoreRules, optional): Rules for files and directories to skip. Excluded directories are
+                not descended into. Defaults to None.
+            index (Dict[Path, Directory], optional): Previous listings of directories, by their path.
+                Listings of unchanged directories are reused and only their files are stat'ed. Defaults to None.
+            trust_dirs (bool, optional): Don't stat or yield the files in unchanged directories at all.
+                Modifications of files that don't change their directory are missed in this mode. Defaults to False.
+        """
+        self.path = path
+        self.threads = threads
+        self.ignore = ignore
+        self.index = index
+        self.trust_dirs = trust_dirs
+        self.failed = False
+        self.changed_dirs: List[Directory] = []
+        self.visited_dirs: Set[Path] = set()
+        self.trusted_dirs: Set[Path] = set()
+
+    def walk(self) -> Iterator[File]:
+        """Walk the directory tree.
+
+        Symbolic links to files are followed, symbolic links to directories are not.
+
+        Yields:
+            File: A File object for each regular file in the tree, in ascending path order.
+        """
+        self.failed = False
+        self.changed_dirs = []
+        self.visited_dirs = set()
+        self.trusted_dirs = set()
+        with concurrent.futures.ThreadPoolExecutor(self.threads) as executor:
+            yield from self._walk_dir(executor, self.path, executor.submit(self._list_dir, self.path))
+
+    def _walk_dir(self, executor: concurrent.futures.Executor, path: Path,
+                  listing: "concurrent.futures.Future[_Listing]") -> Iterator[File]:
+        """Yield the files from a directory listing, descending into subdirectories as they come up.
+
+        Args:
+            executor (concurrent.futures.Executor): Executor used to list subdirectories.
+            path (Path): The directory to walk.
+            listing (Future[_Listing]): The pending listing of the directory.
+        """
+        entries, directory, trusted = listing.result()
+        if self.index is not None:
+            self.visited_dirs.add(path)
+            if directory:
+                self.changed_dirs.append(directory)
+        if trusted:
+            # Must be registered before any files after this directory are yielded, see LibraryScanner.scan()
+            self.trusted_dirs.add(path)
+        # Start listing all subdirectories now so that their results are ready once we get to them
+        subdirs = {entry.path: executor.submit(self._list_dir, entry.path) for entry in entries if entry.is_dir}
+
+        for entry in entries:
+            if entry.is_dir:
+                yield from self._walk_dir(executor, entry.path, subdirs[entry.path])
+            else:
+                yield File(entry.path, mtime=round(entry.stat.st_mtime), mtime_ns=entry.stat.st_mtime_ns,
+                           size=entry.stat.st_size, dev=entry.stat.st_dev, inode=entry.stat.st_ino)
+
+    def _list_dir(self, path: Path) -> _Listing:
+        """List a single directory and stat its files, or reuse its indexed listing if it is unchanged.
+
+        Entries are sorted so that the walk yields files in order of their full path string.
+        To achieve this, directories are sorted as if their name ended with a slash.
+
+        Args:
+            path (Path): The directory to list.
+
+        Returns:
+            _Listing: The sorted directory contents, excluding ignored files.
+        """
+        if self.index is None:
+            return _Listing(self._scan_dir(path)[0], None, False)
+        try:
+            # Stat before listing: if the directory changes in between, it is listed again on the next walk
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError as e:
+            logger.error(f"Could not access directory {path}: {repr(e)}")
+            self.failed = True
+            return _Listing([], None, False)
+
+        indexed = self.index.get(path)
+        if indexed and indexed.mtime_ns == mtime_ns:
+            return _Listing(self._reuse_dir(path, indexed.children), None, self.trust_dirs)
+        entries, children = self._scan_dir(path)
+        return _Listing(entries, Directory(path, mtime_ns, children) if children is not None else None, False)
+
+    def _scan_dir(self, path: Path) -> Tuple[List[_Entry], Union[List[str], None]]:
+        """List a directory with os.scandir and stat its files.
+
+        Args:
+            path (Path): The directory to list.
+
+        Returns:
+            Tuple[List[_Entry], Union[List[str], None]]: The sorted directory contents, excluding ignored files,
+                and the names of all children in the format used by Directory.children.
+                The names are None if the directory could not be listed completely.
+        """
+        entries: List[_Entry] = []
+        children: List[str] = []
+        complete = True
+        try:
+            with os.scandir(path) as it:
+                for dir_entry in it:
+                    try:
+                        if dir_entry.is_dir(follow_symlinks=False):
+                            children.append(dir_entry.name + "/")
+                            if not self._is_ignored(dir_entry.path, True):
+                                entries.append(_Entry(Path(dir_entry.path), True, None))
+                        elif dir_entry.is_file():
+                            children.append(dir_entry.name)
+                            if not self._is_ignored(dir_entry.path, False):
+                                # DirEntry caches the stat result, so this is the only stat call for this file
+                                entries.append(_Entry(Path(dir_entry.path), False, dir_entry.stat()))
+                    except OSError as e:
+                        logger.warning(f"Could not access {dir_entry.path}, skipping: {repr(e)}")
+                        # Don't index the listing, so that the entry is retried next time
+                        complete = False
+        except OSError as e:
+            logger.error(f"Could not list directory {path}: {repr(e)}")
+            self.failed = True
+            return [], None
+
+        return _sort_entries(entries), children if complete else None
+
+    def _reuse_dir(self, path: Path, children: List[str]) -> List[_Entry]:
+        """Build the contents of an unchanged directory from its indexed listing.
+
+        Files are stat'ed individually, unless trust_dirs is set, in which case they are skipped.
+
+        Args:
+            path (Path): The directory.
+            children (List[str]): The indexed children of the directory.
+
+        Returns:
+            List[_Entry]: The sorted directory contents, excluding ignored files.
+        """
+        entries: List[_Entry] = []
+        for child in children:
+            is_dir = child.endswith("/")
+            name = child.rstrip("/")
+            if self._is_ignored(path.joinpath(name), is_dir):
+                continue
+            if is_dir:
+                entries.append(_Entry(path.joinpath(name), True, None))
+            elif not self.trust_dirs:
+                try:
+                    file_stat = os.stat(path.joinpath(name))
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    logger.warning(f"Could not access {path.joinpath(name)}, skipping: {repr(e)}")
+                    continue
+                # The target of a symbolic link may have changed to something that isn't a file anymore
+                if stat.S_ISREG(file_stat.st_mode):
+                    entries.append(_Entry(path.joinpath(name), False, file_stat))
+        return _sort_entries(entries)
+
+    def _is_ignored(self, path: Union[Path, str], is_dir: bool) -> bool:
+        return self.ignore is not None and self.ignore.match(path, is_dir)
+
+
+def _sort_entries(entries: List[_Entry]) -> List[_Entry]:
+    """Sort directory entries in the order of their paths, sorting directories as if their name ended with a slash."""
+    entries.sort(key=lambda entry: entry.path.name + "/" if entry.is_dir else entry.path.name)
+    return entries
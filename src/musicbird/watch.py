@@ -0,0 +1,121 @@
+"""Provides the watch command, which keeps the mirror library in sync as the source library changes.
+"""
+
+import argparse
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Set
+
+from .db import LibraryDB, init as init_db
+from .fingerprint import init as init_detector
+from .jobs import init as init_jobs
+from .probecache import init as init_probe_cache
+from .scanner import LibraryScanner
+from .watcher import Watcher, init as init_watcher
+from .move import move
+from .copy import copy
+from .encode import encode
+from .prune import prune
+
+logger = logging.getLogger(__name__)
+
+# Maximum time to block while waiting for changes, so that a stop request is noticed in time
+_WAIT_INTERVAL = 1.0
+
+
+def watch_command(parent_parser: argparse.ArgumentParser, args: List[str], config: Dict) -> bool:
+    """Entrypoint for the CLI `watch` command.
+
+    Args:
+        parent_parser (argparse.ArgumentParser): The parser from the main entrypoint.
+            Used to display a full --help output by inheriting its arguments.
+        args (List[str]): List of arguments not parsed by the main parser.
+        config (Dict): Dictionary containing the MusicBird configuration
+    """
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description=__doc__, prog="musicbird", parents=[parent_parser])
+    parser.parse_args(args)
+    return watch(config, init_db(config))
+
+
+def watch(config: Dict, db: LibraryDB, stop: threading.Event = None) -> bool:
+    """Process the entire music library, then keep processing changes until stopped.
+
+    Starts watching the source library, then runs a full scan and processes all files like `run`.
+    After that, every burst of changes is collected until no new changes come in for `watch.debounce` seconds
+    (but for at most `watch.max_delay` seconds), then only the changed paths are scanned and processed.
+    The DB and the probe cache stay open the whole time.
+
+    Args:
+        config (Dict): Dictionary containing the musicbird configuration.
+        db (LibraryDB): Database object to read/write the library status from/to.
+        stop (threading.Event, optional): Stop watching once this event is set. Defaults to None,
+            in which case the command runs until interrupted.
+
+    Returns:
+        bool: True if the last round of changes was processed successfully, False if not.
+    """
+    stop = stop or threading.Event()
+    # Start watching before the initial scan, so that no changes made during it are missed
+    watcher = init_watcher(config)
+    probe_cache = init_probe_cache(config)
+    runner = init_jobs(config)
+    scanner = LibraryScanner(config["source"], db, threads=config["scan"]["threads"], probe_threads=config["threads"],
+                             probe_cache=probe_cache, detector=init_detector(config),
+                             fast_rescan=config["scan"]["fast_rescan"], ignore=config["scan"]["ignore"])
+    logger.info(f"Watching {watcher.path} for changes with {type(watcher).__name__}")
+    result = False
+    try:
+        result = _process(config, db, scanner.scan())
+        while not stop.is_set():
+            changed = _collect(watcher, config["watch"]["debounce"], config["watch"]["max_delay"])
+            if changed:
+                logger.info(f"Processing {len(changed)} changed paths")
+                result = _process(config, db, scanner.update_paths(changed))
+    except KeyboardInterrupt:
+        runner.cancel_all()
+        logger.info("Stopped watching")
+    finally:
+        watcher.close()
+        if probe_cache:
+            probe_cache.close()
+    return result
+
+
+def _collect(watcher: Watcher, debounce: float, max_delay: float) -> Set[Path]:
+    """Wait for changes, then keep collecting them until the watched directory settles down.
+
+    Args:
+        watcher (Watcher): The watcher to read changes from.
+        debounce (float): Time without new changes after which a burst is considered complete, in seconds.
+        max_delay (float): Maximum time to collect changes for, so that constant changes don't delay processing
+            indefinitely, in seconds.
+
+    Returns:
+        Set[Path]: The changed paths, empty if there were no changes within _WAIT_INTERVAL.
+    """
+    changed = watcher.read(_WAIT_INTERVAL)
+    if not changed:
+        return changed
+    deadline = time.monotonic() + max_delay
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        more = watcher.read(min(debounce, remaining))
+        if not more:
+            break
+        changed.update(more)
+    return changed
+
+
+def _process(config: Dict, db: LibraryDB, scan_result: bool) -> bool:
+    """Run all processing steps on the queued files, like `run` does after scanning."""
+    results = [scan_result]
+    results.append(move(config, db))
+    results.append(copy(config, db))
+    results.append(encode(config, db))
+    results.append(prune(config, db))
+    return False not in results
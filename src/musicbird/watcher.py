@@ -0,0 +1,250 @@
+"""Provides watchers that report changed paths in the music library filesystem.
+
+The InotifyWatcher subscribes to inotify events for every directory in the library, which reports changes
+as they happen without reading the library. The PollingWatcher is a fallback for systems and filesystems without
+inotify support (such as network mounts), which periodically walks the library and compares the results.
+"""
+
+from abc import ABC, abstractmethod
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+from pathlib import Path
+import select
+import struct
+import time
+from typing import Dict, Set, Tuple
+
+from .ignore import IgnoreRules
+from .walker import LibraryWalker
+
+logger = logging.getLogger(__name__)
+
+
+class Watcher(ABC):
+    """Interface for filesystem watchers.
+
+    Attributes:
+        path: The directory that is being watched.
+        ignore: Rules for files and directories whose changes are not reported, None to report all changes.
+    """
+
+    def __init__(self, path: Path, ignore: IgnoreRules = None) -> None:
+        self.path = path
+        self.ignore = ignore
+
+    @abstractmethod
+    def read(self, timeout: float) -> Set[Path]:
+        """Wait for changes in the watched directory.
+
+        Args:
+            timeout (float): Maximum time to wait for changes, in seconds.
+
+        Returns:
+            Set[Path]: The files and directories that have changed since the last call, empty if there are none.
+                A changed directory means that anything below it might have changed.
+        """
+
+    def close(self) -> None:
+        """Stop watching and release all resources."""
+
+
+class InotifyWatcher(Watcher):
+    """Watch a directory tree with the Linux inotify API.
+
+    inotify is not recursive, so every directory in the tree is watched individually, except for ignored ones.
+    The number of watches per user is limited by the fs.inotify.max_user_watches sysctl.
+    """
+
+    # Flags and event types from <sys/inotify.h>
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+
+    # Files are only reported once they have been closed after writing, not on every write
+    _MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+    # struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+    _EVENT = struct.Struct("iIII")
+    _READ_SIZE = 64 * 1024
+
+    def __init__(self, path: Path, ignore: IgnoreRules = None) -> None:
+        """Start watching a directory tree.
+
+        Args:
+            path (Path): The directory to watch.
+            ignore (IgnoreRules, optional): Rules for directories that should not be watched. Defaults to None.
+
+        Raises:
+            OSError: If inotify is not available or the tree could not be watched.
+        """
+        super().__init__(path, ignore)
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self._libc.inotify_init1
+        except (OSError, AttributeError) as e:
+            raise OSError(errno.ENOSYS, f"inotify is not available: {repr(e)}")
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "Could not initialize inotify")
+        # Watched directories by their watch descriptor
+        self._dirs: Dict[int, Path] = {}
+        try:
+            self._add_tree(path)
+        except OSError:
+            self.close()
+            raise
+
+    def read(self, timeout: float) -> Set[Path]:
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+        changed: Set[Path] = set()
+        while True:
+            try:
+                data = os.read(self._fd, InotifyWatcher._READ_SIZE)
+            except BlockingIOError:
+                break
+            self._parse(data, changed)
+        return changed
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _parse(self, data: bytes, changed: Set[Path]) -> None:
+        """Parse a buffer of inotify events and add the paths they refer to to changed."""
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = InotifyWatcher._EVENT.unpack_from(data, offset)
+            offset += InotifyWatcher._EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & InotifyWatcher.IN_Q_OVERFLOW:
+                logger.warning("inotify event queue overflowed, rescanning the entire library")
+                changed.add(self.path)
+                continue
+            if mask & InotifyWatcher.IN_IGNORED:
+                # The directory was removed, its parent reports the deletion
+                self._dirs.pop(wd, None)
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None:
+                continue
+            path = directory.joinpath(name) if name else directory
+            if name and self.ignore and self.ignore.match(path, bool(mask & InotifyWatcher.IN_ISDIR)):
+                continue
+            if mask & InotifyWatcher.IN_ISDIR:
+                if mask & (InotifyWatcher.IN_CREATE | InotifyWatcher.IN_MOVED_TO):
+                    # Files may have been added to the directory before it was watched, so it is reported as a whole
+                    try:
+                        self._add_tree(path)
+                    except OSError as e:
+                        logger.warning(f"Could not watch directory {path}: {repr(e)}")
+                elif mask & InotifyWatcher.IN_MOVED_FROM:
+                    self._remove_tree(path)
+            changed.add(path)
+
+    def _add_tree(self, path: Path) -> None:
+        """Watch a directory and all directories below it."""
+        if path != self.path and self.ignore and self.ignore.is_ignored(path):
+            return
+        for directory, subdirs, _ in os.walk(path):
+            if self.ignore:
+                subdirs[:] = [name for name in subdirs if not self.ignore.match(os.path.join(directory, name), True)]
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), InotifyWatcher._MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    # Removed while walking
+                    continue
+                if error == errno.ENOSPC:
+                    raise OSError(error, "inotify watch limit reached, consider raising fs.inotify.max_user_watches")
+                raise OSError(error, f"Could not watch directory {directory}")
+            # Watching a directory again (e.g. after it was moved) returns the existing descriptor
+            self._dirs[wd] = Path(directory)
+
+    def _remove_tree(self, path: Path) -> None:
+        """Stop watching a directory and all directories below it, after it was moved elsewhere."""
+        for wd, directory in list(self._dirs.items()):
+            if directory == path or path in directory.parents:
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._dirs[wd]
+
+
+class PollingWatcher(Watcher):
+    """Watch a directory tree by walking it at a fixed interval and comparing the results.
+
+    The mtime and size of all files is kept in memory between walks.
+    """
+
+    def __init__(self, path: Path, interval: float, threads: int = 1, ignore: IgnoreRules = None) -> None:
+        """Start watching a directory tree.
+
+        Args:
+            path (Path): The directory to watch.
+            interval (float): Time between walks, in seconds.
+            threads (int, optional): Number of threads used to walk the tree. Defaults to 1.
+            ignore (IgnoreRules, optional): Rules for files and directories that should not be walked.
+                Defaults to None.
+        """
+        super().__init__(path, ignore)
+        self.interval = interval
+        self._walker = LibraryWalker(path, threads, ignore)
+        self._snapshot = self._walk()
+        self._next_poll = time.monotonic() + interval
+
+    def read(self, timeout: float) -> Set[Path]:
+        remaining = self._next_poll - time.monotonic()
+        if remaining > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(remaining, 0))
+        self._next_poll = time.monotonic() + self.interval
+
+        snapshot = self._walk()
+        if self._walker.failed:
+            logger.warning(f"Some directories in {self.path} could not be read, skipping this poll")
+            return set()
+        changed = {Path(path) for path in snapshot.keys() ^ self._snapshot.keys()}
+        changed.update(Path(path) for path, stat in snapshot.items() if self._snapshot.get(path, stat) != stat)
+        self._snapshot = snapshot
+        return changed
+
+    def _walk(self) -> Dict[str, Tuple[int, int]]:
+        return {str(file.path): (file.mtime_ns, file.size) for file in self._walker.walk()}
+
+
+def init(config: Dict) -> Watcher:
+    """Create the watcher selected in the config for the source library.
+
+    Args:
+        config (Dict): MusicBirds configuration
+
+    Returns:
+        Watcher: The watcher. If inotify is selected automatically but not available, a PollingWatcher is returned.
+
+    Raises:
+        OSError: If inotify was explicitly selected, but could not be used.
+    """
+    path = Path(config["source"])
+    ignore = IgnoreRules(path, config["scan"]["ignore"])
+    method = config["watch"]["method"]
+    if method in ("auto", "inotify"):
+        try:
+            return InotifyWatcher(path, ignore)
+        except OSError as e:
+            if method == "inotify":
+                raise
+            logger.warning(f"Could not watch library with inotify, falling back to polling: {repr(e)}")
+    return PollingWatcher(path, config["watch"]["poll_interval"], config["scan"]["threads"], ignore)
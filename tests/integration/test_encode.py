@@ -1,12 +1,16 @@
 from pathlib import Path
 import shutil
+import threading
+import time
 from typing import List, Tuple
 
 from musicbird.config import Config
 from musicbird.db import LibraryDB, init as init_db
 from musicbird.file import File
-from musicbird.encode import encode
-from musicbird.file import FileType
+from musicbird.encode import _ResultWriter, encode
+from musicbird.encoder import EncodeResult
+from musicbird.file import EncodeOutcome, FileType, Stage
+from musicbird.jobs import JobCancelledError
 from musicbird.scanner import LibraryScanner
 from musicbird.__main__ import main
 
@@ -84,3 +88,137 @@ def test_encode_command(library_and_db: Tuple[Path, List[File], LibraryDB]):
 
     args = ["-c", str(workdir.joinpath("config.yml")), "encode"]
     assert main(args)
+
+
+def test_encode_window(tmp_path, monkeypatch):
+    library_db = init_db({"database": "sqlite3", "sqlite3": {"path": Path(tmp_path).joinpath("db.sqlite3")}})
+    files = [File(Path(tmp_path).joinpath("library", f"{i:03}.flac"), FileType.LOSSLESS, 1) for i in range(50)]
+    library_db.add_or_update_files(files)
+    library_db.set_queued_stages(files, [Stage.ENCODE])
+    config = {"threads": 2, "lossy_files": "copy", "encode": {"schedule": "queue", "retries": 0, "retry_delay": 0}}
+
+    running = []
+    lock = threading.Lock()
+
+    def encode_to_dest(file, _):
+        with lock:
+            running.append(file.path)
+        time.sleep(0.01)
+        return EncodeResult() if file.path.name != "007.flac" else EncodeResult("error")
+    monkeypatch.setattr(File, "encode_to_dest", encode_to_dest)
+    submitted = []
+    original = library_db.iter_queued_files
+
+    def iter_queued_files(stage, paths=None):
+        for file in original(stage, paths):
+            # Files are only read from the queue once there is room in the submission window
+            with lock:
+                submitted.append(len(submitted) - len(running))
+            yield file
+    monkeypatch.setattr(library_db, "iter_queued_files", iter_queued_files)
+
+    assert not encode(config, library_db)
+    assert max(submitted) <= config["threads"] * 2
+    assert [file.path.name for file in library_db.iter_queued_files(Stage.ENCODE)] == ["007.flac"]
+
+
+def test_encode_schedule(tmp_path, monkeypatch):
+    library_db = init_db({"database": "sqlite3", "sqlite3": {"path": Path(tmp_path).joinpath("db.sqlite3")}})
+    files = [File(Path(tmp_path).joinpath("library", f"{i}.flac"), FileType.LOSSLESS, 1, duration=duration)
+             for i, duration in enumerate([180, 5400, 240, None])]
+    files[3].size = 60000000
+    library_db.add_or_update_files(files)
+    library_db.set_queued_stages(files, [Stage.ENCODE])
+    config = {"threads": 1, "lossy_files": "copy", "encode": {"schedule": "lpt", "retries": 0, "retry_delay": 0}}
+
+    started = []
+    monkeypatch.setattr(File, "encode_to_dest", lambda file, _: started.append(file.path.name) or EncodeResult())
+    assert encode(config, library_db)
+    # The file without a duration is estimated from its size (600s)
+    assert started == ["1.flac", "3.flac", "2.flac", "0.flac"]
+    assert not list(library_db.iter_queued_files(Stage.ENCODE))
+
+
+def test_encode_retry(tmp_path, monkeypatch):
+    library_db = init_db({"database": "sqlite3", "sqlite3": {"path": Path(tmp_path).joinpath("db.sqlite3")}})
+    files = [File(Path(tmp_path).joinpath("library", f"{i}.flac"), FileType.LOSSLESS, 1) for i in range(3)]
+    library_db.add_or_update_files(files)
+    library_db.set_queued_stages(files, [Stage.ENCODE])
+    config = {"threads": 1, "lossy_files": "copy", "encode": {"schedule": "queue", "retries": 2, "retry_delay": 0}}
+
+    attempts = []
+
+    def encode_to_dest(file, _):
+        attempts.append(file.path.name)
+        if file.path.name == "0.flac" and attempts.count("0.flac") == 1:
+            return EncodeResult("error", "Input/output error", True)
+        if file.path.name == "1.flac":
+            return EncodeResult("error", "Invalid data found")
+        if file.path.name == "2.flac":
+            return EncodeResult("error", "Input/output error", True)
+        return EncodeResult()
+    monkeypatch.setattr(File, "encode_to_dest", encode_to_dest)
+
+    assert not encode(config, library_db)
+    # Transient failures are retried until they succeed or run out of retries, others fail right away
+    assert attempts == ["0.flac", "0.flac", "1.flac", "2.flac", "2.flac", "2.flac"]
+    assert [file.path.name for file in library_db.iter_queued_files(Stage.ENCODE)] == ["1.flac", "2.flac"]
+    assert library_db.get_encode_outcome(files[0])[:3] == ("ok", 2, "")
+    assert library_db.get_encode_outcome(files[1])[:3] == ("error", 1, "Invalid data found")
+    assert library_db.get_encode_outcome(files[2])[:3] == ("error", 3, "Input/output error")
+
+
+def test_encode_worker_exceptions(tmp_path, monkeypatch):
+    library_db = init_db({"database": "sqlite3", "sqlite3": {"path": Path(tmp_path).joinpath("db.sqlite3")}})
+    files = [File(Path(tmp_path).joinpath("library", f"{i}.flac"), FileType.LOSSLESS, 1) for i in range(3)]
+    library_db.add_or_update_files(files)
+    library_db.set_queued_stages(files, [Stage.ENCODE])
+    config = {"threads": 2, "lossy_files": "copy", "encode": {"schedule": "queue", "retries": 0, "retry_delay": 0}}
+
+    def encode_to_dest(file, _):
+        if file.path.name == "0.flac":
+            raise RuntimeError("unexpected")
+        if file.path.name == "1.flac":
+            raise JobCancelledError("cancelled")
+        return EncodeResult()
+    monkeypatch.setattr(File, "encode_to_dest", encode_to_dest)
+
+    # Exceptions raised by a worker are recorded as failures instead of being lost
+    assert not encode(config, library_db)
+    assert [file.path.name for file in library_db.iter_queued_files(Stage.ENCODE)] == ["0.flac", "1.flac"]
+    assert library_db.get_encode_outcome(files[0])[:3] == ("error", 1, "RuntimeError('unexpected')")
+    assert library_db.get_encode_outcome(files[1]).status == "cancelled"
+    assert library_db.get_encode_outcome(files[2]).status == "ok"
+
+
+def test_result_writer(tmp_path):
+    library_db = init_db({"database": "sqlite3", "sqlite3": {"path": Path(tmp_path).joinpath("db.sqlite3")}})
+    files = [File(Path(f"/music/{i}.flac"), FileType.LOSSLESS, 1) for i in range(5)]
+    library_db.add_or_update_files(files)
+    library_db.set_queued_stages(files, [Stage.ENCODE])
+
+    writer = _ResultWriter(library_db, max_items=2, max_delay=0.2)
+    writer.start()
+    # Full groups are committed right away
+    writer.put(files[0], EncodeOutcome("ok", 1, "", 0.0))
+    writer.put(files[1], EncodeOutcome("ok", 1, "", 0.0))
+    writer.put(files[2], EncodeOutcome("error", 1, "Invalid data found", 0.0))
+    deadline = time.monotonic() + 5
+    while writer.commits < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert writer.commits == 1
+    # Incomplete groups are committed after max_delay
+    writer.put(files[3], EncodeOutcome("ok", 1, "", 0.0))
+    time.sleep(0.5)
+    assert writer.commits == 2
+    assert writer.max_latency < 0.5
+    writer.put(files[4], EncodeOutcome("ok", 1, "", 0.0))
+    writer.close()
+
+    assert writer.commits == 3
+    assert writer.successes == 4
+    assert writer.failures == [files[2]]
+    assert [file.path for file in library_db.iter_queued_files(Stage.ENCODE)] == [files[2].path]
+    # Failures are recorded along with successes
+    assert library_db.get_encode_outcome(files[2]).status == "error"
+    assert library_db.get_encode_outcome(files[4]).status == "ok"
@@ -0,0 +1,93 @@
+import os
+from pathlib import Path
+from typing import List, Tuple
+
+from musicbird.config import Config
+from musicbird.copy import copy
+from musicbird.db import LibraryDB
+from musicbird.encode import encode
+from musicbird.file import File, FileType, Stage
+from musicbird.move import _remove_empty_dirs, move
+from musicbird.scanner import LibraryScanner
+from musicbird.__main__ import main
+
+
+def test_move(library_and_db: Tuple[Path, List[File], LibraryDB]):
+    workdir = library_and_db[0]
+    library_files = library_and_db[1]
+    library_db = library_and_db[2]
+    config = Config(workdir.joinpath("config.yml")).config
+
+    scanner = LibraryScanner(workdir.joinpath("library"), library_db)
+    scanner.scan()
+    copy(config, library_db)
+    encode(config, library_db)
+
+    # Rename the album directory
+    album = workdir.joinpath("library", "Artist", "Album")
+    renamed = album.with_name("Renamed Album")
+    os.rename(album, renamed)
+    moved_files = [File(renamed.joinpath(file.path.name), file.type) for file in library_files
+                   if file.path.parent == album and file.type != FileType.ALBUMART]
+    old_dests = [file.get_dest_path(config) for file in library_files
+                 if file.path.parent == album and file.type != FileType.ALBUMART]
+    scanner.scan()
+
+    assert sorted(file.path for file in library_db.iter_queued_files(Stage.MOVE)) == \
+        sorted(file.path for file in moved_files)
+    for stage in [Stage.COPY, Stage.ENCODE, Stage.PRUNE]:
+        assert not list(library_db.iter_queued_files(stage))
+
+    assert move(config, library_db)
+    for file in moved_files:
+        assert file.get_dest_path(config).is_file()
+        assert not library_db.get_file_by_path(file.path).moved_from
+    for dest in old_dests:
+        assert not dest.exists()
+    assert not list(library_db.iter_queued_files(Stage.MOVE))
+    assert not library_db.get_files_needing_processing()
+
+
+def test_move_missing_output(library_and_db: Tuple[Path, List[File], LibraryDB]):
+    workdir = library_and_db[0]
+    library_files = library_and_db[1]
+    library_db = library_and_db[2]
+    config = Config(workdir.joinpath("config.yml")).config
+
+    scanner = LibraryScanner(workdir.joinpath("library"), library_db)
+    scanner.scan()
+    copy(config, library_db)
+    encode(config, library_db)
+
+    moved_file = [file for file in library_files if file.type == FileType.LOSSLESS][0]
+    moved_file.get_dest_path(config).unlink()
+    new_path = moved_file.path.with_name("Moved.flac")
+    os.rename(moved_file.path, new_path)
+    scanner.scan()
+
+    # Files without an output are processed again
+    assert move(config, library_db)
+    assert [file.path for file in library_db.iter_queued_files(Stage.ENCODE)] == [new_path]
+    assert [file.path for file in library_db.get_files_needing_processing()] == [new_path]
+
+
+def test_move_command(library_and_db: Tuple[Path, List[File], LibraryDB]):
+    workdir = library_and_db[0]
+    library_db = library_and_db[2]
+
+    scanner = LibraryScanner(workdir.joinpath("library"), library_db)
+    scanner.scan()
+
+    args = ["-c", str(workdir.joinpath("config.yml")), "move"]
+    assert main(args)
+
+
+def test_remove_empty_dirs(tmp_path):
+    album = Path(tmp_path).joinpath("dest", "Artist", "Album")
+    album.mkdir(parents=True)
+    Path(tmp_path).joinpath("dest", "cover.jpg").write_bytes(b"")
+    _remove_empty_dirs(album.joinpath("track.mp3"))
+    assert not album.parent.exists()
+    assert Path(tmp_path).joinpath("dest").is_dir()
+    # The directory may already have been removed, for example along with a sibling file
+    _remove_empty_dirs(album.joinpath("other.mp3"))
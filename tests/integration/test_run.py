@@ -28,6 +28,26 @@ def test_run(library: Tuple[Path, List[File], LibraryDB]):
     assert not library_db.get_files_needing_processing()
 
 
+def test_run_path(library: Tuple[Path, List[File], LibraryDB]):
+    workdir = library[0]
+    library_files = library[1]
+    album = workdir.joinpath("library", "Artist", "Album")
+
+    config = Config(workdir.joinpath("config.yml")).config
+    config["copy"]["album_art"] = True
+
+    assert run(config, paths=[album])
+
+    expected_files = [file.get_dest_path(config) for file in library_files if file.path.parent == album]
+    actual_files = [path for path in workdir.glob("dest/**/*") if path.is_file()]
+    assert sorted(expected_files) == sorted(actual_files)
+
+    # Files outside of the path were not scanned
+    library_db = init_db(config)
+    assert sorted(file.path for file in library_db.get_all_files()) == \
+        sorted(file.path for file in library_files if file.path.parent == album)
+
+
 def test_run_pretend(library: Tuple[Path, List[File], LibraryDB]):
     workdir = library[0]
 
@@ -1,9 +1,11 @@
+import io
+import os
 from pathlib import Path
 from typing import Dict, List, Tuple
 
 from musicbird.db import LibraryDB
-from musicbird.file import File
-from musicbird.scan import scan
+from musicbird.file import File, Stage
+from musicbird.scan import read_change_list, scan
 from musicbird.config import Config
 from musicbird.__main__ import main
 
@@ -25,3 +27,38 @@ def test_scan_command(library: Tuple[Path, List[File]]):
 
     args = ["-c", str(workdir.joinpath("config.yml")), "scan"]
     assert main(args)
+
+
+def test_scan_from_list(library_and_db: Tuple[Path, List[File], LibraryDB]):
+    workdir = library_and_db[0]
+    library_db = library_and_db[2]
+    config_path = workdir.joinpath("config.yml")
+    assert main(["-c", str(config_path), "scan"])
+    library_db.complete_queued_files((Stage.COPY, file) for file in library_db.get_all_files())
+
+    library = workdir.joinpath("library")
+    library.joinpath("notes.txt").write_text("new file")
+    library.joinpath("Attributions.txt").unlink()
+    # Unlisted changes are not picked up
+    library.joinpath("unlisted.txt").write_text("new file")
+    change_list = workdir.joinpath("changes.txt")
+    change_list.write_bytes(b"\0".join([b"notes.txt", os.fsencode(library.joinpath("Attributions.txt"))]))
+    assert main(["-c", str(config_path), "scan", "--from-list", str(change_list)])
+
+    assert [file.path for file in library_db.iter_queued_files(Stage.COPY)] == [library.joinpath("notes.txt")]
+    assert [file.path for file in library_db.iter_queued_files(Stage.PRUNE)] == [library.joinpath("Attributions.txt")]
+    assert not library_db.get_file_by_path(library.joinpath("unlisted.txt"))
+
+
+def test_read_change_list():
+    rsync_output = (b".d..t...... ./\n"
+                    b">f+++++++++ Artist/Album/01 - A Track.flac\n"
+                    b">f..t...... Artist/Album/cover.jpg\n"
+                    b"cd+++++++++ Artist/New Album/\n"
+                    b"*deleting   Artist/Old Album/\n"
+                    b"cL+++++++++ track.flac -> Artist/Album/01 - A Track.flac\n")
+    assert read_change_list(io.BytesIO(rsync_output)) == [
+        "Artist/Album/01 - A Track.flac", "Artist/Album/cover.jpg", "Artist/Old Album/", "track.flac"]
+    # Lists separated by NUL characters may contain paths with newlines
+    assert read_change_list(io.BytesIO(b"line\nbreak.flac\0track.mp3\0")) == ["line\nbreak.flac", "track.mp3"]
+    assert read_change_list(io.BytesIO(b"track.mp3\n\n")) == ["track.mp3"]
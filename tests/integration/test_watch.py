@@ -0,0 +1,49 @@
+import os
+from pathlib import Path
+import threading
+import time
+from typing import List, Tuple
+
+from musicbird.config import Config
+from musicbird.db import LibraryDB
+from musicbird.file import File, FileType
+from musicbird.watch import watch
+
+
+def _wait_for(condition, timeout: float = 10) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def test_watch(library_and_db: Tuple[Path, List[File], LibraryDB]):
+    workdir = library_and_db[0]
+    library_files = library_and_db[1]
+    library_db = library_and_db[2]
+    config = Config(workdir.joinpath("config.yml")).config
+    config["watch"]["debounce"] = 0.2
+    config["watch"]["poll_interval"] = 0.5
+
+    stop = threading.Event()
+    watcher = threading.Thread(target=watch, args=(config, library_db, stop))
+    watcher.start()
+    try:
+        # The entire library is processed first
+        assert _wait_for(lambda: all(file.get_dest_path(config).is_file() for file in library_files
+                                     if file.type != FileType.ALBUMART))
+
+        # Changes are processed as they happen
+        added = workdir.joinpath("library", "Artist", "notes.txt")
+        added.write_text("new file")
+        moved = [file for file in library_files if file.type == FileType.LOSSLESS][0]
+        os.rename(moved.path, moved.path.with_name("Renamed.flac"))
+        assert _wait_for(lambda: File(added, FileType.OTHER).get_dest_path(config).is_file())
+        assert _wait_for(lambda: File(moved.path.with_name("Renamed.flac"), FileType.LOSSLESS)
+                         .get_dest_path(config).is_file())
+        assert not moved.get_dest_path(config).exists()
+    finally:
+        stop.set()
+        watcher.join()
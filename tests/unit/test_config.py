@@ -7,7 +7,7 @@ import pytest
 from schema import SchemaError
 import yaml
 
-from musicbird.config import Config
+from musicbird.config import Config, resolve_source_paths
 from musicbird.__main__ import main
 from musicbird.file import File
 
@@ -49,3 +49,16 @@ def test_config_generate_command(tmp_path):
 
     args.append("--force")
     assert main(args)
+
+
+def test_resolve_source_paths(tmp_path):
+    source = Path(tmp_path).joinpath("library")
+    source.joinpath("Artist", "Album").mkdir(parents=True)
+    config = {"source": source}
+
+    assert resolve_source_paths(config, None) is None
+    assert resolve_source_paths(config, ["Artist/Album", str(source.joinpath("Other")), "Artist/../Artist"]) == [
+        source.joinpath("Artist"), source.joinpath("Other")]
+    # Paths outside of the library are skipped
+    assert resolve_source_paths(config, ["..", "/elsewhere", "."]) == [source]
+    assert resolve_source_paths(config, ["../library2"]) == []
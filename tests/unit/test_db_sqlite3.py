@@ -1,12 +1,13 @@
 # pylint: disable=redefined-outer-name
 
 from pathlib import Path
+import sqlite3
 from typing import Dict, List
 
 import pytest
 
 from musicbird.db import LibraryDB, SQLiteLibrary
-from musicbird.file import File, FileType
+from musicbird.file import EncodeOutcome, File, FileType, Stage
 
 
 @pytest.fixture
@@ -47,6 +48,109 @@ def test_db_remove(library_db: LibraryDB, test_files: List[File]):
     assert not library_db.get_all_files()
 
 
+def test_db_fingerprint(library_db: LibraryDB, test_files: List[File]):
+    test_files[0].mtime_ns = 12345000000001
+    test_files[0].size = 4096
+    test_files[0].checksum = "0123456789abcdef"
+    library_db.add_or_update_files(test_files)
+    stored = library_db.get_file_by_path(test_files[0].path)
+    assert (stored.mtime_ns, stored.size, stored.checksum) == (12345000000001, 4096, "0123456789abcdef")
+    assert library_db.get_file_by_path(test_files[1].path).mtime_ns is None
+
+
+def test_db_stream_info(library_db: LibraryDB, test_files: List[File]):
+    test_files[0].duration = 5400.5
+    test_files[0].sample_rate = 96000
+    library_db.add_or_update_files(test_files)
+    stored = library_db.get_file_by_path(test_files[0].path)
+    assert (stored.duration, stored.sample_rate) == (5400.5, 96000)
+    assert library_db.get_file_by_path(test_files[1].path).duration is None
+
+
+def test_db_encode_outcomes(library_db: LibraryDB, test_files: List[File]):
+    library_db.add_or_update_files(test_files)
+    assert library_db.get_encode_outcome(test_files[0]) is None
+
+    library_db.record_encode_outcomes([(test_files[0], EncodeOutcome("stalled", 1, "no progress", 120.5)),
+                                       (test_files[1], EncodeOutcome("ok", 2, "", 10.0))])
+    library_db.record_encode_outcomes([(test_files[0], EncodeOutcome("ok", 3, "", 30.0))])
+    assert library_db.get_encode_outcome(test_files[0]) == EncodeOutcome("ok", 3, "", 30.0)
+    assert library_db.get_encode_outcome(test_files[1]) == EncodeOutcome("ok", 2, "", 10.0)
+
+    # Outcomes are removed along with their file
+    library_db.remove_files(test_files[:1])
+    assert library_db.get_encode_outcome(test_files[0]) is None
+
+
+def test_db_add_and_remove_many(library_db: LibraryDB, test_files: List[File]):
+    library_db.add_or_update_files(test_files)
+    assert sorted(test_files) == sorted(library_db.get_all_files())
+
+    test_files[0].needs_processing = False
+    library_db.add_or_update_files(test_files[:1])
+    assert sorted(test_files) == sorted(library_db.get_all_files())
+
+    library_db.remove_files(test_files[1:])
+    assert library_db.get_all_files() == test_files[:1]
+
+
+def test_db_transaction(tmp_path, test_files: List[File]):
+    path = Path(tmp_path).joinpath("db.sqlite3")
+    library_db = SQLiteLibrary(path)
+    with library_db.transaction():
+        library_db.add_or_update_files(test_files[:1])
+        with library_db.transaction():
+            library_db.add_or_update_file(test_files[1])
+        # Nothing is visible to other connections until the outermost transaction completes
+        assert not SQLiteLibrary(path).get_all_files()
+    assert sorted(test_files[:2]) == sorted(SQLiteLibrary(path).get_all_files())
+
+    with pytest.raises(RuntimeError):
+        with library_db.transaction():
+            library_db.remove_files(test_files[:2])
+            raise RuntimeError()
+    assert sorted(test_files[:2]) == sorted(library_db.get_all_files())
+
+
+def test_db_options(tmp_path, test_files: List[File]):
+    path = Path(tmp_path).joinpath("db.sqlite3")
+    library_db = SQLiteLibrary(path, options={"journal_mode": "wal", "synchronous": "normal", "busy_timeout": 100})
+    # pylint: disable=protected-access
+    assert library_db._make_query("PRAGMA journal_mode")[0][0] == "wal"
+    assert library_db._make_query("PRAGMA synchronous")[0][0] == 1
+
+    library_db.add_or_update_files(test_files)
+    # With WAL, other connections can read while a write transaction is in progress
+    with library_db.transaction():
+        library_db.remove_files(test_files)
+        assert sorted(test_files) == sorted(SQLiteLibrary(path).get_all_files())
+
+
+def test_db_iter_all_files(library_db: LibraryDB, test_files: List[File], monkeypatch):
+    # Use a tiny chunk size to make sure that iteration continues across chunks
+    monkeypatch.setattr(SQLiteLibrary, "_CHUNK_SIZE", 2)
+    for file in test_files:
+        library_db.add_or_update_file(file)
+    assert sorted(test_files) == list(library_db.iter_all_files())
+
+
+def test_db_iter_and_count(library_db: LibraryDB, test_files: List[File], monkeypatch):
+    monkeypatch.setattr(SQLiteLibrary, "_CHUNK_SIZE", 1)
+    library_db.add_or_update_files(test_files)
+
+    assert sorted(f for f in test_files if f.needs_processing) == list(library_db.iter_files_needing_processing())
+    assert sorted(f for f in test_files if f.was_deleted) == list(library_db.iter_deleted_files())
+    assert library_db.count_all_files() == len(test_files)
+    assert library_db.count_files_needing_processing() == len([f for f in test_files if f.needs_processing])
+    assert library_db.count_deleted_files() == len([f for f in test_files if f.was_deleted])
+
+    # Files may be updated while iterating over them
+    for file in library_db.iter_files_needing_processing():
+        file.needs_processing = False
+        library_db.add_or_update_file(file)
+    assert library_db.count_files_needing_processing() == 0
+
+
 def test_db_get_file_by_path(library_db: LibraryDB, test_files: List[File]):
     for file in test_files:
         library_db.add_or_update_file(file)
@@ -77,6 +181,137 @@ def test_db_get_deleted_files(library_db: LibraryDB, test_files: List[File]):
     assert sorted([f for f in test_files if f.was_deleted]) == sorted(library_db.get_deleted_files())
 
 
+def test_db_scan_epochs(library_db: LibraryDB, test_files: List[File]):
+    for file in test_files:
+        file.was_deleted = False
+        library_db.add_or_update_file(file)
+
+    epoch = library_db.next_scan_epoch()
+    # also_lossy.mp3 < lossless.flac < lossy.mp3, so only lossless.flac is left unstamped
+    library_db.mark_files_seen(Path("also_lossy.mp3"), Path("also_lossy.mp3"), epoch)
+    library_db.mark_files_seen(Path("lossy.mp3"), Path("lossy.mp3"), epoch)
+    assert library_db.mark_unseen_files_deleted(epoch) == 1
+    assert [f.path for f in library_db.get_deleted_files()] == [Path("lossless.flac")]
+
+    # Updating a file must not reset its epoch
+    library_db.add_or_update_file(test_files[0])
+    assert library_db.next_scan_epoch() == epoch + 1
+    assert library_db.mark_unseen_files_deleted(epoch) == 0
+
+
+def test_db_upsert_fallback(library_db: LibraryDB, test_files: List[File], monkeypatch):
+    monkeypatch.setattr(SQLiteLibrary, "_UPSERT_SUPPORTED", False)
+    for file in test_files:
+        file.was_deleted = False
+    library_db.add_or_update_files(test_files[:2])
+    epoch = library_db.next_scan_epoch()
+    library_db.mark_files_seen(Path("also_lossy.mp3"), Path("lossy.mp3"), epoch)
+
+    # Existing files are updated without resetting their epoch, new files are added
+    test_files[0].type = FileType.OTHER
+    library_db.add_or_update_files(test_files)
+    assert sorted(test_files) == sorted(library_db.get_all_files())
+    assert library_db.mark_unseen_files_deleted(epoch) == 1
+    assert [f.path for f in library_db.get_deleted_files()] == [test_files[2].path]
+
+
+def test_db_queues(library_db: LibraryDB, test_files: List[File]):
+    library_db.add_or_update_files(test_files)
+    library_db.set_queued_stages(test_files[:2], [Stage.COPY, Stage.ENCODE])
+    library_db.set_queued_stages(test_files[1:2], [Stage.ENCODE])
+    assert list(library_db.iter_queued_files(Stage.COPY)) == [test_files[0]]
+    assert [f.path for f in library_db.iter_queued_files(Stage.ENCODE)] == [Path("also_lossy.mp3"), Path("lossy.mp3")]
+    assert library_db.count_queued_files(Stage.ENCODE) == 2
+    assert library_db.count_queued_files(Stage.PRUNE) == 0
+
+    # needs_processing is only cleared once all stages are done with a file
+    library_db.complete_queued_files([(Stage.COPY, test_files[0]), (Stage.ENCODE, test_files[1])])
+    assert library_db.get_file_by_path(Path("lossy.mp3")).needs_processing
+    assert not library_db.get_file_by_path(Path("also_lossy.mp3")).needs_processing
+    library_db.complete_queued_files([(Stage.ENCODE, test_files[0])])
+    assert not library_db.get_files_needing_processing()
+
+    # Newly deleted files move to the prune queue
+    library_db.set_queued_stages(test_files[:1], [Stage.COPY])
+    library_db.mark_files_seen(Path("also_lossy.mp3"), Path("also_lossy.mp3"), library_db.next_scan_epoch())
+    library_db.mark_unseen_files_deleted(1)
+    assert library_db.count_queued_files(Stage.COPY) == 0
+    assert [f.path for f in library_db.iter_queued_files(Stage.PRUNE)] == [Path("lossy.mp3")]
+    library_db.remove_files(test_files)
+    assert library_db.count_queued_files(Stage.PRUNE) == 0
+
+
+
+def test_db_iter_files_below(library_db: LibraryDB):
+    paths = [Path("/music/A"), Path("/music/A/1.flac"), Path("/music/A/B/2.flac"), Path("/music/A B/3.flac"),
+             Path("/music/A.flac"), Path("/music/A0/4.flac")]
+    library_db.add_or_update_files(File(path, FileType.LOSSLESS, 1) for path in paths)
+    assert [f.path for f in library_db.iter_files_below(Path("/music/A"))] == [paths[1], paths[2]]
+
+    library_db.mark_files_deleted([File(paths[1], FileType.LOSSLESS, 1)])
+    assert [f.path for f in library_db.get_deleted_files()] == [paths[1]]
+    assert [f.path for f in library_db.iter_queued_files(Stage.PRUNE)] == [paths[1]]
+
+
+def test_db_scoped_queues(library_db: LibraryDB):
+    paths = [Path("/music/A/1.flac"), Path("/music/A B/2.flac"), Path("/music/A/C/3.flac"), Path("/music/D.flac"),
+             Path("/music/E/4.flac")]
+    files = [File(path, FileType.LOSSLESS, 1) for path in paths]
+    library_db.add_or_update_files(files)
+    library_db.set_queued_stages(files, [Stage.ENCODE])
+
+    scope = [Path("/music/A"), Path("/music/D.flac")]
+    assert [f.path for f in library_db.iter_queued_files(Stage.ENCODE, scope)] == [paths[0], paths[2], paths[3]]
+    assert library_db.count_queued_files(Stage.ENCODE, scope) == 3
+    assert library_db.count_queued_files(Stage.ENCODE, []) == 0
+    assert library_db.count_queued_files(Stage.COPY, scope) == 0
+
+
+def test_db_schema_upgrade(tmp_path, test_files: List[File]):
+    # Create a database as written by older versions
+    path = Path(tmp_path).joinpath("db.sqlite3")
+    con = sqlite3.connect(str(path))
+    with con:
+        con.execute(("CREATE TABLE Files (path TEXT PRIMARY KEY, filetype INT, mtime INT, "
+                     "needs_processing BOOLEAN, was_deleted BOOLEAN)"))
+        con.execute("INSERT INTO Files VALUES (?,?,?,?,?)", ("lossy.mp3", FileType.LOSSY.value, 12345, True, False))
+        con.execute("INSERT INTO Files VALUES (?,?,?,?,?)", ("gone.flac", FileType.LOSSLESS.value, 1, False, True))
+    con.close()
+
+    library_db = SQLiteLibrary(path)
+    assert library_db.get_file_by_path(Path("lossy.mp3")) == test_files[0]
+    assert library_db.next_scan_epoch() == 1
+    # Pending work is carried over into the queues
+    assert [f.path for f in library_db.iter_queued_files(Stage.COPY)] == [Path("lossy.mp3")]
+    assert [f.path for f in library_db.iter_queued_files(Stage.ENCODE)] == [Path("lossy.mp3")]
+    assert [f.path for f in library_db.iter_queued_files(Stage.PRUNE)] == [Path("gone.flac")]
+    # pylint: disable=protected-access
+    indexes = {row["name"] for row in library_db._make_query("SELECT name FROM sqlite_master WHERE type='index'")}
+    assert set(SQLiteLibrary._INDEXES) <= indexes
+
+
+def test_db_query_plans(library_db: SQLiteLibrary):
+    library_db.add_or_update_files(
+        File(Path(f"/music/{i:06}.flac"), FileType(i % 4 + 1), 12345, needs_processing=i % 100 == 0,
+             was_deleted=i % 500 == 0)
+        for i in range(50000)
+    )
+    queries = {
+        "SELECT * FROM Files WHERE needs_processing": ((), "Files_needs_processing"),
+        "SELECT * FROM Files WHERE was_deleted": ((), "Files_was_deleted"),
+        "SELECT * FROM Files WHERE filetype=?": ((FileType.LOSSY.value,), "Files_filetype"),
+        "SELECT * FROM Queue JOIN Files USING (path) WHERE stage=? AND Queue.path > ? ORDER BY Queue.path":
+            ((Stage.COPY.value, ""), "sqlite_autoindex_Files_1"),
+        "DELETE FROM Queue WHERE path=?": (("",), "Queue_path"),
+        "SELECT COUNT(*) FROM Queue WHERE stage=? AND Queue.path > ? AND Queue.path < ?":
+            ((Stage.COPY.value, "/music/A/", "/music/A0"), "PRIMARY KEY"),
+    }
+    for query, (params, index) in queries.items():
+        # pylint: disable=protected-access
+        plan = " ".join(row["detail"] for row in library_db._make_query(f"EXPLAIN QUERY PLAN {query}", params))
+        assert f"USING {index}" in plan or f"INDEX {index}" in plan
+
+
 def test_db_pretend(tmp_path, test_files: List[File]):
     # Initialize the DB and add some files
     library_db = SQLiteLibrary(Path(tmp_path).joinpath("db.sqlite3"))
@@ -99,6 +334,44 @@ def test_db_pretend(tmp_path, test_files: List[File]):
     assert sorted(test_files) == sorted(library_db.get_all_files())
 
 
+def test_db_pretend_snapshot(tmp_path, test_files: List[File]):
+    library_db = SQLiteLibrary(Path(tmp_path).joinpath("db.sqlite3"))
+    library_db.add_or_update_files(test_files)
+    library_db.mark_files_seen(Path("also_lossy.mp3"), Path("lossy.mp3"), library_db.next_scan_epoch())
+    del library_db
+
+    # The snapshot contains everything stored in the DB, not just the file attributes
+    library_db = SQLiteLibrary(Path(tmp_path).joinpath("db.sqlite3"), pretend=True)
+    assert sorted(test_files) == sorted(library_db.get_all_files())
+    assert library_db.next_scan_epoch() == 2
+    # pylint: disable=protected-access
+    indexes = {row["name"] for row in library_db._make_query("SELECT name FROM sqlite_master WHERE type='index'")}
+    assert set(SQLiteLibrary._INDEXES) <= indexes
+
+
+def test_db_pretend_read_only(tmp_path, test_files: List[File]):
+    # Create a database as written by older versions
+    path = Path(tmp_path).joinpath("db.sqlite3")
+    con = sqlite3.connect(str(path))
+    with con:
+        con.execute(("CREATE TABLE Files (path TEXT PRIMARY KEY, filetype INT, mtime INT, "
+                     "needs_processing BOOLEAN, was_deleted BOOLEAN)"))
+        con.execute("INSERT INTO Files VALUES (?,?,?,?,?)", ("lossy.mp3", FileType.LOSSY.value, 12345, True, False))
+    con.close()
+    data = path.read_bytes()
+    mtime_ns = path.stat().st_mtime_ns
+
+    # Neither the schema upgrade nor the options are applied to the file itself
+    library_db = SQLiteLibrary(path, pretend=True, options={"journal_mode": "wal", "synchronous": "normal"})
+    assert library_db.get_file_by_path(Path("lossy.mp3")) == test_files[0]
+    assert [f.path for f in library_db.iter_queued_files(Stage.ENCODE)] == [Path("lossy.mp3")]
+    library_db.add_or_update_files(test_files[1:])
+    del library_db
+
+    assert path.read_bytes() == data
+    assert path.stat().st_mtime_ns == mtime_ns
+
+
 def test_db_delete(tmp_path, test_files: List[File]):
     # Initialize the DB and add some files
     library_db = SQLiteLibrary(Path(tmp_path).joinpath("db.sqlite3"))
@@ -1,9 +1,14 @@
+import os
 from pathlib import Path
+import stat
+import sys
 from typing import List, Tuple
 import ffmpeg
+import pytest
 
+from musicbird import encoder as encoder_module
 from musicbird.file import File, FileType
-from musicbird.encoder import MP3Encoder, OpusEncoder
+from musicbird.encoder import CapabilityCache, Encoder, JobLimits, MP3Encoder, OpusEncoder, init as init_encoder
 
 
 def test_mp3_vbr_encoder(library: Tuple[Path, List[File]]):
@@ -54,3 +59,139 @@ def test_opus_encoder(library: Tuple[Path, List[File]]):
     # There is no easy way to determine the encoding mode/quality from ffprobes output,
     # but we can still make a rough check via bitrate
     assert int(ffmpeg.probe(str(dest))["format"]["bit_rate"]) <= 140000
+
+
+def _fake_ffmpeg(tmp_path: Path) -> Tuple[Path, Path]:
+    """Create a fake ffmpeg binary that logs every call to a file.
+
+    Returns:
+        Tuple[Path, Path]: The directory containing the binary and the call log.
+    """
+    bindir = tmp_path.joinpath("bin")
+    bindir.mkdir()
+    calls = tmp_path.joinpath("calls")
+    binary = bindir.joinpath("ffmpeg")
+    binary.write_text((
+        "#!/bin/sh\n"
+        f"echo called >> '{calls}'\n"
+        "echo ' A....D libmp3lame           libmp3lame MP3 (MPEG audio layer 3) (codec mp3)'\n"
+    ))
+    binary.chmod(binary.stat().st_mode | stat.S_IEXEC)
+    return bindir, calls
+
+
+def test_capability_cache(tmp_path, monkeypatch):
+    bindir, calls = _fake_ffmpeg(tmp_path)
+    monkeypatch.setenv("PATH", str(bindir), prepend=os.pathsep)
+    cache_path = tmp_path.joinpath("capabilities.json")
+
+    # pylint: disable=protected-access
+    assert CapabilityCache(cache_path).get("ffmpeg", encoder_module._probe_ffmpeg) == {"encoders": ["libmp3lame"]}
+    assert len(calls.read_text().splitlines()) == 1
+
+    # A fresh cache reads the result from disk instead of calling the binary again
+    assert CapabilityCache(cache_path).get("ffmpeg", encoder_module._probe_ffmpeg) == {"encoders": ["libmp3lame"]}
+    assert len(calls.read_text().splitlines()) == 1
+
+    # Replacing the binary invalidates the entry
+    binary = bindir.joinpath("ffmpeg")
+    os.utime(binary, ns=(binary.stat().st_atime_ns, binary.stat().st_mtime_ns + 10**9))
+    CapabilityCache(cache_path).get("ffmpeg", encoder_module._probe_ffmpeg)
+    assert len(calls.read_text().splitlines()) == 2
+
+    assert CapabilityCache(cache_path).get("not-a-binary", encoder_module._probe_ffmpeg) is None
+
+
+def test_encoder_init_error(tmp_path, monkeypatch):
+    bindir, _ = _fake_ffmpeg(tmp_path)
+    bindir.joinpath("ffmpeg").write_text("#!/bin/sh\necho ' A....D aac                  AAC (Advanced Audio Coding)'\n")
+    monkeypatch.setenv("PATH", str(bindir), prepend=os.pathsep)
+    monkeypatch.setattr(encoder_module, "capabilities", CapabilityCache(tmp_path.joinpath("capabilities.json")))
+    monkeypatch.setattr(encoder_module, "_registry", {})
+    config = {
+        "encoder": "mp3",
+        "mp3": {"vbr": True, "quality": 2}
+    }
+
+    with pytest.raises(OSError):
+        init_encoder(config, exit_on_error=False)
+    with pytest.raises(SystemExit, match="Error initializing encoder mp3: .*libmp3lame"):
+        init_encoder(config)
+
+
+def test_encoder_registry(tmp_path, monkeypatch):
+    bindir, calls = _fake_ffmpeg(tmp_path)
+    monkeypatch.setenv("PATH", str(bindir), prepend=os.pathsep)
+    monkeypatch.setattr(encoder_module, "capabilities", CapabilityCache(tmp_path.joinpath("capabilities.json")))
+    monkeypatch.setattr(encoder_module, "_registry", {})
+    config = {
+        "encoder": "mp3",
+        "mp3": {"vbr": True, "quality": 2}
+    }
+
+    encoder = init_encoder(config)
+    assert init_encoder(config) is encoder
+    assert len(calls.read_text().splitlines()) == 1
+
+    # Different settings result in a different encoder
+    config["mp3"]["quality"] = 4
+    assert init_encoder(config) is not encoder
+
+
+def test_run_classification(tmp_path):
+    src = tmp_path.joinpath("file.flac")
+
+    result = Encoder._run(src, [sys.executable, "-c", "pass"], None)
+    assert result and result.status == "ok"
+
+    # Errors on network mounts are worth retrying, others are not
+    code = "import sys; print('out_time_us=5\\n{}', file=sys.stderr); sys.exit(1)"
+    result = Encoder._run(src, [sys.executable, "-c", code.format("file.flac: Input/output error")], None)
+    assert not result
+    assert result.status == "error" and result.transient
+    assert result.error == "file.flac: Input/output error"
+    result = Encoder._run(src, [sys.executable, "-c", code.format("Invalid data found")], None)
+    assert result.status == "error" and not result.transient
+
+    limits = JobLimits(timeout=0.5)
+    assert Encoder._run(src, [sys.executable, "-c", "import time; time.sleep(30)"], limits).status == "timeout"
+    limits = JobLimits(stall_timeout=0.5)
+    result = Encoder._run(src, [sys.executable, "-c", "import time; time.sleep(30)"], limits, poll=lambda: 0)
+    assert result.status == "stalled"
+
+    result = Encoder._run(src, [str(tmp_path.joinpath("missing"))], None)
+    assert result.status == "error" and not result.transient
+
+
+def test_encode_segment_unsupported(tmp_path):
+    class _PlainEncoder(Encoder):
+        def encode(self, src, dest, limits=None):
+            return True
+
+    encoder = _PlainEncoder()
+    assert not encoder.segment_format
+    result = encoder.encode_segment(tmp_path.joinpath("a.flac"), tmp_path.joinpath("a.mp3"), 0, 0, None, 44100, True)
+    assert result.status == "error"
+    assert not tmp_path.joinpath("a.mp3").exists()
+
+
+def test_capability_cache_location(tmp_path, monkeypatch):
+    bindir, calls = _fake_ffmpeg(tmp_path)
+    monkeypatch.setenv("PATH", str(bindir), prepend=os.pathsep)
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path.joinpath("cache")))
+    # pylint: disable=protected-access
+    CapabilityCache().get("ffmpeg", encoder_module._probe_ffmpeg)
+    assert tmp_path.joinpath("cache", "musicbird", "capabilities.json").is_file()
+
+    # Without a home directory, the cache is only kept in memory
+    monkeypatch.delenv("XDG_CACHE_HOME")
+    monkeypatch.delenv("HOME")
+
+    def home():
+        raise RuntimeError("Could not determine home directory.")
+    monkeypatch.setattr(Path, "home", home)
+    cache = CapabilityCache()
+    assert cache.get("ffmpeg", encoder_module._probe_ffmpeg) == {"encoders": ["libmp3lame"]}
+    assert cache.get("ffmpeg", encoder_module._probe_ffmpeg) == {"encoders": ["libmp3lame"]}
+    assert cache.path is None
+    assert len(calls.read_text().splitlines()) == 2
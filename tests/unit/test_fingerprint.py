@@ -0,0 +1,77 @@
+import os
+from pathlib import Path
+
+from musicbird.db import SQLiteLibrary
+from musicbird.file import File, FileType, Stage
+from musicbird.fingerprint import Change, ChecksumDetector, MtimeDetector, partial_checksum
+from musicbird.scanner import LibraryScanner
+
+
+def _stored(path: Path, **kwargs) -> File:
+    return File(path, FileType.OTHER, kwargs.pop("mtime", 1000), **kwargs)
+
+
+def test_mtime_detector(tmp_path):
+    path = Path(tmp_path).joinpath("file")
+    path.write_bytes(b"data")
+    os.utime(path, ns=(1000_300_000_000, 1000_300_000_000))
+    file = File(path)
+    detector = MtimeDetector()
+
+    assert detector.compare(file, _stored(path, mtime_ns=1000_300_000_000, size=4)) == Change.UNCHANGED
+    # Sub-second changes and size changes are detected
+    assert detector.compare(file, _stored(path, mtime_ns=1000_100_000_000, size=4)) == Change.MODIFIED
+    assert detector.compare(file, _stored(path, mtime_ns=1000_300_000_000, size=5)) == Change.MODIFIED
+    # Legacy entries only have the mtime in seconds
+    assert detector.compare(file, _stored(path)) == Change.METADATA
+    assert detector.compare(file, _stored(path, mtime=999)) == Change.MODIFIED
+
+
+def test_checksum_detector(tmp_path):
+    path = Path(tmp_path).joinpath("file")
+    path.write_bytes(b"data" * 100000)
+    checksum = partial_checksum(path)
+    file = File(path)
+    detector = ChecksumDetector()
+
+    assert detector.compare(file, _stored(path, mtime_ns=file.mtime_ns, size=file.size, checksum=checksum)) \
+        == Change.UNCHANGED
+    # Touched files with the same contents only need their metadata updated
+    assert detector.compare(file, _stored(path, mtime_ns=1, size=file.size, checksum=checksum)) == Change.METADATA
+    assert detector.compare(file, _stored(path, mtime_ns=1, size=file.size, checksum="0" * 32)) == Change.MODIFIED
+    # Entries without a checksum receive one
+    file.checksum = None
+    assert detector.compare(file, _stored(path, mtime_ns=file.mtime_ns, size=file.size)) == Change.METADATA
+    assert file.checksum == checksum
+
+
+def test_partial_checksum(tmp_path):
+    path = Path(tmp_path).joinpath("file")
+    path.write_bytes(bytes(200000))
+    checksum = partial_checksum(path)
+    with path.open("r+b") as f:
+        f.write(b"tag")
+    assert partial_checksum(path) != checksum
+    assert partial_checksum(Path(tmp_path).joinpath("missing")) is None
+
+
+def test_checksum_scan(tmp_path):
+    library = Path(tmp_path).joinpath("library")
+    library.mkdir()
+    touched = library.joinpath("touched.txt")
+    touched.write_text("unchanged")
+    modified = library.joinpath("modified.txt")
+    modified.write_text("original")
+    db = SQLiteLibrary(Path(tmp_path).joinpath("db.sqlite3"))
+    scanner = LibraryScanner(library, db, detector=ChecksumDetector())
+    scanner.scan()
+    db.complete_queued_files((Stage.COPY, file) for file in db.get_all_files())
+
+    os.utime(touched, ns=(1, 1))
+    modified.write_text("modifies")
+    os.utime(modified, ns=(1, 1))
+    scanner.scan()
+
+    assert [file.path for file in db.get_files_needing_processing()] == [modified]
+    assert [file.path for file in db.iter_queued_files(Stage.COPY)] == [modified]
+    assert db.get_file_by_path(touched).mtime_ns == 1
@@ -0,0 +1,58 @@
+from pathlib import Path
+
+import pytest
+
+from musicbird.ignore import IgnoreRules
+
+
+@pytest.mark.parametrize("pattern,path,is_dir,expected", [
+    ("Thumbs.db", "Thumbs.db", False, True),
+    ("Thumbs.db", "Artist/Album/Thumbs.db", False, True),
+    ("Thumbs.db", "Artist/Thumbs.db.bak", False, False),
+    ("@eaDir/", "Artist/@eaDir", True, True),
+    ("@eaDir/", "Artist/@eaDir", False, False),
+    ("*.tmp", "Artist/track.flac.tmp", False, True),
+    ("*.tmp", "Artist.tmp/track.flac", False, False),
+    ("._*", "Album/._01.flac", False, True),
+    ("/Scratch", "Scratch", True, True),
+    ("/Scratch", "Artist/Scratch", True, False),
+    ("Artist/Scratch", "Artist/Scratch", True, True),
+    ("Artist/Scratch", "Other/Artist/Scratch", True, False),
+    ("Artist/*/Demos", "Artist/Album/Demos", True, True),
+    ("Artist/*/Demos", "Artist/Album/CD1/Demos", True, False),
+    ("Artist/**/Demos", "Artist/Album/CD1/Demos", True, True),
+    ("Artist/**/Demos", "Artist/Demos", True, True),
+    ("**/Samples", "Samples", True, True),
+    ("Artist/**", "Artist/Album", True, True),
+    ("Artist/**", "Artist", True, False),
+    ("CD?", "Album/CD1", True, True),
+    ("CD[!1]", "Album/CD1", True, False),
+    ("CD[0-9]", "Album/CD2", True, True),
+    (r"\!important", "!important", False, True),
+])
+def test_ignore_patterns(pattern: str, path: str, is_dir: bool, expected: bool):
+    root = Path("/music")
+    assert IgnoreRules(root, [pattern]).match(root.joinpath(path), is_dir) == expected
+
+
+def test_ignore_rules(tmp_path):
+    root = Path(tmp_path)
+    root.joinpath("Album", "@eaDir").mkdir(parents=True)
+    rules = IgnoreRules(root, ["# comment", "", "*.tmp", "!keep.tmp", "@eaDir/", "[invalid"])
+    assert [rule.pattern for rule in rules.rules] == ["*.tmp", "!keep.tmp", "@eaDir/", "[invalid"]
+
+    # The last matching rule wins
+    assert rules.match(root.joinpath("Album", "track.tmp"), False)
+    assert not rules.match(root.joinpath("Album", "keep.tmp"), False)
+    assert not rules.match(root.joinpath("Album", "track.flac"), False)
+    assert rules.hits == [1, 1, 0, 0]
+    assert rules.report() == "'*.tmp': 1, '!keep.tmp': 1"
+
+    # Paths in excluded directories are excluded as well
+    assert rules.is_ignored(root.joinpath("Album", "@eaDir", "track.flac@SynoEAStream"))
+    assert rules.is_ignored(root.joinpath("Album", "@eaDir"))
+    assert not rules.is_ignored(root.joinpath("Album"))
+    assert not rules.is_ignored(root)
+
+    rules.reset()
+    assert rules.report() == "no paths matched"
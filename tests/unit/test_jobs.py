@@ -0,0 +1,121 @@
+import concurrent.futures
+import sys
+import threading
+import time
+
+import pytest
+
+from musicbird.jobs import JobCancelledError, JobRunner, Watchdog
+
+
+def _python(code: str):
+    return [sys.executable, "-c", code]
+
+
+@pytest.fixture
+def runner():
+    runners = []
+    yield lambda max_jobs: runners.append(JobRunner(max_jobs)) or runners[-1]
+    for created in runners:
+        created.close()
+
+
+def test_run(runner):
+    runner = runner(2)
+    result = runner.run(_python("import sys; print('out'); print('err', file=sys.stderr); sys.exit(3)"))
+    assert result.returncode == 3
+    assert result.stdout.strip() == b"out"
+    assert result.stderr.strip() == b"err"
+    assert not result.timed_out
+
+    with pytest.raises(OSError):
+        runner.run(["/nonexistent/binary"])
+
+
+def test_run_stderr_stream(runner):
+    runner = runner(1)
+    lines = []
+    code = "import sys, time\nfor i in range(3):\n    sys.stderr.write(f'progress {i}\\r'); sys.stderr.flush()"
+    runner.run(_python(code), on_stderr=lines.append)
+    assert lines == ["progress 0", "progress 1", "progress 2"]
+
+
+def test_run_timeout(runner):
+    runner = runner(1)
+    start = time.monotonic()
+    result = runner.run(_python("import time; time.sleep(30)"), timeout=0.5)
+    assert result.timed_out
+    assert result.returncode != 0
+    assert time.monotonic() - start < 10
+
+
+def test_run_stalled(runner):
+    runner = runner(1)
+    # Progress is reported at first, then the job hangs
+    code = "import sys, time\nfor i in range(1, 4):\n    print(i, file=sys.stderr, flush=True)\ntime.sleep(30)"
+    watchdog = Watchdog(0.5)
+    start = time.monotonic()
+    result = runner.run(_python(code), on_stderr=lambda line: watchdog.update(int(line)), watchdog=watchdog)
+    assert result.stalled
+    assert not result.timed_out
+    assert watchdog.progress == 3
+    assert time.monotonic() - start < 10
+
+    # Polled progress keeps a job alive
+    polls = []
+    watchdog = Watchdog(0.5, poll=lambda: polls.append(None) or len(polls))
+    result = runner.run(_python("import time; time.sleep(2)"), watchdog=watchdog)
+    assert result.returncode == 0
+    assert not result.stalled
+
+
+def test_run_budget(runner):
+    runner = runner(2)
+    peak = []
+
+    def job():
+        peak.append(runner.running)
+        return runner.run(_python("import time; time.sleep(0.3)")).returncode
+
+    with concurrent.futures.ThreadPoolExecutor(6) as executor:
+        results = list(executor.map(lambda _: job(), range(6)))
+    assert results == [0] * 6
+    assert max(peak) <= 2
+
+
+def test_cancel_all(runner):
+    runner = runner(1)
+    errors = []
+
+    def job():
+        try:
+            runner.run(_python("import time; time.sleep(30)"))
+        except JobCancelledError as e:
+            errors.append(e)
+
+    # One job is running, the other one waits for the budget
+    threads = [threading.Thread(target=job) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + 10
+    while runner.running < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    runner.cancel_all()
+    for thread in threads:
+        thread.join(10)
+    assert len(errors) == 2
+    deadline = time.monotonic() + 10
+    while runner.running and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert runner.running == 0
+
+    with pytest.raises(JobCancelledError):
+        runner.run(_python("pass"))
+    runner.reset()
+    assert runner.run(_python("pass")).returncode == 0
+
+    with pytest.raises(KeyboardInterrupt):
+        with runner.cancel_on_interrupt():
+            raise KeyboardInterrupt()
+    with pytest.raises(JobCancelledError):
+        runner.run(_python("pass"))
@@ -0,0 +1,73 @@
+import os
+from pathlib import Path
+
+from musicbird.file import File, FileType
+from musicbird.probecache import ProbeCache
+
+RESULT = {"streams": [{"codec_type": "audio", "codec_name": "mp3", "channels": 2, "sample_rate": "44100"}],
+          "duration": "1.000000", "bit_rate": "128000"}
+
+
+def test_probe_cache(tmp_path):
+    file = Path(tmp_path).joinpath("file")
+    file.write_bytes(b"data")
+    cache = ProbeCache(Path(tmp_path).joinpath("cache.sqlite3"), 10)
+    assert cache.get(file) is None
+    cache.put(file, RESULT)
+    assert cache.get(file) == RESULT
+    cache.close()
+
+    # Entries are persistent and survive renames
+    renamed = file.with_name("renamed")
+    os.rename(file, renamed)
+    cache = ProbeCache(Path(tmp_path).joinpath("cache.sqlite3"), 10)
+    assert cache.get(renamed) == RESULT
+    assert (cache.hits, cache.misses) == (1, 0)
+
+    # Modifying the file invalidates the entry
+    renamed.write_bytes(b"other data")
+    assert cache.get(renamed) is None
+
+
+def test_probe_cache_eviction(tmp_path):
+    cache = ProbeCache(Path(tmp_path).joinpath("cache.sqlite3"), 20)
+    files = []
+    for i in range(20):
+        files.append(Path(tmp_path).joinpath(f"file{i}"))
+        files[-1].write_text(str(i))
+        cache.put(files[-1], RESULT)
+    # Use the first file, so that the second one becomes the least recently used
+    cache.get(files[0])
+
+    new_file = Path(tmp_path).joinpath("new")
+    new_file.write_text("new")
+    cache.put(new_file, RESULT)
+    assert cache.get(files[0]) == RESULT
+    assert cache.get(files[1]) is None
+    assert cache.get(new_file) == RESULT
+
+
+def test_probe_cache_readonly(tmp_path):
+    # Characters with a special meaning in URIs must not change the file that is opened
+    path = Path(tmp_path).joinpath("cache ?#%41.sqlite3")
+    file = Path(tmp_path).joinpath("file")
+    file.write_bytes(b"data")
+    ProbeCache(path, 10).close()
+
+    cache = ProbeCache(path, 10, readonly=True)
+    cache.put(file, RESULT)
+    assert cache.get(file) is None
+
+
+def test_determine_type_cached(tmp_path, monkeypatch):
+    probed = []
+    monkeypatch.setattr(File, "_probe", lambda self: probed.append(self.path) or RESULT)
+    path = Path(tmp_path).joinpath("unknown.bin")
+    path.write_bytes(b"\x00\x01" * 100)
+    cache = ProbeCache(Path(tmp_path).joinpath("cache.sqlite3"), 10)
+
+    for _ in range(3):
+        file = File(path)
+        file.determine_type(cache)
+        assert file.type == FileType.LOSSY
+    assert probed == [path]
@@ -1,9 +1,13 @@
 import os
 from pathlib import Path
+import random
+import shutil
+import time
 from typing import List, Tuple
 
-from musicbird.db import LibraryDB
-from musicbird.file import File, FileType
+from musicbird.db import LibraryDB, SQLiteLibrary
+from musicbird.file import File, FileType, Stage
+from musicbird import scanner as scanner_module
 from musicbird.scanner import LibraryScanner
 
 
@@ -95,3 +99,146 @@ def test_modified_scan(library_and_db: Tuple[Path, List[File], LibraryDB]):
     assert actual_modified[0].path == expected_modified.path
     assert actual_modified[0].type == expected_modified.type
     assert actual_modified[0].mtime != expected_modified.mtime
+
+
+def test_parallel_probe_scan(tmp_path, monkeypatch):
+    library = Path(tmp_path).joinpath("library")
+    for i in range(60):
+        path = library.joinpath(f"Artist {i % 3}", f"{i:02}.flac" if i % 2 else f"{i:02}.txt")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"fLaC" if i % 2 else b"text")
+    original = File.determine_type
+
+    def slow_determine_type(self, probe_cache=None):
+        # Finish type detections in random order
+        time.sleep(random.random() / 100)
+        original(self, probe_cache)
+    monkeypatch.setattr(File, "determine_type", slow_determine_type)
+
+    results = []
+    for threads in [1, 8]:
+        db = SQLiteLibrary(Path(tmp_path).joinpath(f"db{threads}.sqlite3"))
+        scanner = LibraryScanner(library, db, probe_threads=threads)
+        assert scanner.scan()
+        os.rename(library.joinpath("Artist 1", "01.flac"), library.joinpath("Artist 1", "99.flac"))
+        assert scanner.scan()
+        os.rename(library.joinpath("Artist 1", "99.flac"), library.joinpath("Artist 1", "01.flac"))
+        results.append((db.get_all_files(), {stage: list(db.iter_queued_files(stage)) for stage in Stage}))
+
+    assert results[0] == results[1]
+    assert {file.type for file in results[0][0]} == {FileType.LOSSLESS, FileType.OTHER}
+
+
+def test_moved_scan(tmp_path, monkeypatch):
+    library = Path(tmp_path).joinpath("library")
+    for name in ["a.txt", "b.txt", "pending.txt"]:
+        library.joinpath("Album").mkdir(parents=True, exist_ok=True)
+        library.joinpath("Album", name).write_text(name)
+    db = SQLiteLibrary(Path(tmp_path).joinpath("db.sqlite3"))
+    scanner = LibraryScanner(library, db)
+    keyed = []
+    move_keys = scanner_module._move_keys
+    monkeypatch.setattr(scanner_module, "_move_keys", lambda file: keyed.append(file.path) or move_keys(file))
+    scanner.scan()
+    # Nothing can have moved on the first scan, so no move keys are collected
+    assert not keyed
+    db.complete_queued_files((Stage.COPY, file) for file in db.get_all_files() if file.path.name != "pending.txt")
+
+    os.rename(library.joinpath("Album"), library.joinpath("Renamed"))
+    # A copy of a file is not a move, as it has a different inode
+    library.joinpath("Renamed", "copy.txt").write_text("a.txt")
+    assert scanner.scan()
+
+    moved = {file.path.name: file for file in db.iter_queued_files(Stage.MOVE)}
+    assert sorted(moved) == ["a.txt", "b.txt", "pending.txt"]
+    assert moved["a.txt"].moved_from == library.joinpath("Album", "a.txt")
+    # Stages the old file was still queued for are carried over
+    assert [file.path for file in db.iter_queued_files(Stage.COPY)] == [
+        library.joinpath("Renamed", "copy.txt"), library.joinpath("Renamed", "pending.txt")]
+    assert not list(db.iter_queued_files(Stage.PRUNE))
+    assert not db.get_deleted_files()
+    assert not [file for file in db.get_all_files() if file.path.parent.name == "Album"]
+    assert library.joinpath("Renamed", "copy.txt") in keyed
+    # pylint: disable=protected-access
+    assert not scanner._new
+
+
+def test_update_paths(tmp_path):
+    library = Path(tmp_path).joinpath("library")
+    for album in ["A", "B"]:
+        library.joinpath(album).mkdir(parents=True)
+        for track in ["1.txt", "2.txt"]:
+            library.joinpath(album, track).write_text(album + track)
+    db = SQLiteLibrary(Path(tmp_path).joinpath("db.sqlite3"))
+    scanner = LibraryScanner(library, db)
+    scanner.scan()
+    db.complete_queued_files((Stage.COPY, file) for file in db.get_all_files())
+
+    library.joinpath("A", "1.txt").write_text("modified")
+    library.joinpath("A", "3.txt").write_text("new")
+    library.joinpath("A", "2.txt").unlink()
+    os.rename(library.joinpath("B"), library.joinpath("C"))
+    # Unreported changes are not picked up
+    library.joinpath("untracked.txt").write_text("new")
+    assert scanner.update_paths([library.joinpath("A"), library.joinpath("A", "1.txt"), library.joinpath("B"),
+                                 library.joinpath("C"), Path(tmp_path)])
+
+    assert [file.path for file in db.iter_queued_files(Stage.COPY)] == [
+        library.joinpath("A", "1.txt"), library.joinpath("A", "3.txt")]
+    assert [file.path for file in db.iter_queued_files(Stage.PRUNE)] == [library.joinpath("A", "2.txt")]
+    assert [file.path for file in db.iter_queued_files(Stage.MOVE)] == [
+        library.joinpath("C", "1.txt"), library.joinpath("C", "2.txt")]
+    assert not db.get_file_by_path(library.joinpath("untracked.txt"))
+    assert not [file for file in db.get_all_files() if file.path.parent.name == "B"]
+
+
+def test_fast_rescan(tmp_path):
+    library = Path(tmp_path).joinpath("library")
+    for album in ["A", "B"]:
+        library.joinpath(album).mkdir(parents=True)
+        for track in ["1.txt", "2.txt"]:
+            library.joinpath(album, track).write_text(album + track)
+    db = SQLiteLibrary(Path(tmp_path).joinpath("db.sqlite3"))
+    assert LibraryScanner(library, db, fast_rescan=True).scan()
+    assert sorted(directory.path for directory in db.iter_directories()) == [
+        library, library.joinpath("A"), library.joinpath("B")]
+    db.complete_queued_files((Stage.COPY, file) for file in db.get_all_files())
+
+    # Modifying a file in place doesn't change its directory
+    library.joinpath("A", "1.txt").write_text("modified")
+    os.utime(library.joinpath("A", "1.txt"), ns=(1, 1))
+    library.joinpath("B", "2.txt").unlink()
+    library.joinpath("C").mkdir()
+    assert LibraryScanner(library, db, trust_dirs=True).scan()
+    assert not list(db.iter_queued_files(Stage.COPY))
+    assert [file.path for file in db.iter_queued_files(Stage.PRUNE)] == [library.joinpath("B", "2.txt")]
+    assert not db.get_file_by_path(library.joinpath("A", "2.txt")).was_deleted
+
+    assert LibraryScanner(library, db, fast_rescan=True).scan()
+    assert [file.path for file in db.iter_queued_files(Stage.COPY)] == [library.joinpath("A", "1.txt")]
+
+    shutil.rmtree(library.joinpath("C"))
+    assert LibraryScanner(library, db, fast_rescan=True).scan()
+    assert library.joinpath("C") not in [directory.path for directory in db.iter_directories()]
+
+
+def test_ignore_scan(tmp_path):
+    library = Path(tmp_path).joinpath("library")
+    for name in ["Album/01.txt", "Album/@eaDir/01.txt@SynoEAStream", "Album/.DS_Store", "Scratch/demo.txt"]:
+        library.joinpath(name).parent.mkdir(parents=True, exist_ok=True)
+        library.joinpath(name).write_text(name)
+    db = SQLiteLibrary(Path(tmp_path).joinpath("db.sqlite3"))
+    assert LibraryScanner(library, db, ignore=["@eaDir/", ".DS_Store"]).scan()
+    assert [file.path for file in db.get_all_files()] == [library.joinpath("Album", "01.txt"),
+                                                          library.joinpath("Scratch", "demo.txt")]
+
+    # Files that are excluded later on are deleted
+    scanner = LibraryScanner(library, db, ignore=["@eaDir/", ".DS_Store", "/Scratch/"])
+    assert scanner.scan()
+    assert [file.path for file in db.iter_queued_files(Stage.PRUNE)] == [library.joinpath("Scratch", "demo.txt")]
+    assert scanner.ignore.hits == [1, 1, 1]
+
+    # Changed paths in excluded directories are skipped
+    library.joinpath("Album", "@eaDir", "02.txt@SynoEAStream").write_text("new")
+    assert scanner.update_paths([library.joinpath("Album", "@eaDir", "02.txt@SynoEAStream")])
+    assert not db.get_file_by_path(library.joinpath("Album", "@eaDir", "02.txt@SynoEAStream"))
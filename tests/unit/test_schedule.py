@@ -0,0 +1,58 @@
+from pathlib import Path
+
+import pytest
+
+from musicbird.file import File, FileType
+from musicbird.schedule import MakespanTracker, estimate_cost, order_files, predict_makespan
+
+
+def _file(path: str, duration: float = None, sample_rate: int = None, size: int = None, mtime: int = 1) -> File:
+    return File(Path(path), FileType.LOSSLESS, mtime, mtime_ns=mtime * 10**9, size=size,
+                duration=duration, sample_rate=sample_rate)
+
+
+def test_estimate_cost():
+    assert estimate_cost(_file("/a.flac", duration=300, sample_rate=44100)) == 300
+    assert estimate_cost(_file("/a.flac", duration=300, sample_rate=88200)) == 600
+    assert estimate_cost(_file("/a.flac", duration=300)) == 300
+    assert estimate_cost(_file("/a.flac", size=1000000)) == 10
+    assert estimate_cost(_file("/a.flac")) == 0
+
+
+def test_order_files():
+    files = [
+        _file("/music/A/1.flac", duration=200, mtime=3),
+        _file("/music/A/2.flac", duration=400, mtime=1),
+        _file("/music/B/1.flac", duration=100, sample_rate=192000, mtime=2),
+        _file("/music/B/2.flac", duration=5000, mtime=4),
+    ]
+
+    def names(ordered):
+        return [str(file.path).replace("/music/", "") for file in ordered]
+    assert names(order_files(files, "lpt")) == ["B/2.flac", "B/1.flac", "A/2.flac", "A/1.flac"]
+    assert names(order_files(files, "album")) == ["A/2.flac", "A/1.flac", "B/2.flac", "B/1.flac"]
+    assert names(order_files(files, "newest")) == ["B/2.flac", "A/1.flac", "B/1.flac", "A/2.flac"]
+    assert order_files(files, "queue") == files
+    with pytest.raises(ValueError):
+        order_files(files, "random")
+
+
+def test_predict_makespan():
+    # A long job submitted last ends up running on its own
+    assert predict_makespan([1, 1, 1, 1, 4], 2) == 6
+    assert predict_makespan([4, 1, 1, 1, 1], 2) == 4
+    assert predict_makespan([], 4) == 0
+    assert predict_makespan([3], 4) == 3
+
+
+def test_makespan_tracker():
+    tracker = MakespanTracker(2)
+    assert tracker.report() == "no jobs finished"
+    for cost in [4, 2, 2]:
+        tracker.submit(cost)
+    # Jobs run at 2x realtime
+    for cost in [4, 2, 2]:
+        tracker.finish(cost, cost / 2)
+    report = tracker.report()
+    assert report.startswith("predicted 2.0s (lower bound 2.0s), actual ")
+    assert report.endswith("encoding at 2.0x realtime per worker")
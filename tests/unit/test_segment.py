@@ -0,0 +1,216 @@
+from pathlib import Path
+import struct
+from typing import Union
+
+import pytest
+
+from musicbird.encoder import EncodeResult, Encoder
+from musicbird.segment import (_crc16, _crc16_shift, _iter_ogg_pages, _ogg_crc, _ogg_page, _read_ogg_opus,
+                               encode_segmented, join_opus, plan_segments)
+
+# An MPEG-1 layer III frame header at 128 kbit/s, 44.1 kHz, stereo. Frames are 417 bytes long
+_MP3_HEADER = b"\xff\xfb\x90\x00"
+_MP3_FRAME_SIZE = 417
+# Encoder delay of LAME, including the delay of the decoder
+_MP3_DELAY = 1105
+_ID3 = b"ID3\x04\x00\x00\x00\x00\x00\x05TIT2x"
+_OPUS_PRESKIP = 312
+
+
+def _mp3_frame(payload: bytes) -> bytes:
+    return _MP3_HEADER + bytes(32) + payload + bytes(_MP3_FRAME_SIZE - 36 - len(payload))
+
+
+def _mp3_encode(samples: int, offset: int, first: bool) -> bytes:
+    """Simulate an MP3 encode of a segment. Each frame contains its position in an encode of the entire file."""
+    frames = (samples + _MP3_DELAY + 1151) // 1152
+    audio = b"".join(_mp3_frame(struct.pack(">I", offset // 1152 + index)) for index in range(frames))
+    padding = frames * 1152 - 576 - samples
+    lame = (b"LAME3.100" + bytes(12) + ((576 << 12) | padding).to_bytes(3, "big") + bytes(4)
+            + (len(audio) + _MP3_FRAME_SIZE).to_bytes(4, "big") + _crc16(audio).to_bytes(2, "big"))
+    info = bytearray(_mp3_frame(b"Info" + struct.pack(">III", 0x0f, frames, len(audio)) + bytes(104) + lame + b"\0\0"))
+    info[190:192] = _crc16(bytes(info[:190])).to_bytes(2, "big")
+    return (_ID3 if first else b"") + bytes(info) + audio
+
+
+def _opus_encode(samples: int, offset: int, first: bool) -> bytes:
+    """Simulate an Ogg Opus encode of a segment. Each packet contains its position in an encode of the entire file."""
+    head = b"OpusHead" + struct.pack("<BBHIhB", 1, 2, _OPUS_PRESKIP, 44100, 0, 0)
+    tags = b"OpusTags" + struct.pack("<I", 4) + b"test" + (struct.pack("<II", 1, 7) + b"TITLE=x" if first else bytes(4))
+    packets = [b"\xf8" + struct.pack(">I", offset // 960 + index)
+               for index in range((samples + _OPUS_PRESKIP + 959) // 960)]
+    pages = [_ogg_page(1234, 0, 0, 0x02, [head]), _ogg_page(1234, 1, 0, 0, [tags])]
+    for index in range(0, len(packets), 30):
+        last = index + 30 >= len(packets)
+        granule = _OPUS_PRESKIP + samples if last else (index + 30) * 960
+        pages.append(_ogg_page(1234, len(pages), granule, 0x04 if last else 0, packets[index:index + 30]))
+    return b"".join(pages)
+
+
+class _FakeEncoder(Encoder):
+    """Writes simulated encodes, at an output rate of 48 kHz for Opus and at the source rate for MP3."""
+
+    def __init__(self, segment_format: str) -> None:
+        self.segment_format = segment_format
+        self.extension = f".{segment_format}"
+        self.segments = []
+
+    def encode(self, src: Path, dest: Path, limits=None) -> EncodeResult:
+        return EncodeResult("error")
+
+    def output_rate(self, sample_rate: int) -> int:
+        return 48000 if self.segment_format == "opus" else sample_rate
+
+    def encode_segment(self, src: Path, dest: Path, seek: int, start: int, end: Union[int, None], sample_rate: int,
+                       first: bool, limits=None) -> EncodeResult:
+        self.segments.append((seek, start, end, first))
+        end = int(src.read_text()) if end is None else end
+        rate = self.output_rate(sample_rate)
+        offset, samples = start * rate // sample_rate, (end - start) * rate // sample_rate
+        encode = _opus_encode if self.segment_format == "opus" else _mp3_encode
+        dest.write_bytes(encode(samples, offset, first))
+        return EncodeResult()
+
+
+def _reference_ogg_crc(data: bytes) -> int:
+    crc = 0
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04c11db7 if crc & 0x80000000 else crc << 1) & 0xffffffff
+    return crc
+
+
+def test_plan_segments():
+    for sample_rate, output_rate, frame_size in ((44100, 44100, 1152), (96000, 48000, 1152),
+                                                 (44100, 48000, 960), (22050, 22050, 576)):
+        segments = plan_segments(3600, sample_rate, output_rate, frame_size, 600)
+        assert len(segments) == 6
+        assert segments[0].start == segments[0].seek == segments[0].offset == segments[0].keep_start == 0
+        assert segments[-1].end is None and segments[-1].keep_end is None
+        for segment in segments:
+            assert segment.seek * sample_rate <= segment.start
+            # Boundaries are on a grid of frames shared by all segments
+            assert segment.offset % frame_size == 0
+            assert segment.offset * sample_rate % output_rate == 0
+            assert segment.keep_start % frame_size == 0
+        for segment, following in zip(segments, segments[1:]):
+            assert segment.offset + segment.keep_end == following.offset + following.keep_start
+            assert segment.end > following.start
+            # The range of each segment is about as long as requested
+            assert abs(segment.keep_end - segment.keep_start - 600 * output_rate) < 600 * output_rate / 100
+
+    # A short remainder is merged into the last segment, files that are too short are not split at all
+    assert len(plan_segments(1500, 44100, 44100, 1152, 600)) == 2
+    assert plan_segments(800, 44100, 44100, 1152, 600) == []
+
+
+def test_crc16_shift():
+    data = bytes(range(256)) * 3
+    assert _crc16_shift(_crc16(data[:100]), 668) ^ _crc16(data[100:]) == _crc16(data)
+    assert _crc16_shift(_crc16(data), 100) == _crc16(data + bytes(100))
+    assert _crc16_shift(_crc16_shift(_crc16(data), 12345), -12345) == _crc16(data)
+
+
+def test_ogg_crc():
+    data = bytes(range(256)) * 4 + b"OggS"
+    assert _ogg_crc(data) == _reference_ogg_crc(data)
+
+
+def test_encode_segmented_mp3(tmp_path: Path):
+    total = 44100 * 65 + 123
+    src = tmp_path.joinpath("mix.flac")
+    src.write_text(str(total))
+    dest = tmp_path.joinpath("out", "mix.mp3")
+    encoder = _FakeEncoder("mp3")
+
+    assert encode_segmented(encoder, src, dest, total / 44100, 44100, 20)
+    assert len(encoder.segments) == 3
+    assert [first for _, _, _, first in encoder.segments] == [True, False, False]
+    assert list(dest.parent.iterdir()) == [dest]
+
+    # The joined file looks exactly like an encode of the entire file
+    data = dest.read_bytes()
+    assert data.startswith(_ID3)
+    info, audio = data[len(_ID3):len(_ID3) + _MP3_FRAME_SIZE], data[len(_ID3) + _MP3_FRAME_SIZE:]
+    frames = (total + _MP3_DELAY + 1151) // 1152
+    assert len(audio) == frames * _MP3_FRAME_SIZE
+    for index in range(frames):
+        assert audio[index * _MP3_FRAME_SIZE + 36:index * _MP3_FRAME_SIZE + 40] == struct.pack(">I", index)
+    assert info[36:40] == b"Info"
+    assert struct.unpack_from(">II", info, 44) == (frames, len(audio))
+    toc = info[52:152]
+    assert toc[0] == 0 and list(toc) == sorted(toc) and abs(toc[50] - 128) <= 1
+    lame = 156
+    assert int.from_bytes(info[lame + 21:lame + 24], "big") == (576 << 12) | (frames * 1152 - 576 - total)
+    assert int.from_bytes(info[lame + 28:lame + 32], "big") == len(audio) + _MP3_FRAME_SIZE
+    assert int.from_bytes(info[lame + 32:lame + 34], "big") == _crc16(audio)
+    assert int.from_bytes(info[lame + 34:lame + 36], "big") == _crc16(info[:lame + 34])
+
+
+def test_encode_segmented_opus(tmp_path: Path):
+    total = 44100 * 65 + 123
+    src = tmp_path.joinpath("mix.flac")
+    src.write_text(str(total))
+    dest = tmp_path.joinpath("mix.opus")
+    encoder = _FakeEncoder("opus")
+
+    assert encode_segmented(encoder, src, dest, total / 44100, 44100, 20)
+    assert len(encoder.segments) == 3
+
+    data = dest.read_bytes()
+    last_start = encoder.segments[-1][1]
+    samples = last_start * 48000 // 44100 + (total - last_start) * 48000 // 44100
+    stream = _read_ogg_opus(data)
+    assert stream.header == _opus_encode(0, 0, True)[:len(stream.header)]
+    assert stream.preskip == _OPUS_PRESKIP
+    assert stream.granule == _OPUS_PRESKIP + samples
+    assert [packet[1:] for packet in stream.packets] == [
+        struct.pack(">I", index) for index in range((samples + _OPUS_PRESKIP + 959) // 960)]
+
+    position = 0
+    sequence = 0
+    while position < len(data):
+        length = 27 + data[position + 26] + sum(data[position + 27:position + 27 + data[position + 26]])
+        page = bytearray(data[position:position + length])
+        assert struct.unpack_from("<I", page, 18)[0] == sequence
+        crc = struct.unpack_from("<I", page, 22)[0]
+        page[22:26] = bytes(4)
+        assert crc == _reference_ogg_crc(bytes(page))
+        position += length
+        sequence += 1
+    # Only the last page ends the stream
+    assert page[5] == 0x04
+
+
+def test_join_opus_granules(tmp_path: Path):
+    # The last page of the joined file holds a single packet, with fewer samples than the pre-skip
+    total = 3450 * 960 + 100 - _OPUS_PRESKIP
+    src = tmp_path.joinpath("mix.flac")
+    src.write_text(str(total))
+    dest = tmp_path.joinpath("mix.opus")
+
+    assert encode_segmented(_FakeEncoder("opus"), src, dest, total / 48000, 48000, 20)
+    pages = list(_iter_ogg_pages(dest.read_bytes()))[2:]
+    granules = [granule for _, granule, _, _, _ in pages]
+    assert len(pages[-1][2]) == 1
+    assert all(granule < following for granule, following in zip(granules, granules[1:]))
+    # Granule positions count the decoded samples, including the pre-skip
+    assert granules[-2] == sum(len(segments) for _, _, segments, _, _ in pages[:-1]) * 960
+    assert granules[-1] - _OPUS_PRESKIP == total
+
+
+def test_join_opus_preskip(tmp_path: Path):
+    segments = plan_segments(60, 48000, 48000, 960, 30)
+    parts = []
+    for index, segment in enumerate(segments):
+        path = tmp_path.joinpath(f"{index}.opus")
+        data = bytearray(_opus_encode(48000 * 40, segment.offset, index == 0))
+        # Change the pre-skip of the second segment
+        if index:
+            data[28 + 10:28 + 12] = struct.pack("<H", 100)
+        path.write_bytes(bytes(data))
+        parts.append((path, segment))
+    with pytest.raises(ValueError, match="pre-skip"):
+        join_opus(parts, tmp_path.joinpath("out.opus"))
+    assert not tmp_path.joinpath("out.opus").exists()
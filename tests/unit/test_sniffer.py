@@ -0,0 +1,136 @@
+from pathlib import Path
+import random
+import struct
+
+import pytest
+
+from musicbird import sniffer
+from musicbird.file import File, FileType
+from musicbird.sniffer import sniff_codecs
+
+
+def _random_bytes(size: int) -> bytes:
+    # Use a fixed seed, so that all test workers generate the same parameters
+    generator = random.Random(size)
+    return bytes(generator.getrandbits(8) for _ in range(size))
+
+
+def _box(box_type: bytes, *contents: bytes) -> bytes:
+    data = b"".join(contents)
+    return struct.pack(">I4s", len(data) + 8, box_type) + data
+
+
+def _mp4(sample_entry: bytes, handler: bytes = b"soun") -> bytes:
+    hdlr = _box(b"hdlr", bytes(8), handler, bytes(12))
+    stsd = _box(b"stsd", bytes(4), struct.pack(">I", 1), sample_entry)
+    trak = _box(b"trak", _box(b"mdia", hdlr, _box(b"minf", _box(b"stbl", stsd))))
+    # Put the media data first, as done by encoders that don't optimize files for streaming
+    return _box(b"ftyp", b"M4A ", bytes(4)) + _box(b"mdat", bytes(20000)) + _box(b"moov", trak)
+
+
+def _mp4a(object_type: int) -> bytes:
+    decoder_config = bytes([0x04, 13, object_type]) + bytes(12)
+    es_descriptor = bytes([0x03, 0x80, 0x80, 0x80, 3 + len(decoder_config), 0, 1, 0]) + decoder_config
+    return _box(b"mp4a", bytes(6), struct.pack(">H", 1), bytes(20), _box(b"esds", bytes(4), es_descriptor))
+
+
+def _mp3_frames(count: int = 3) -> bytes:
+    # MPEG-1 Layer III, 128 kbit/s, 44.1 kHz: 417 bytes per frame
+    return (b"\xff\xfb\x90\x00" + bytes(413)) * count
+
+
+def _ogg_page(packet: bytes) -> bytes:
+    return b"OggS\x00\x02" + bytes(20) + bytes([1, len(packet)]) + packet
+
+
+def _wave(format_tag: int, bits: int) -> bytes:
+    fmt = struct.pack("<HHIIHH", format_tag, 2, 44100, 44100 * bits // 4, bits // 4, bits)
+    return b"RIFF\x00\x00\x00\x00WAVE" + b"JUNK\x03\x00\x00\x00abc\x00" + b"fmt \x10\x00\x00\x00" + fmt + b"data"
+
+
+def _aiff(form: bytes, compression: bytes = b"") -> bytes:
+    comm = struct.pack(">hIh", 2, 1000, 16) + bytes(10) + compression
+    return b"FORM\x00\x00\x00\x00" + form + b"COMM" + struct.pack(">I", len(comm)) + comm
+
+
+def _asf(format_tag: int) -> bytes:
+    stream = (sniffer._ASF_AUDIO_MEDIA + bytes(16) + bytes(8) + struct.pack("<IIHI", 18, 0, 1, 0)
+              + struct.pack("<H", format_tag) + bytes(16))
+    stream_object = sniffer._ASF_STREAM_PROPERTIES + struct.pack("<Q", len(stream) + 24) + stream
+    return sniffer._ASF_HEADER + struct.pack("<QIH", len(stream_object) + 30, 1, 0) + stream_object
+
+
+@pytest.mark.parametrize("content,codecs", [
+    (b"fLaC\x00\x00\x00\x22" + bytes(100), ["flac"]),
+    (_mp3_frames(), ["mp3"]),
+    (b"ID3\x04\x00\x00\x00\x00\x00\x64" + bytes(100) + _mp3_frames(), ["mp3"]),
+    (b"ID3\x04\x00\x00\x00\x00\x7f\x7f" + bytes(16383) + _mp3_frames(), ["mp3"]),
+    (b"ID3\x03\x00\x00\x00\x00\x00\x10" + bytes(16) + b"fLaC", ["flac"]),
+    ((b"\xff\xf1\x50\x80\x0c\x9f\xfc" + bytes(93)) * 3, ["aac"]),
+    (_wave(1, 16), ["pcm_s16le"]),
+    (_wave(1, 24), ["pcm_s24le"]),
+    (_wave(3, 32), ["pcm_f32le"]),
+    (_aiff(b"AIFF"), ["pcm_s16be"]),
+    (_aiff(b"AIFC", b"sowt"), ["pcm_s16le"]),
+    (_ogg_page(b"OpusHead\x01\x02"), ["opus"]),
+    (_ogg_page(b"\x01vorbis\x00\x00"), ["vorbis"]),
+    (_asf(0x161), ["wmav2"]),
+    (_mp4(_mp4a(0x40)), ["aac"]),
+    (_mp4(_box(b"alac", bytes(28))), ["alac"]),
+    (b"\xff\xd8\xff\xe0" + bytes(100), []),
+    ("REM GENRE Rock\nFILE \"01 - Täst.flac\" WAVE\n".encode("utf-8"), []),
+    (b"", []),
+], ids=["flac", "mp3", "id3-mp3", "id3-large-mp3", "id3-flac", "adts", "wav-s16", "wav-s24", "wav-f32", "aiff",
+        "aifc-sowt", "ogg-opus", "ogg-vorbis", "asf-wma", "mp4-aac", "mp4-alac", "jpeg", "text", "empty"])
+def test_sniff_codecs(tmp_path, content: bytes, codecs):
+    path = Path(tmp_path).joinpath("file")
+    path.write_bytes(content)
+    assert sniff_codecs(path) == codecs
+
+
+@pytest.mark.parametrize("content", [
+    _random_bytes(4096),
+    # A frame sync pattern that is not followed by a second frame
+    b"\xff\xfb\x90\x00" + bytes(2000),
+    _ogg_page(b"\x80theora"),
+    _mp4(_mp4a(0x40), handler=b"vide"),
+    b"RIFF\x00\x00\x00\x00WAVE",
+], ids=["random", "single-frame", "ogg-theora", "mp4-video", "wav-no-fmt"])
+def test_sniff_codecs_unknown(tmp_path, content: bytes):
+    path = Path(tmp_path).joinpath("file")
+    path.write_bytes(content)
+    assert sniff_codecs(path) is None
+
+
+def test_sniff_stream_info(tmp_path):
+    # STREAMINFO of a 90 minute stereo file with 24 bit samples at 96 kHz
+    packed = 96000 << 44 | 1 << 41 | 23 << 36 | 96000 * 5400
+    path = Path(tmp_path).joinpath("track.flac")
+    path.write_bytes(b"fLaC\x80\x00\x00\x22" + bytes(10) + packed.to_bytes(8, "big") + bytes(100))
+    assert sniffer.sniff_file(path) == (["flac"], sniffer.StreamInfo(5400.0, 96000))
+
+    file = File(path)
+    file.determine_type()
+    assert (file.type, file.duration, file.sample_rate) == (FileType.LOSSLESS, 5400.0, 96000)
+
+    # Encoders that can't seek back leave the number of samples at 0
+    path.write_bytes(b"fLaC\x80\x00\x00\x22" + bytes(10) + (96000 << 44).to_bytes(8, "big") + bytes(100))
+    assert sniffer.sniff_file(path) == (["flac"], None)
+
+
+def test_determine_type_fallback(tmp_path, monkeypatch):
+    probed = []
+    monkeypatch.setattr(File, "_probe_codecs", lambda self, probe_cache=None: probed.append(self.path) or ["mp3"])
+    sniffer.stats.reset()
+
+    flac = Path(tmp_path).joinpath("track.flac")
+    flac.write_bytes(b"fLaC" + bytes(100))
+    unknown = Path(tmp_path).joinpath("track.mp3")
+    unknown.write_bytes(_random_bytes(4096))
+    files = [File(flac), File(unknown)]
+    for file in files:
+        file.determine_type()
+
+    assert [file.type for file in files] == [FileType.LOSSLESS, FileType.LOSSY]
+    assert probed == [unknown]
+    assert (sniffer.stats.hits, sniffer.stats.fallbacks) == (1, 1)
@@ -0,0 +1,89 @@
+from pathlib import Path
+
+import pytest
+
+from musicbird.ignore import IgnoreRules
+from musicbird.walker import LibraryWalker
+
+
+@pytest.fixture
+def tree(tmp_path) -> Path:
+    """Creates a directory tree whose directory order differs from its path order.
+
+    "Artist A.txt" sorts before "Artist/..." because " " < "/", even though a naive depth-first walk
+    would visit the "Artist" directory first.
+    """
+    root = Path(tmp_path).joinpath("tree")
+    for name in ["Artist/Album/01.flac", "Artist/Album/cover.jpg", "Artist A.txt", "Artist A/track.mp3",
+                 "Artist-B/Thumbs.db", "Artist-B/track.mp3", "a.txt", "empty/"]:
+        path = root.joinpath(name)
+        if name.endswith("/"):
+            path.mkdir(parents=True)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(name)
+    return root
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_walk_order(tree: Path, threads: int):
+    walker = LibraryWalker(tree, threads)
+    paths = [str(file.path) for file in walker.walk()]
+
+    assert paths == sorted(str(path) for path in tree.glob("**/*") if path.is_file())
+    assert not walker.failed
+
+
+def test_walk_ignore(tree: Path):
+    files = list(LibraryWalker(tree, ignore=IgnoreRules(tree, ["Thumbs.db"])).walk())
+    assert tree.joinpath("Artist-B/Thumbs.db") not in [file.path for file in files]
+    assert tree.joinpath("Artist-B/track.mp3") in [file.path for file in files]
+
+
+def test_walk_ignore_dirs(tree: Path, monkeypatch):
+    ignore = IgnoreRules(tree, ["Artist/", "*.mp3", "!Artist A/*.mp3"])
+    listed = []
+    original = LibraryWalker._scan_dir
+    monkeypatch.setattr(LibraryWalker, "_scan_dir", lambda self, path: listed.append(path) or original(self, path))
+
+    files = [file.path for file in LibraryWalker(tree, ignore=ignore).walk()]
+    assert files == [tree.joinpath(name) for name in ["Artist A.txt", "Artist A/track.mp3", "Artist-B/Thumbs.db",
+                                                      "a.txt"]]
+    # Excluded directories are not descended into
+    assert tree.joinpath("Artist") not in listed
+    assert ignore.hits == [1, 1, 1]
+
+
+def test_walk_mtime(tree: Path):
+    for file in LibraryWalker(tree).walk():
+        assert file.mtime == round(file.path.stat().st_mtime)
+
+
+def test_walk_missing_dir(tmp_path):
+    walker = LibraryWalker(Path(tmp_path).joinpath("missing"))
+    assert not list(walker.walk())
+    assert walker.failed
+
+
+def test_walk_index(tree: Path, monkeypatch):
+    walker = LibraryWalker(tree, index={})
+    expected = [file.path for file in walker.walk()]
+    index = {directory.path: directory for directory in walker.changed_dirs}
+    assert sorted(index) == sorted([tree] + [path for path in tree.glob("**/*") if path.is_dir()])
+    assert index[tree.joinpath("Artist")].children == ["Album/"]
+
+    # Unchanged directories are not listed again
+    tree.joinpath("Artist-B", "new.mp3").write_text("new")
+    listed = []
+    original = LibraryWalker._scan_dir
+    monkeypatch.setattr(LibraryWalker, "_scan_dir", lambda self, path: listed.append(path) or original(self, path))
+    walker = LibraryWalker(tree, index=index)
+    assert [file.path for file in walker.walk()] == sorted(expected + [tree.joinpath("Artist-B", "new.mp3")], key=str)
+    assert listed == [tree.joinpath("Artist-B")]
+    assert [directory.path for directory in walker.changed_dirs] == [tree.joinpath("Artist-B")]
+    assert walker.visited_dirs == set(index)
+
+    # With trust_dirs, the files in unchanged directories are skipped
+    walker = LibraryWalker(tree, index=index, trust_dirs=True)
+    assert [file.path.name for file in walker.walk()] == ["Thumbs.db", "new.mp3", "track.mp3"]
+    assert walker.trusted_dirs == set(index) - {tree.joinpath("Artist-B")}
@@ -0,0 +1,105 @@
+import os
+from pathlib import Path
+import time
+
+import pytest
+
+from musicbird.ignore import IgnoreRules
+from musicbird.watch import _collect
+from musicbird.watcher import InotifyWatcher, PollingWatcher, Watcher
+
+
+def _read_all(watcher: Watcher, timeout: float = 0.5):
+    changed = set()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        changed.update(watcher.read(0.05))
+    return changed
+
+
+@pytest.fixture
+def inotify_watcher(tmp_path):
+    library = Path(tmp_path).joinpath("library")
+    library.joinpath("Album").mkdir(parents=True)
+    try:
+        watcher = InotifyWatcher(library)
+    except OSError as e:
+        pytest.skip(f"inotify is not available: {repr(e)}")
+    yield library, watcher
+    watcher.close()
+
+
+def test_inotify_watcher(inotify_watcher):
+    library, watcher = inotify_watcher
+    assert not watcher.read(0)
+
+    library.joinpath("Album", "01.flac").write_bytes(b"data")
+    assert _read_all(watcher) == {library.joinpath("Album", "01.flac")}
+
+    # New directories are watched as well and reported as a whole
+    library.joinpath("New").mkdir()
+    assert _read_all(watcher) == {library.joinpath("New")}
+    library.joinpath("New", "02.flac").write_bytes(b"data")
+    assert _read_all(watcher) == {library.joinpath("New", "02.flac")}
+
+    # Moved directories are watched at their new location
+    os.rename(library.joinpath("New"), library.joinpath("Renamed"))
+    assert _read_all(watcher) == {library.joinpath("New"), library.joinpath("Renamed")}
+    library.joinpath("Renamed", "02.flac").unlink()
+    assert _read_all(watcher) == {library.joinpath("Renamed", "02.flac")}
+
+
+def test_inotify_watcher_ignore(tmp_path):
+    library = Path(tmp_path).joinpath("library")
+    library.joinpath("Album", "@eaDir").mkdir(parents=True)
+    try:
+        watcher = InotifyWatcher(library, IgnoreRules(library, ["@eaDir/", "Thumbs.db"]))
+    except OSError as e:
+        pytest.skip(f"inotify is not available: {repr(e)}")
+    try:
+        library.joinpath("Album", "@eaDir", "01.flac@SynoEAStream").write_bytes(b"data")
+        library.joinpath("Album", "Thumbs.db").write_bytes(b"data")
+        library.joinpath("@eaDir").mkdir()
+        library.joinpath("@eaDir", "02.flac@SynoEAStream").write_bytes(b"data")
+        assert not _read_all(watcher)
+        library.joinpath("Album", "01.flac").write_bytes(b"data")
+        assert _read_all(watcher) == {library.joinpath("Album", "01.flac")}
+    finally:
+        watcher.close()
+
+
+def test_polling_watcher(tmp_path):
+    library = Path(tmp_path).joinpath("library")
+    library.joinpath("Album").mkdir(parents=True)
+    library.joinpath("Album", "01.flac").write_bytes(b"data")
+    library.joinpath("Album", "02.flac").write_bytes(b"data")
+    watcher = PollingWatcher(library, 0.1)
+
+    library.joinpath("Album", "01.flac").write_bytes(b"modified")
+    library.joinpath("Album", "02.flac").unlink()
+    library.joinpath("Album", "03.flac").write_bytes(b"data")
+    assert _read_all(watcher) == {library.joinpath("Album", f"0{i}.flac") for i in range(1, 4)}
+
+
+class _ScriptedWatcher(Watcher):
+    """Watcher that returns one batch of changes per read, then nothing."""
+
+    def __init__(self, batches):
+        super().__init__(Path("/"))
+        self.batches = batches
+
+    def read(self, timeout):
+        return self.batches.pop(0) if self.batches else set()
+
+
+def test_collect():
+    paths = [Path(f"/{i}") for i in range(5)]
+    watcher = _ScriptedWatcher([{paths[0]}, {paths[1]}, {paths[2]}, set(), {paths[3]}])
+    # Changes are collected until a read returns nothing
+    assert _collect(watcher, 0, 60) == set(paths[:3])
+    assert _collect(watcher, 0, 60) == {paths[3]}
+    assert _collect(watcher, 0, 60) == set()
+
+    # Constant changes are processed after max_delay
+    watcher = _ScriptedWatcher([{path} for path in paths])
+    assert _collect(watcher, 0, 0) == {paths[0]}